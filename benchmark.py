@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Measure the importers, the indexer and the publisher against a fake IPFS node.
+
+Generates synthetic Common Voice directories of several sizes, starts a
+FakeIPFS server and runs each tool on them in a fresh process, reporting
+records per second, peak RSS and the requests made to the API.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import fakeipfs
+
+# MPEG 1 layer III, 32 kbit/s, 44.1 kHz, joint stereo
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x10, 0x64])
+FRAME_SIZE = 144 * 32000 // 44100
+SIDE_INFO = 32
+
+WORDS = ['ada', 'bele', 'cumo', 'dira', 'esen', 'fulu', 'gara', 'hobi', 'ilke', 'jasa',
+		'kuzu', 'lale', 'mavi', 'nane', 'okul', 'pari', 'renk', 'salı', 'tuz', 'uzun']
+
+TOOLS = ['importer', 'importer_mp', 'importer_async', 'indexer', 'publisher']
+
+
+def make_clip(path, frames):
+	"""
+	Write a silent MP3 with an ID3 tag and a Xing header giving its number of frames
+	path: where to write it
+	frames: number of MPEG frames, 1152 samples each
+	"""
+	from mutagen.id3 import ID3, TSSE
+
+	first = bytearray(FRAME_SIZE)
+	first[:4] = FRAME_HEADER
+	xing = 4 + SIDE_INFO
+	first[xing:xing + 4] = b'Xing'
+	first[xing + 4:xing + 8] = (1).to_bytes(4, 'big')
+	first[xing + 8:xing + 12] = frames.to_bytes(4, 'big')
+	silent = FRAME_HEADER + bytes(FRAME_SIZE - 4)
+	with open(path, 'wb') as clip_file:
+		clip_file.write(bytes(first) + silent * (frames - 1))
+
+	tags = ID3()
+	tags.add(TSSE(encoding=3, text=['omnilingo benchmark']))
+	tags.save(path)
+
+
+def make_dataset(path, rows, locale, seed=0):
+	"""
+	Generate a Common Voice directory with validated.tsv and clips/
+	path: directory to create
+	rows: number of clips
+	locale: value of the locale column
+	seed: seed of the random sentences and clip lengths
+	"""
+	rng = random.Random(seed)
+	os.makedirs(os.path.join(path, 'clips'), exist_ok=True)
+	sentences = []
+	for _ in range(max(1, rows // 4)):
+		sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+		sentences.append(sentence.capitalize() + '.')
+
+	with open(os.path.join(path, 'validated.tsv'), 'w', newline='') as tsv_file:
+		writer = csv.writer(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE, quotechar=None, lineterminator='\n')
+		writer.writerow(['client_id', 'path', 'sentence', 'up_votes', 'down_votes', 'age', 'gender', 'accent', 'locale', 'segment'])
+		for i in range(rows):
+			clip_name = 'common_voice_%s_%08d.mp3' % (locale, i)
+			# 40 to 350 frames, about 1 to 9 seconds
+			make_clip(os.path.join(path, 'clips', clip_name), rng.randint(40, 350))
+			client_id = '%064x' % rng.getrandbits(256)
+			writer.writerow([client_id, clip_name, rng.choice(sentences), '2', '0', '', '', '', locale, ''])
+
+
+def peak_rss():
+	"""Peak resident set size of this process and its children, in MiB"""
+	# kilobytes on Linux, bytes on macOS
+	unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+	try:
+		# ru_maxrss can carry over from the benchmark process on Linux, the
+		# high water mark in /proc only covers this process
+		with open('/proc/self/status') as status:
+			for line in status:
+				if line.startswith('VmHWM:'):
+					peak = int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	return max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+def run_importer(dataset, work, opts):
+	import importer
+	imp = importer.Importer()
+	imp.hashify(dataset, os.path.join(work, 'index.json'), batch_size=opts['batch_size'])
+	imp.close()
+
+
+def run_importer_mp(dataset, work, opts):
+	import importer_mp
+	imp = importer_mp.Importer()
+	imp.hashify(dataset, os.path.join(work, 'index_mp.json'), batch_size=opts['batch_size'])
+	imp.close()
+
+
+def run_importer_async(dataset, work, opts):
+	import importer_async
+
+	async def run():
+		imp = importer_async.Importer(api=opts['api'])
+		await imp.connect()
+		try:
+			await imp.hashify(dataset, os.path.join(work, 'index_async.json'), batch_size=opts['batch_size'])
+		finally:
+			await imp.close()
+
+	asyncio.run(run())
+
+
+def run_indexer(dataset, work, opts):
+	import indexer
+	ind = indexer.Indexer(opts['locale'], seed=0)
+	index_cid = ind.index(os.path.join(work, 'index.json'))
+	ind.close()
+	with open(os.path.join(work, 'index.cid'), 'w') as cid_file:
+		cid_file.write(index_cid)
+
+
+def run_publisher(dataset, work, opts):
+	import publisher
+	model_fn = os.path.join(work, 'model.tflite')
+	if not os.path.exists(model_fn):
+		with open(model_fn, 'wb') as model_file:
+			model_file.write(os.urandom(4 * 1024 * 1024))
+	model = (model_fn, {'format': 'coqui', 'type': 'acoustic', 'licence': 'AGPL-3.0'})
+	index_cid = fakeipfs.cid(b'[]')
+	if os.path.exists(os.path.join(work, 'index.cid')):
+		with open(os.path.join(work, 'index.cid')) as cid_file:
+			index_cid = cid_file.read()
+	pub = publisher.Publisher()
+	for i in range(opts['locales']):
+		pub.add('%s%d' % (opts['locale'], i), 'Benchmark %d' % i, [model], index_cid)
+	pub.publish()
+	pub.close()
+
+
+RUNNERS = {
+	'importer': run_importer,
+	'importer_mp': run_importer_mp,
+	'importer_async': run_importer_async,
+	'indexer': run_indexer,
+	'publisher': run_publisher,
+}
+
+
+def child(tool, dataset, work, opts, conn):
+	"""Run one tool in a fresh process and send back its time and peak RSS"""
+	if not opts['verbose']:
+		devnull = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(devnull, 1)
+		os.dup2(devnull, 2)
+	start = time.perf_counter()
+	RUNNERS[tool](dataset, work, opts)
+	conn.send((time.perf_counter() - start, peak_rss()))
+	conn.close()
+
+
+def run(tool, dataset, work, opts, fake):
+	"""
+	Run a tool against the fake node
+	tool: one of TOOLS
+	dataset: Common Voice directory
+	work: directory for its output
+	opts: benchmark options
+	fake: the FakeIPFS server
+	Returns a dict of results, None if the tool failed
+	"""
+	fake.reset()
+	ctx = multiprocessing.get_context('spawn')
+	(parent_conn, child_conn) = ctx.Pipe(duplex=False)
+	proc = ctx.Process(target=child, args=(tool, dataset, work, opts, child_conn))
+	proc.start()
+	child_conn.close()
+	try:
+		(seconds, rss) = parent_conn.recv()
+	except EOFError:
+		proc.join()
+		print('%s failed with exit code %s, run with --verbose to see why' % (tool, proc.exitcode), file=sys.stderr)
+		return None
+	proc.join()
+	return dict(seconds=seconds, peak_rss_mib=rss, **fake.stats())
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(usage='benchmark.py [--sizes N,N,...] [--latency seconds] [--tools name,...] [--json path]')
+	parser.add_argument('-s', '--sizes', dest='sizes', default='100,1000',
+			help='numbers of clips in the generated datasets (default: 100,1000)')
+	parser.add_argument('-l', '--latency', dest='latency', type=float, default=0.0,
+			help='seconds the fake node waits before answering each request (default: 0)')
+	parser.add_argument('-t', '--tools', dest='tools', default=','.join(TOOLS),
+			help='tools to run, in order (default: %s)' % ','.join(TOOLS))
+	parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=100,
+			help='batch size passed to the importers (default: 100)')
+	parser.add_argument('--locale', dest='locale', default='tr',
+			help='locale of the generated datasets (default: tr)')
+	parser.add_argument('--locales', dest='locales', type=int, default=10,
+			help='number of locales the publisher publishes (default: 10)')
+	parser.add_argument('-d', '--dir', dest='dir', default=None,
+			help='where to generate the datasets, kept afterwards (default: a temporary directory)')
+	parser.add_argument('-j', '--json', dest='json', default=None,
+			help='also write the results to this JSON file')
+	parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+			help='show the output of the tools')
+	args = parser.parse_args()
+
+	tools = args.tools.split(',')
+	for tool in tools:
+		if tool not in RUNNERS:
+			parser.error('unknown tool: ' + tool)
+
+	fake = fakeipfs.FakeIPFS(latency=args.latency)
+	# Read by ipfshttpclient when it is imported in the tool's process
+	os.environ['PY_IPFS_HTTP_CLIENT_DEFAULT_ADDR'] = fake.multiaddr
+	# Keep the tools' caches out of the user's
+	base = args.dir or tempfile.mkdtemp(prefix='omnilingo-benchmark-')
+	os.environ['XDG_CACHE_HOME'] = os.path.join(base, 'cache')
+	opts = {
+		'api': fake.url,
+		'batch_size': args.batch_size,
+		'locale': args.locale,
+		'locales': args.locales,
+		'verbose': args.verbose,
+	}
+
+	results = []
+	print('%-15s %7s %9s %10s %13s %9s' % ('tool', 'records', 'seconds', 'recs/sec', 'peak RSS MiB', 'requests'))
+	try:
+		for size in [int(size) for size in args.sizes.split(',')]:
+			dataset = os.path.join(base, 'cv-%d' % size)
+			if not os.path.exists(os.path.join(dataset, 'validated.tsv')):
+				make_dataset(dataset, size, args.locale)
+			work = os.path.join(base, 'work-%d' % size)
+			os.makedirs(work, exist_ok=True)
+			for tool in tools:
+				result = run(tool, dataset, work, opts, fake)
+				if result is None:
+					continue
+				records = args.locales if tool == 'publisher' else size
+				result.update(tool=tool, size=size, records=records, latency=args.latency,
+						recs_per_sec=records / result['seconds'])
+				results.append(result)
+				print('%-15s %7d %9.2f %10.1f %13.1f %9d' % (tool, records, result['seconds'],
+						result['recs_per_sec'], result['peak_rss_mib'], result['total_requests']))
+	finally:
+		fake.close()
+		if not args.dir:
+			shutil.rmtree(base)
+
+	if args.json:
+		with open(args.json, 'w') as json_file:
+			json.dump(results, json_file, indent=2)
@@ -0,0 +1,88 @@
+"""Strategies for sorting clips into difficulty buckets by speaking rate.
+
+A strategy works on NumPy arrays of the number of characters of each clip's
+sentence and of the clip lengths, and returns the buckets of all of the clips
+at once. Strategies that depend on the data are first fitted on a calibration
+sample of the clips of the locale, their fitted property tells if they are
+ready to assign buckets.
+"""
+import numpy
+
+NUM_BUCKETS = 10
+
+
+class FixedBuckets:
+	"""Buckets by whole characters per second, the same for every locale."""
+
+	# [47, 120, 264, 156, 173, 162, 129, 81, 69, 63]
+	# index is characters per second, value is the bucket, faster clips are in bucket 10
+	TABLE = numpy.array([1, 1, 1, 1, 1, 2, 2, 3, 3, 4, 5, 6, 7, 8, 9, 10])
+
+	def __init__(self, calibration=0):
+		"""
+		calibration: ignored, there is nothing to fit
+		"""
+		self.calibration = 0
+
+	@property
+	def fitted(self):
+		"""Always ready to assign buckets"""
+		return True
+
+	def fit(self, chars, lengths):
+		"""Nothing to fit"""
+		pass
+
+	def assign(self, chars, lengths):
+		"""
+		Find the buckets of clips
+		chars: array of the number of characters of the sentences
+		lengths: array of the clip lengths in seconds
+		Returns an array of buckets in [1..NUM_BUCKETS]
+		"""
+		rate = (numpy.asarray(chars) // numpy.asarray(lengths)).astype(numpy.int64)
+		return self.TABLE[numpy.clip(rate, 0, len(self.TABLE) - 1)]
+
+
+class QuantileBuckets:
+	"""Buckets holding equal shares of the locale's clips by characters per second."""
+
+	def __init__(self, calibration=5000):
+		"""
+		calibration: number of clips to fit the bucket edges on
+		"""
+		self.calibration = calibration
+		self.edges = None
+
+	@property
+	def fitted(self):
+		"""Check if the bucket edges were fitted, buckets can only be assigned after that"""
+		return self.edges is not None
+
+	def fit(self, chars, lengths):
+		"""
+		Put the bucket edges at the deciles of the calibration sample
+		chars: array of the number of characters of the sentences
+		lengths: array of the clip lengths in seconds
+		"""
+		rate = numpy.asarray(chars, dtype=numpy.float64) / numpy.asarray(lengths, dtype=numpy.float64)
+		if len(rate) == 0:
+			self.edges = numpy.zeros(NUM_BUCKETS - 1)
+			return
+		self.edges = numpy.quantile(rate, numpy.arange(1, NUM_BUCKETS) / NUM_BUCKETS)
+
+	def assign(self, chars, lengths):
+		"""
+		Find the buckets of clips
+		chars: array of the number of characters of the sentences
+		lengths: array of the clip lengths in seconds
+		Returns an array of buckets in [1..NUM_BUCKETS]
+		"""
+		rate = numpy.asarray(chars, dtype=numpy.float64) / numpy.asarray(lengths, dtype=numpy.float64)
+		return numpy.searchsorted(self.edges, rate, side='right') + 1
+
+
+STRATEGIES = {
+	'quantile': QuantileBuckets,
+	'fixed': FixedBuckets,
+}
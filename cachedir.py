@@ -0,0 +1,8 @@
+"""Where OmniLingo keeps its local caches."""
+import os
+
+
+def cache_dir():
+	"""Directory for OmniLingo's local caches"""
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'omnilingo')
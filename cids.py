@@ -0,0 +1,57 @@
+"""Conversion between CIDv0 strings and the SHA-256 digests they are made of."""
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B58_INDEX = {c: i for (i, c) in enumerate(B58_ALPHABET)}
+
+# Multihash prefix of a sha2-256 digest: function code 0x12, length 32
+SHA256_PREFIX = b'\x12\x20'
+DIGEST_SIZE = 32
+
+
+def b58encode(data):
+	"""
+	Base58 (Bitcoin alphabet) encoding, as used by CIDv0
+	data: bytes to encode
+	"""
+	n = int.from_bytes(data, 'big')
+	out = ''
+	while n:
+		(n, r) = divmod(n, 58)
+		out = B58_ALPHABET[r] + out
+	pad = len(data) - len(data.lstrip(b'\0'))
+	return '1' * pad + out
+
+
+def b58decode(text):
+	"""
+	Decode base58 (Bitcoin alphabet)
+	text: base58 string
+	"""
+	n = 0
+	for c in text:
+		n = n * 58 + B58_INDEX[c]
+	pad = len(text) - len(text.lstrip('1'))
+	return b'\0' * pad + n.to_bytes((n.bit_length() + 7) // 8, 'big')
+
+
+def to_digest(cid):
+	"""
+	The SHA-256 digest a CIDv0 is made of
+	cid: CIDv0 string, Qm...
+	Raises ValueError for any other kind of CID
+	"""
+	try:
+		multihash = b58decode(cid)
+	except KeyError:
+		raise ValueError('Not a base58 CID: ' + cid)
+	if len(multihash) != len(SHA256_PREFIX) + DIGEST_SIZE or not multihash.startswith(SHA256_PREFIX):
+		raise ValueError('Not a CIDv0: ' + cid)
+	return multihash[len(SHA256_PREFIX):]
+
+
+def from_digest(digest):
+	"""
+	The CIDv0 of a SHA-256 digest
+	digest: 32 bytes
+	"""
+	return b58encode(SHA256_PREFIX + bytes(digest))
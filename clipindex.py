@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""Read and write the sentence → clips index produced by the importers.
+
+The index comes in three formats, chosen by the file name:
+
+- `.json`: one JSON object mapping each sentence CID to the list of its clip CIDs.
+  The audio info of the clips, if known, goes in a second JSON object mapping
+  clip CID → info in `index_path.info`.
+- `.ndjson` or `.jsonl`: one JSON object per line,
+  `{"sentence": CID, "clips": [CID, ...], "info": {CID: info, ...}}`,
+  appended to as the import goes along. A sentence can appear on more than one line,
+  its clips are then the clips of all of its lines.
+- `.cidx`: a binary file that is memory-mapped rather than loaded. After a
+  header come the SHA-256 digests of the sentence CIDs (CIDv0 only) as sorted
+  32-byte records, the range of each sentence's clips in the clip table, the
+  sentences' order in the index, the clip digests grouped by sentence, and the
+  audio info of each clip. See BinaryIndex.
+
+The audio info of a clip is `{"length": seconds, "bitrate": bits/sec, "size": bytes}`.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy
+
+import cids
+
+STREAMING_SUFFIXES = ('.ndjson', '.jsonl')
+BINARY_SUFFIXES = ('.cidx',)
+
+BINARY_MAGIC = b'OLCLIPIX'
+BINARY_VERSION = 1
+# magic, version, number of sentences, number of clips
+BINARY_HEADER = struct.Struct('<8sIII4x')
+# A clip with no info has a NaN length
+INFO_DTYPE = numpy.dtype([('length', '<f8'), ('bitrate', '<u4'), ('size', '<u4')])
+
+
+def by_cid(cid):
+	"""
+	Sort key visiting sentences by their CID. CIDs are hashes, so this order
+	has nothing to do with the order of the file. CIDv0 strings are all the
+	same length and the base58 alphabet is in ASCII order, so they sort like
+	their digests and a binary index is already stored in this order.
+	cid: CID of a sentence
+	"""
+	return cid
+
+
+def is_streaming(path):
+	"""
+	Check if an index path is in the streaming (NDJSON) format
+	path: path to an index file
+	"""
+	return path.endswith(STREAMING_SUFFIXES)
+
+
+def is_binary(path):
+	"""
+	Check if an index path is in the binary format
+	path: path to an index file
+	"""
+	return path.endswith(BINARY_SUFFIXES)
+
+
+def _align(offset):
+	return offset + (-offset % 8)
+
+
+def _layout(num_sentences, num_clips):
+	"""Offset of each section of a binary index"""
+	sections = {}
+	offset = BINARY_HEADER.size
+	for (name, size) in (('sentences', num_sentences * cids.DIGEST_SIZE),
+			('ranges', (num_sentences + 1) * 4),
+			('order', num_sentences * 4),
+			('clips', num_clips * cids.DIGEST_SIZE),
+			('info', num_clips * INFO_DTYPE.itemsize)):
+		sections[name] = offset
+		offset = _align(offset + size)
+	sections['end'] = offset
+	return sections
+
+
+def write_binary(path, index, info):
+	"""
+	Write an index in the binary format
+	path: output path
+	index: dict of sentence digest → list of clip digests, in index order
+	info: dict of clip digest → audio info
+	"""
+	sent_digests = list(index)
+	# rank[i] is where the i-th sentence of the index is in the sorted table
+	by_digest = sorted(range(len(sent_digests)), key=sent_digests.__getitem__)
+	rank = numpy.empty(len(sent_digests), dtype='<u4')
+	rank[by_digest] = numpy.arange(len(sent_digests), dtype='<u4')
+
+	num_clips = sum(len(clips) for clips in index.values())
+	ranges = numpy.zeros(len(sent_digests) + 1, dtype='<u4')
+	clip_table = bytearray()
+	info_table = numpy.zeros(num_clips, dtype=INFO_DTYPE)
+	info_table['length'] = numpy.nan
+	n = 0
+	for (k, i) in enumerate(by_digest):
+		for clip_digest in index[sent_digests[i]]:
+			clip_table += clip_digest
+			clip_info = info.get(clip_digest)
+			if clip_info:
+				info_table[n] = (clip_info['length'], clip_info['bitrate'], clip_info['size'])
+			n += 1
+		ranges[k + 1] = n
+
+	layout = _layout(len(sent_digests), num_clips)
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as index_file:
+		index_file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(sent_digests), num_clips))
+		for (name, data) in (('sentences', b''.join(sent_digests[i] for i in by_digest)),
+				('ranges', ranges.tobytes()),
+				('order', rank.tobytes()),
+				('clips', bytes(clip_table)),
+				('info', info_table.tobytes())):
+			index_file.seek(layout[name])
+			index_file.write(data)
+		index_file.truncate(layout['end'])
+	os.replace(tmp_path, path)
+
+
+class BinaryIndex:
+	"""
+	A binary index mapped into memory, read without loading it.
+	Sentences are numbered by their place in the sorted digest table.
+	"""
+
+	def __init__(self, path):
+		"""
+		Map an index
+		path: path to a .cidx file
+		"""
+		self.path = path
+		self._file = open(path, 'rb')
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		(magic, version, num_sentences, num_clips) = BINARY_HEADER.unpack_from(self._map)
+		if magic != BINARY_MAGIC or version != BINARY_VERSION:
+			raise ValueError('%s is not a version %d binary clip index' % (path, BINARY_VERSION))
+		layout = _layout(num_sentences, num_clips)
+		if len(self._map) < layout['end']:
+			raise ValueError('%s is cut short' % path)
+		# 'S32' compares like the digests' bytes, so the table can be searched
+		self._sentences = numpy.frombuffer(self._map, dtype='S32', count=num_sentences, offset=layout['sentences'])
+		self._ranges = numpy.frombuffer(self._map, dtype='<u4', count=num_sentences + 1, offset=layout['ranges'])
+		self._order = numpy.frombuffer(self._map, dtype='<u4', count=num_sentences, offset=layout['order'])
+		self._clips = numpy.frombuffer(self._map, dtype='S32', count=num_clips, offset=layout['clips'])
+		self._info = numpy.frombuffer(self._map, dtype=INFO_DTYPE, count=num_clips, offset=layout['info'])
+
+	def __len__(self):
+		return len(self._sentences)
+
+	def clip_count(self):
+		"""Number of clips in the index"""
+		return len(self._clips)
+
+	def _digest(self, array, k):
+		# numpy drops trailing NUL bytes of 'S' items
+		return array[k].ljust(cids.DIGEST_SIZE, b'\0')
+
+	def sentence(self, k):
+		"""
+		CID of a sentence
+		k: its number
+		"""
+		return cids.from_digest(self._digest(self._sentences, k))
+
+	def clips(self, k):
+		"""
+		Clips of a sentence
+		k: its number
+		Returns (list of clip CIDs, dict of clip CID → audio info)
+		"""
+		(first, end) = (int(self._ranges[k]), int(self._ranges[k + 1]))
+		clips = []
+		info = {}
+		for n in range(first, end):
+			clip_cid = cids.from_digest(self._digest(self._clips, n))
+			clips.append(clip_cid)
+			(length, bitrate, size) = self._info[n].tolist()
+			if length == length:
+				info[clip_cid] = {'length': length, 'bitrate': bitrate, 'size': size}
+		return (clips, info)
+
+	def find(self, sent_cid):
+		"""
+		Look up a sentence by binary search
+		sent_cid: its CID
+		Returns its number, None if it is not in the index
+		"""
+		try:
+			digest = cids.to_digest(sent_cid)
+		except ValueError:
+			return None
+		k = int(numpy.searchsorted(self._sentences, numpy.bytes_(digest)))
+		if k < len(self) and self._digest(self._sentences, k) == digest:
+			return k
+		return None
+
+	def numbers(self):
+		"""Numbers of the sentences in index order"""
+		return self._order.tolist()
+
+	def sorted_numbers(self, key):
+		"""
+		Numbers of the sentences sorted by a key of their CIDs, ties in index order
+		key: sort key of sentence CIDs
+		"""
+		if key is by_cid:
+			return numpy.arange(len(self), dtype='<u4')
+		return numpy.array(sorted(self.numbers(), key=lambda k: key(self.sentence(k))), dtype='<u4')
+
+	def clip_lengths(self, ks=None):
+		"""
+		Recorded lengths of all clips and where their sentences come in a scan,
+		without making any CIDs
+		ks: numbers of the sentences in the order of the scan, None for index order
+		Returns (array of the position of each clip's sentence, array of clip
+		lengths in seconds, NaN where not recorded)
+		"""
+		position = numpy.empty(len(self), dtype=numpy.int64)
+		position[self._order if ks is None else ks] = numpy.arange(len(self))
+		# The clip table is grouped by sentence number
+		return (numpy.repeat(position, numpy.diff(self._ranges)), self._info['length'].copy())
+
+	def __iter__(self):
+		"""Yields (sentence CID, list of clip CIDs, dict of clip CID → audio info) in index order"""
+		for k in self._order:
+			k = int(k)
+			yield (self.sentence(k),) + self.clips(k)
+
+	def close(self):
+		"""Unmap the index"""
+		# The arrays point into the map, which cannot be closed while they exist
+		del self._sentences, self._ranges, self._order, self._clips, self._info
+		self._map.close()
+		self._file.close()
+
+
+class IndexWriter:
+	"""Writes the sentence → clips index as results come in."""
+
+	def __init__(self, path):
+		"""
+		Start a new index
+		path: output path, NDJSON if it ends in .ndjson or .jsonl, binary if it ends in .cidx, JSON otherwise
+		"""
+		self.path = path
+		self.streaming = is_streaming(path)
+		self.binary = is_binary(path)
+		self._index = {}
+		self._info = {}
+		self._file = None
+		if self.streaming:
+			self._file = open(path, 'w')
+
+	def extend(self, items):
+		"""
+		Add clips to the index
+		items: iterable of (sentence CID, clip CID) or (sentence CID, clip CID, audio info), in row order
+		"""
+		# Group the clips of each sentence so that it only takes one line
+		group = {}
+		info = {}
+		for item in items:
+			(sent_cid, clip_cid) = item[:2]
+			if sent_cid not in group:
+				group[sent_cid] = []
+			group[sent_cid].append(clip_cid)
+			if len(item) > 2 and item[2]:
+				info[clip_cid] = item[2]
+
+		if self.binary:
+			# Keep the digests rather than the strings, this also fails early on a CID that is not a CIDv0
+			for (sent_cid, clips) in group.items():
+				digests = [cids.to_digest(clip_cid) for clip_cid in clips]
+				self._index.setdefault(cids.to_digest(sent_cid), []).extend(digests)
+				self._info.update((digest, info[clip_cid]) for (digest, clip_cid) in zip(digests, clips) if clip_cid in info)
+			return
+
+		if not self.streaming:
+			for (sent_cid, clips) in group.items():
+				if sent_cid not in self._index:
+					self._index[sent_cid] = []
+				self._index[sent_cid] += clips
+			self._info.update(info)
+			return
+
+		for (sent_cid, clips) in group.items():
+			# The sentence goes first, iter_index reads it without parsing the line
+			entry = {'sentence': sent_cid, 'clips': clips}
+			clip_info = {clip_cid: info[clip_cid] for clip_cid in clips if clip_cid in info}
+			if clip_info:
+				entry['info'] = clip_info
+			self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+		self._file.flush()
+
+	def close(self):
+		"""Write out the JSON or binary index, or close the NDJSON one"""
+		if self.streaming:
+			self._file.close()
+			return
+		if self.binary:
+			write_binary(self.path, self._index, self._info)
+			return
+		with open(self.path, 'w') as output_file:
+			json.dump(self._index, output_file)
+		if self._info:
+			with open(self.path + '.info', 'w') as info_file:
+				json.dump(self._info, info_file)
+
+
+def scan_order(path, order):
+	"""
+	Sort the sentences of a binary index once, to pass to iter_index in place of
+	the sort key. Sorting makes the CID of every sentence, which takes a while
+	on a large index, so a caller that scans it more than once should only pay
+	for it once.
+	path: path to an index file
+	order: sort key of sentence CIDs, None for file order
+	Returns the numbers of the sentences of a binary index in order, the key
+	itself for the other formats
+	"""
+	if order is None or not is_binary(path):
+		return order
+	index = BinaryIndex(path)
+	try:
+		return index.sorted_numbers(order)
+	finally:
+		index.close()
+
+
+# How IndexWriter starts every line of a streamed index
+SENTENCE_PREFIX = b'{"sentence":"'
+
+
+def _sentence_of(line):
+	"""
+	Sentence CID of a line of a streamed index, without parsing the rest of it
+	line: bytes of the line
+	"""
+	if line.startswith(SENTENCE_PREFIX):
+		end = line.find(b'"', len(SENTENCE_PREFIX))
+		sent_cid = line[len(SENTENCE_PREFIX):end]
+		if end > 0 and b'\\' not in sent_cid:
+			return sent_cid.decode('utf-8')
+	# Written some other way, e.g. with the keys in another order
+	return json.loads(line)['sentence']
+
+
+def iter_index(path, order=None):
+	"""
+	Iterate over an index in either format without caring which one it is
+	path: path to an index file
+	order: sort key of sentence CIDs to visit them in, or what scan_order made
+	       of it, None for file order
+	Yields (sentence CID, list of clip CIDs, dict of clip CID → audio info)
+	"""
+	if is_binary(path):
+		index = BinaryIndex(path)
+		try:
+			if order is None:
+				yield from index
+				return
+			# Sorted by the key of each sentence, ties in index order
+			ks = index.sorted_numbers(order) if callable(order) else order
+			for k in ks:
+				k = int(k)
+				yield (index.sentence(k),) + index.clips(k)
+		finally:
+			index.close()
+		return
+
+	if not is_streaming(path):
+		with open(path, 'r') as index_file:
+			clip_index = json.load(index_file)
+		clip_info = {}
+		if os.path.exists(path + '.info'):
+			with open(path + '.info', 'r') as info_file:
+				clip_info = json.load(info_file)
+		sent_cids = clip_index.keys() if order is None else sorted(clip_index, key=order)
+		for sent_cid in sent_cids:
+			clips = clip_index[sent_cid]
+			yield (sent_cid, clips, {clip_cid: clip_info[clip_cid] for clip_cid in clips if clip_cid in clip_info})
+		return
+
+	with open(path, 'rb') as index_file:
+		# A sentence takes one line per batch it was in, so only keep the file
+		# offsets of the lines of each sentence in memory, then seek to them to
+		# merge its clips
+		offsets = {}
+		offset = 0
+		for line in index_file:
+			if line.strip():
+				offsets.setdefault(_sentence_of(line), []).append(offset)
+			offset += len(line)
+		# Sorted by the key of each sentence, ties in file order
+		sent_cids = offsets.keys() if order is None else sorted(offsets, key=order)
+		for sent_cid in sent_cids:
+			clips = []
+			info = {}
+			for offset in offsets[sent_cid]:
+				index_file.seek(offset)
+				entry = json.loads(index_file.readline())
+				clips += entry['clips']
+				info.update(entry.get('info', {}))
+			yield (sent_cid, clips, info)
+
+
+def clip_lengths(path, order=None):
+	"""
+	Recorded lengths of the clips of an index and where their sentences come in
+	a scan, without making any CIDs for a binary index
+	path: path to an index file
+	order: as for iter_index
+	Returns (array of the position in the scan of each clip's sentence, array
+	of clip lengths in seconds, NaN where not recorded)
+	"""
+	if is_binary(path):
+		index = BinaryIndex(path)
+		try:
+			return index.clip_lengths(index.sorted_numbers(order) if callable(order) else order)
+		finally:
+			index.close()
+
+	positions = []
+	lengths = []
+	for (position, (_, clips, info)) in enumerate(iter_index(path, order=order)):
+		for clip_cid in clips:
+			positions.append(position)
+			lengths.append(info.get(clip_cid, {}).get('length') or numpy.nan)
+	return (numpy.array(positions, dtype=numpy.int64), numpy.array(lengths, dtype=numpy.float64))
+
+
+def export(input_path, output_path):
+	"""
+	Convert an index between formats, e.g. NDJSON to the JSON format
+	input_path: path to the index to read
+	output_path: path to write, the format is chosen by the file name
+	"""
+	writer = IndexWriter(output_path)
+	for (sent_cid, clips, info) in iter_index(input_path):
+		writer.extend((sent_cid, clip_cid, info.get(clip_cid)) for clip_cid in clips)
+	writer.close()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		print('clipindex.py input_index output_index', file=sys.stderr)
+		sys.exit(-1)
+	export(sys.argv[1], sys.argv[2])
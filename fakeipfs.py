@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""In-process stand-in for the IPFS HTTP API, for benchmarks.
+
+Implements just enough of /api/v0 for the importers, the indexer and the
+publisher: version, add (multipart, including only-hash), cat (with offset and
+length), files/stat, name/publish, name/resolve, key/list and pin/ls. Objects
+are kept in memory. CIDs are CIDv0 strings of the SHA-256 of the content, they
+look like real CIDs but are not the ones a real node would give.
+
+Every request waits for a configurable latency before it is answered, and the
+requests are counted by endpoint.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import cids
+
+SELF_ID = 'k51qzi5uqu5dlfakeomnilingobenchmarkselfkey00000000000000'
+
+
+def cid(data):
+	"""
+	Fake CIDv0 of some content, a sha2-256 multihash in base58
+	data: bytes
+	"""
+	return cids.from_digest(hashlib.sha256(data).digest())
+
+
+def truthy(value):
+	return value is not None and value.lower() in ('true', '1', 'yes')
+
+
+class FakeIPFS:
+	"""A fake IPFS daemon listening on localhost in a background thread."""
+
+	def __init__(self, latency=0.0, port=0):
+		"""
+		Start the server
+		latency: seconds to wait before answering each request
+		port: TCP port to listen on, 0 for any free port
+		"""
+		self.latency = latency
+		self.objects = {}
+		self.pins = set()
+		self.names = {}
+		self.requests = Counter()
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self._lock = threading.Lock()
+
+		fake = self
+
+		class Handler(RequestHandler):
+			ipfs = fake
+
+		self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+		self._server.daemon_threads = True
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+
+	@property
+	def url(self):
+		"""Base URL of the API, as importer_async.py takes it"""
+		return 'http://127.0.0.1:%d' % self.port
+
+	@property
+	def multiaddr(self):
+		"""Address of the API, as ipfshttpclient takes it"""
+		return '/ip4/127.0.0.1/tcp/%d/http' % self.port
+
+	def reset(self):
+		"""Zero the request counters, the stored objects are kept"""
+		with self._lock:
+			self.requests.clear()
+			self.bytes_in = 0
+			self.bytes_out = 0
+
+	def stats(self):
+		"""Request counts by endpoint and bytes in and out since the last reset"""
+		with self._lock:
+			return {
+				'requests': dict(self.requests),
+				'total_requests': sum(self.requests.values()),
+				'bytes_in': self.bytes_in,
+				'bytes_out': self.bytes_out,
+			}
+
+	def store(self, data, pin=True):
+		"""
+		Keep an object
+		data: its content
+		pin: pin it as well
+		Returns its CID
+		"""
+		object_cid = cid(data)
+		with self._lock:
+			self.objects[object_cid] = data
+			if pin:
+				self.pins.add(object_cid)
+		return object_cid
+
+	def close(self):
+		"""Stop the server"""
+		self._server.shutdown()
+		self._server.server_close()
+
+
+class ApiError(Exception):
+	pass
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+	"""Answers /api/v0 requests for the FakeIPFS it belongs to."""
+
+	protocol_version = 'HTTP/1.1'
+	ipfs = None
+
+	def log_message(self, format, *args):
+		pass
+
+	def handle(self):
+		try:
+			super().handle()
+		except (ConnectionResetError, BrokenPipeError):
+			# A client that exited without closing its connection
+			pass
+
+	def read_body(self):
+		if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+			chunks = []
+			while True:
+				size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+				if size == 0:
+					# Trailers, up to the empty line
+					while self.rfile.readline().strip():
+						pass
+					break
+				chunks.append(self.rfile.read(size))
+				self.rfile.readline()
+			return b''.join(chunks)
+		return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+	def files(self, body):
+		"""Split a multipart body into (file name, content), skipping directories"""
+		content_type = self.headers.get('Content-Type', '')
+		boundary = None
+		for param in content_type.split(';')[1:]:
+			(key, _, value) = param.strip().partition('=')
+			if key == 'boundary':
+				boundary = value.strip('"').encode()
+		if boundary is None:
+			raise ApiError('not a multipart request')
+		files = []
+		for part in body.split(b'--' + boundary)[1:]:
+			if part.startswith(b'--'):
+				break
+			(head, _, content) = part.partition(b'\r\n\r\n')
+			if content.endswith(b'\r\n'):
+				content = content[:-2]
+			headers = {}
+			for line in head.decode('utf-8').strip().split('\r\n'):
+				(key, _, value) = line.partition(':')
+				headers[key.strip().lower()] = value.strip()
+			if 'directory' in headers.get('content-type', ''):
+				continue
+			name = ''
+			for param in headers.get('content-disposition', '').split(';')[1:]:
+				(key, _, value) = param.strip().partition('=')
+				if key == 'filename':
+					name = unquote(value.strip('"'))
+			files.append((name, content))
+		return files
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		params = {key: values[-1] for (key, values) in parse_qs(url.query).items()}
+		endpoint = url.path[len('/api/v0/'):] if url.path.startswith('/api/v0/') else url.path
+		body = self.read_body()
+		ipfs = self.ipfs
+		with ipfs._lock:
+			ipfs.requests[endpoint] += 1
+			ipfs.bytes_in += len(body)
+		if ipfs.latency:
+			time.sleep(ipfs.latency)
+
+		handler = getattr(self, 'api_' + endpoint.replace('/', '_'), None)
+		try:
+			if handler is None:
+				raise ApiError('unknown command: ' + endpoint)
+			(content_type, payload) = handler(params, body)
+			status = 200
+		except (ApiError, KeyError) as e:
+			content_type = 'application/json'
+			payload = json.dumps({'Message': str(e), 'Code': 0, 'Type': 'error'}).encode()
+			status = 500
+
+		with ipfs._lock:
+			ipfs.bytes_out += len(payload)
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def json(self, obj):
+		return ('application/json', json.dumps(obj).encode())
+
+	def api_version(self, params, body):
+		return self.json({'Version': '0.8.0', 'Commit': 'fake', 'Repo': '11', 'System': 'fake', 'Golang': 'fake'})
+
+	def api_add(self, params, body):
+		only_hash = truthy(params.get('only-hash'))
+		pin = params.get('pin', 'true').lower() != 'false'
+		lines = []
+		for (name, content) in self.files(body):
+			if only_hash:
+				object_cid = cid(content)
+			else:
+				object_cid = self.ipfs.store(content, pin=pin)
+			lines.append(json.dumps({'Name': name, 'Hash': object_cid, 'Size': str(len(content))}))
+		return ('application/json', ('\n'.join(lines) + '\n').encode())
+
+	def object(self, path):
+		object_cid = path[len('/ipfs/'):] if path.startswith('/ipfs/') else path
+		if object_cid not in self.ipfs.objects:
+			raise ApiError('object not found: ' + object_cid)
+		return (object_cid, self.ipfs.objects[object_cid])
+
+	def api_cat(self, params, body):
+		(_, data) = self.object(params['arg'])
+		offset = int(params.get('offset', 0))
+		data = data[offset:]
+		if 'length' in params:
+			data = data[:int(params['length'])]
+		return ('text/plain', data)
+
+	def api_files_stat(self, params, body):
+		(object_cid, data) = self.object(params['arg'])
+		return self.json({'Hash': object_cid, 'Size': len(data), 'CumulativeSize': len(data), 'Blocks': 1, 'Type': 'file'})
+
+	def api_name_publish(self, params, body):
+		name = SELF_ID if params.get('key', 'self') == 'self' else params['key']
+		path = params['arg'] if params['arg'].startswith('/ipfs/') else '/ipfs/' + params['arg']
+		self.ipfs.names[name] = path
+		return self.json({'Name': name, 'Value': path})
+
+	def api_name_resolve(self, params, body):
+		name = params['arg'].replace('/ipns/', '')
+		if name not in self.ipfs.names:
+			raise ApiError('could not resolve name')
+		return self.json({'Path': self.ipfs.names[name]})
+
+	def api_key_list(self, params, body):
+		return self.json({'Keys': [{'Name': 'self', 'Id': SELF_ID}]})
+
+	def api_pin_ls(self, params, body):
+		(object_cid, _) = self.object(params['arg'])
+		if object_cid not in self.ipfs.pins:
+			raise ApiError('path \'%s\' is not pinned' % object_cid)
+		return self.json({'Keys': {object_cid: {'Type': 'recursive'}}})
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(usage='fakeipfs.py [--port N] [--latency seconds]')
+	parser.add_argument('-p', '--port', dest='port', type=int, default=5001,
+			help='port to listen on (default: 5001)')
+	parser.add_argument('-l', '--latency', dest='latency', type=float, default=0.0,
+			help='seconds to wait before answering each request (default: 0)')
+	args = parser.parse_args()
+	fake = FakeIPFS(latency=args.latency, port=args.port)
+	print('Fake IPFS API on', fake.multiaddr, file=sys.stderr)
+	try:
+		while True:
+			time.sleep(60)
+			print(json.dumps(fake.stats()), file=sys.stderr)
+	except KeyboardInterrupt:
+		fake.close()
@@ -1,38 +1,40 @@
 #!/usr/bin/env python3
 """Import a Common Voice dump into IPFS generating an index of CIDs."""
-import csv
+import argparse
 import hashlib
 import ipfshttpclient
-from itertools import (takewhile,repeat)
-import json
 import progressbar
+import os
 import re
 import sys
+import time
 
 from mutagen.mp3 import MP3
-from mutagen.easyid3 import EasyID3
+
+import ipfsbatch
+import tagging
+from clipindex import IndexWriter
+from journal import Journal
+from manifest import Manifest, PreviousImport, clip_stat, manifest_path, row_digest
+from metrics import metrics
+from normalise import Normaliser
+from tsvreader import TSVReader
 
 class Importer:
 
 	def __init__(self):
 		"""Set up a connection to the local IPFS node"""
 		try:
-			self._client = ipfshttpclient.connect(session=True)
+			self._client = metrics.instrument(ipfshttpclient.connect(session=True))
 		except:
 			print('Could not connect to IPFS node', file=sys.stderr)
 			sys.exit(-1)
 
+		# (content, locale) → sentence CID, so each sentence is only added once
+		self._sentences = {}
+		self.sentence_hits = 0
+		self.sentence_misses = 0
 
-	def line_count(self, input_path):
-		"""
-		Efficiently count the number of lines in a file
-		input_path: path to count the number of lines in
-		"""
-		f = open(input_path, 'rb')
-		bufgen = takewhile(lambda x: x, (f.raw.read(1024*1024) for _ in repeat(None)))
-		res = sum( buf.count(b'\n') for buf in bufgen )
-		f.close()
-		return res
 
 	def path_join(self, *args, sep='/'):
 		"""
@@ -42,63 +44,200 @@ class Importer:
 		"""
 		return sep.join(args)
 
-	def hashify(self, input_path, output_path, dryrun=False):
+	def batches(self, reader, batch_size):
+		"""
+		Group the rows of a reader into lists of at most batch_size rows
+		reader: an iterable of rows
+		batch_size: maximum number of rows per batch
+		Yields (number of rows read so far, batch)
+		"""
+		batch = []
+		i = 0
+		# Only time the reading, not what the caller does between batches
+		start = time.perf_counter()
+		for (i, row) in enumerate(reader, 1):
+			batch.append(row)
+			if len(batch) == batch_size:
+				metrics.observe('tsv.read', time.perf_counter() - start)
+				yield (i, batch)
+				batch = []
+				start = time.perf_counter()
+		if batch:
+			metrics.observe('tsv.read', time.perf_counter() - start)
+			yield (i, batch)
+
+	def sentence_hashes(self, rows, opts={}):
+		"""
+		Look up the sentence CIDs for a batch of rows, adding the sentences
+		that have not been seen before in a single request
+		rows: list of rows from validated.tsv
+		opts: options passed to the IPFS add call
+		Returns a list of sentence CIDs in the same order as rows
+		"""
+		keys = [(row.sentence, row.locale) for row in rows]
+		new_keys = {}
+		for key in keys:
+			if key in self._sentences:
+				self.sentence_hits += 1
+			elif key in new_keys:
+				# Repeated within this batch, only add it once
+				self.sentence_hits += 1
+			else:
+				self.sentence_misses += 1
+				new_keys[key] = None
+
+		sentences = []
+		for (content, locale) in new_keys:
+			sentences.append({
+				'content': content,
+				'language': locale,
+				'copyright': "CC0-1.0"
+			})
+		new_hashes = ipfsbatch.add_json_many(self._client, sentences, opts=opts)
+		self._sentences.update(zip(new_keys, new_hashes))
+
+		return [self._sentences[key] for key in keys]
+
+	def hashify_batch(self, rows, clips_path, opts={}, in_memory=False):
+		"""
+		Import a batch of rows, adding all of the sentences in one request
+		and all of the clips in another
+		rows: list of rows from validated.tsv
+		clips_path: path to the directory containing the clips
+		opts: options passed to the IPFS add calls
+		in_memory: tag the clips in memory instead of rewriting them on disk
+		Returns a list of (sentence CID, clip CID, audio info) in the same order as rows
+		"""
+		sent_hashes = self.sentence_hashes(rows, opts=opts)
+
+		clips = []
+		infos = []
+		for (row, sent_hash) in zip(rows, sent_hashes):
+			clip_path = self.path_join(clips_path, row.path)
+			clip = tagging.tag_clip(clip_path, row.locale, sent_hash, row.client_id, in_memory=in_memory)
+			clips.append(clip)
+			infos.append(tagging.clip_info(clip))
+		clip_res = ipfsbatch.add_many(self._client, clips, opts=opts)
+
+		return [(sent_hash, res['Hash'], info) for (sent_hash, res, info) in zip(sent_hashes, clip_res, infos)]
+
+	def hashify(self, input_path, output_path, dryrun=False, batch_size=1, resume=False, in_memory=False, previous=None, normalise=False):
 		"""
 		Import a Common Voice dump into IPFS
 		input_path: path to a Common Voice dump directory
-		output_path: place to put the generated index in JSON
+		output_path: place to put the generated index, streamed as NDJSON if it ends in .ndjson
+		batch_size: number of rows to send to IPFS in each add request
+		resume: skip the rows recorded in the journal of an interrupted run
+		in_memory: send tagged clips straight to IPFS, leaving the dataset untouched
+		previous: index of an earlier import, only rows that are new or changed since are imported
+		normalise: fold alternative spellings of sentences into one, see normalise.py
 		"""
 
-		clip_index = {}
-
 		print(input_path, '→', output_path, file=sys.stderr)
 
+		earlier = None
+		if previous:
+			if not os.path.exists(manifest_path(previous)):
+				print('No manifest for', previous, '(it was imported before manifests were written)', file=sys.stderr)
+				sys.exit(-1)
+			earlier = PreviousImport(previous)
+			print('Previous import:', len(earlier.records), 'rows', file=sys.stderr)
+
 		validated_path = self.path_join(input_path, 'validated.tsv')
 		clips_path = self.path_join(input_path, 'clips')
 
-		file_length = self.line_count(validated_path)
-
-		with open(validated_path, newline='') as validated_file:
-			opts = {}
-			if dryrun: 
-				opts={'only_hash': True}
-			reader = csv.DictReader(validated_file, delimiter='\t')
-			bar = progressbar.ProgressBar(max_value=file_length).start()
-			for (i, row) in enumerate(reader):
-				sentence = {
-					'content': row['sentence'],
-					'language': row["locale"],
-					'copyright': "CC0-1.0"
-				}
-				sent_hash = self._client.add_json(sentence, opts=opts)
-				clip_path = self.path_join(clips_path, row['path'])
-				audio = EasyID3(clip_path)
-				audio["copyright"] = "CC0-1.0"
-				audio["language"] = row["locale"]
-				audio["album"] = sent_hash
-				audio["author"] = row["client_id"]
-				audio.save()
-				clip_res = self._client.add(clip_path, opts=opts)
-
-				if sent_hash not in clip_index:
-					clip_index[sent_hash] = []
-				clip_index[sent_hash].append(clip_res['Hash'])
-				bar.update(i)
-
-		# Save the transcript → clip hash as a json file
-		with open(output_path, 'w') as output_file:
-			json.dump(clip_index, output_file)
+		reader = TSVReader(validated_path)
+		normaliser = Normaliser() if normalise else None
+
+		# Rows are journalled as they finish so that an import can be resumed
+		journal = Journal(output_path + '.journal', resume=resume)
+		if journal.done:
+			print('Resuming,', len(journal.done), 'rows already imported', file=sys.stderr)
+
+		clip_index = IndexWriter(output_path)
+		# What each row was imported from, for the next incremental import
+		manifest = Manifest(manifest_path(output_path))
+
+		opts = {}
+		if dryrun: 
+			opts={'only_hash': True}
+		bar = progressbar.ProgressBar(max_value=len(reader)).start()
+		for (i, batch) in self.batches(normaliser.rows(reader) if normaliser else reader, batch_size):
+			stats = [clip_stat(self.path_join(clips_path, row.path)) for row in batch]
+			# row number in batch → (manifest record, index item) of the rows unchanged since the previous import
+			reused = {}
+			if earlier:
+				for (n, (row, stat)) in enumerate(zip(batch, stats)):
+					found = earlier.lookup(row, stat)
+					if found:
+						reused[n] = found
+						# Its sentence need not be added again by other rows
+						self._sentences[(row.sentence, row.locale)] = found[1][0]
+			todo = [n for (n, row) in enumerate(batch) if n not in reused and row.path not in journal.done]
+			with metrics.timer('batch'):
+				new_hashes = self.hashify_batch([batch[n] for n in todo], clips_path, opts=opts, in_memory=in_memory)
+			with metrics.timer('journal.append'):
+				journal.append((batch[n].path,) + hashes for (n, hashes) in zip(todo, new_hashes))
+
+			items = dict(zip(todo, new_hashes))
+			records = []
+			for (n, row) in enumerate(batch):
+				if n in reused:
+					(record, items[n]) = reused[n]
+					records.append(record)
+					continue
+				if n not in items:
+					items[n] = journal.done[row.path]
+				# Tagging in place rewrites the clip
+				tagged = stats[n] if in_memory else clip_stat(self.path_join(clips_path, row.path))
+				records.append((row.path, stats[n], tagged, row_digest(row)) + tuple(items[n][:2]))
+			with metrics.timer('index.write'):
+				clip_index.extend(items[n] for n in range(len(batch)))
+			manifest.append(records)
+			metrics.count('rows.imported', len(todo))
+			metrics.count('rows.reused', len(reused))
+			metrics.count('rows.resumed', len(batch) - len(todo) - len(reused))
+			bar.update(i)
+
+		# Save the transcript → clip hash index, streamed lines are already written
+		clip_index.close()
+		manifest.close()
+		journal.close(remove=True)
+		reader.close()
+		if normaliser:
+			# variant → canonical sentence, for the record
+			normaliser.save(output_path + '.variants')
+
+		metrics.count('sentence_cache.hits', self.sentence_hits)
+		metrics.count('sentence_cache.misses', self.sentence_misses)
+		print('', file=sys.stderr)
+		print('Sentences:', len(self._sentences), 'unique |', self.sentence_hits, 'hits |',
+				self.sentence_misses, 'misses', file=sys.stderr)
 
 	def close(self):
 		"""Close the TCP connection to IPFS"""
 		self._client.close()
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(usage='importer.py [--batch-size N] [--resume] [--in-memory] [--previous index.json] [--normalise] [--metrics report.json] [--prometheus metrics.prom] dataset_dir index_path')
+	parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1,
+			help='number of rows to add to IPFS per request (default: 1)')
+	parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+			help='continue an interrupted import from index_path.journal')
+	parser.add_argument('-m', '--in-memory', dest='in_memory', action='store_true',
+			help='tag clips in memory instead of rewriting the files in dataset_dir')
+	parser.add_argument('-p', '--previous', dest='previous', default=None,
+			help='index of an earlier import, only import the rows that are new or changed since')
+	parser.add_argument('--normalise', dest='normalise', action='store_true',
+			help='fold alternative spellings of sentences (e.g. apostrophes) into one, listing them in index_path.variants')
+	metrics.add_arguments(parser)
+	parser.add_argument('dataset_dir')
+	parser.add_argument('index_path')
+	args = parser.parse_args()
+	metrics.start('importer', args.metrics, args.prometheus, args.prometheus_interval)
 	imp = Importer()
-	if len(sys.argv) != 3:
-		print('importer.py dataset_dir index_path')
-		sys.exit(-1)
-	dataset_dir = sys.argv[1]
-	index_path = sys.argv[2]
-	imp.hashify(dataset_dir, index_path, dryrun=False)
+	imp.hashify(args.dataset_dir, args.index_path, dryrun=False, batch_size=max(1, args.batch_size),
+			resume=args.resume, in_memory=args.in_memory, previous=args.previous,
+			normalise=args.normalise)
 	imp.close()
+	metrics.finish()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Import a Common Voice dump into IPFS generating an index of CIDs using asyncio."""
+import aiohttp
+import argparse
+import asyncio
+import json
+import progressbar
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import ipfsbatch
+import tagging
+from clipindex import IndexWriter
+from journal import Journal
+from metrics import metrics
+from normalise import Normaliser
+from tsvreader import TSVReader
+
+DEFAULT_API = 'http://localhost:5001'
+
+class Importer:
+	"""
+	Talks to the IPFS HTTP API over a single aiohttp session with a bounded
+	number of requests in flight, ID3 tagging runs in a small thread pool.
+	"""
+
+	def __init__(self, api=DEFAULT_API, max_requests=16, tag_threads=4):
+		"""
+		api: base URL of the IPFS HTTP API
+		max_requests: maximum number of requests in flight to the daemon
+		tag_threads: number of threads used for ID3 tagging
+		"""
+		self.api = api.rstrip('/') + '/api/v0'
+		self.max_requests = max_requests
+		self._tagger = ThreadPoolExecutor(max_workers=tag_threads)
+		self._session = None
+
+		# (content, locale) → sentence CID, plus the adds in flight
+		self._sentences = {}
+		self._pending = {}
+		self.sentence_hits = 0
+		self.sentence_misses = 0
+
+	def path_join(self, *args, sep='/'):
+		"""
+		Join a sequence of arguments on a given delimiter
+		*args: any number of strings
+		sep: directory separator
+		"""
+		return sep.join(args)
+
+	async def connect(self):
+		"""Open the HTTP session and check that the daemon answers"""
+		connector = aiohttp.TCPConnector(limit=self.max_requests)
+		timeout = aiohttp.ClientTimeout(total=None)
+		self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+		try:
+			async with self._session.post(self.api + '/version') as resp:
+				resp.raise_for_status()
+		except aiohttp.ClientError:
+			await self._session.close()
+			print('Could not connect to IPFS node', file=sys.stderr)
+			sys.exit(-1)
+
+	async def add(self, files, opts={}):
+		"""
+		Add files to IPFS in one /api/v0/add request
+		files: list of (name, bytes), names must be unique
+		opts: query parameters for the add call, e.g. {'only-hash': 'true'}
+		Returns the list of CIDs in the same order as files
+		"""
+		if not files:
+			return []
+		form = aiohttp.FormData()
+		for (name, data) in files:
+			form.add_field('file', data, filename=name, content_type='application/octet-stream')
+		with metrics.timer('ipfs.add'):
+			async with self._session.post(self.api + '/add', params=opts, data=form) as resp:
+				resp.raise_for_status()
+				body = await resp.text()
+		by_name = {}
+		for line in body.splitlines():
+			if line.strip():
+				entry = json.loads(line)
+				by_name[entry['Name']] = entry['Hash']
+		return [by_name[name] for (name, _) in files]
+
+	async def sentence_hashes(self, rows, opts={}):
+		"""
+		Look up the sentence CIDs for a batch of rows, adding the sentences
+		that have not been seen before in a single request
+		rows: list of rows from validated.tsv
+		opts: query parameters for the add call
+		Returns a list of sentence CIDs in the same order as rows
+		"""
+		keys = [(row.sentence, row.locale) for row in rows]
+		new_keys = {}
+		waiting = []
+		for key in keys:
+			if key in self._sentences or key in new_keys:
+				self.sentence_hits += 1
+			elif key in self._pending:
+				# Being added by another batch, wait for it rather than adding it twice
+				self.sentence_hits += 1
+				waiting.append(self._pending[key])
+			else:
+				self.sentence_misses += 1
+				new_keys[key] = None
+
+		if new_keys:
+			done = asyncio.get_running_loop().create_future()
+			for key in new_keys:
+				self._pending[key] = done
+			try:
+				files = []
+				for (i, (content, locale)) in enumerate(new_keys):
+					sentence = {
+						'content': content,
+						'language': locale,
+						'copyright': "CC0-1.0"
+					}
+					files.append((str(i) + '.json', ipfsbatch.encode_json(sentence)))
+				self._sentences.update(zip(new_keys, await self.add(files, opts=opts)))
+				done.set_result(None)
+			except BaseException as e:
+				done.set_exception(e)
+				# Mark it retrieved, it is raised here and maybe no other batch waits on it
+				done.exception()
+				raise
+			finally:
+				for key in new_keys:
+					del self._pending[key]
+		if waiting:
+			await asyncio.gather(*waiting)
+
+		return [self._sentences[key] for key in keys]
+
+	def tag_clip(self, clip_path, row, sent_hash, in_memory=False):
+		"""
+		Tag a clip and return its contents and audio info, runs in the tagging pool
+		clip_path: path to the mp3 file
+		row: the row of validated.tsv for the clip
+		sent_hash: CID of the sentence object
+		in_memory: tag the clip in memory instead of rewriting it on disk
+		"""
+		clip = tagging.tag_clip(clip_path, row.locale, sent_hash, row.client_id, in_memory=in_memory)
+		info = tagging.clip_info(clip)
+		if in_memory:
+			return (clip.getvalue(), info)
+		with open(clip_path, 'rb') as clip_file:
+			return (clip_file.read(), info)
+
+	async def hashify_batch(self, rows, clips_path, opts={}, in_memory=False):
+		"""
+		Import a batch of rows with one add request for the sentences and one for the clips
+		rows: list of rows from validated.tsv
+		clips_path: path to the directory containing the clips
+		opts: query parameters for the add calls
+		in_memory: tag the clips in memory instead of rewriting them on disk
+		Returns a list of (sentence CID, clip CID, audio info) in the same order as rows
+		"""
+		loop = asyncio.get_running_loop()
+		sent_hashes = await self.sentence_hashes(rows, opts=opts)
+		clips = await asyncio.gather(*[
+			loop.run_in_executor(self._tagger, self.tag_clip, self.path_join(clips_path, row.path), row, sent_hash, in_memory)
+			for (row, sent_hash) in zip(rows, sent_hashes)
+		])
+		clip_hashes = await self.add([(row.path, data) for (row, (data, _)) in zip(rows, clips)], opts=opts)
+		return [(sent_hash, clip_hash, info) for (sent_hash, clip_hash, (_, info)) in zip(sent_hashes, clip_hashes, clips)]
+
+	async def hashify(self, input_path, output_path, dryrun=False, batch_size=1, resume=False, in_memory=False, normalise=False):
+		"""
+		Import a Common Voice dump into IPFS
+		input_path: path to a Common Voice dump directory
+		output_path: place to put the generated index, streamed as NDJSON if it ends in .ndjson
+		batch_size: number of rows to send to IPFS in each add request
+		resume: skip the rows recorded in the journal of an interrupted run
+		in_memory: send tagged clips straight to IPFS, leaving the dataset untouched
+		normalise: fold alternative spellings of sentences into one, see normalise.py
+		"""
+		print(input_path, '→', output_path, file=sys.stderr)
+
+		validated_path = self.path_join(input_path, 'validated.tsv')
+		clips_path = self.path_join(input_path, 'clips')
+
+		reader = TSVReader(validated_path)
+		normaliser = Normaliser() if normalise else None
+
+		journal = Journal(output_path + '.journal', resume=resume)
+		if journal.done:
+			print('Resuming,', len(journal.done), 'rows already imported', file=sys.stderr)
+
+		opts = {}
+		if dryrun:
+			opts = {'only-hash': 'true'}
+
+		# Finished batches by batch number, written out in order as soon as
+		# all of the batches before them are done
+		results = {}
+		written = 0
+		clip_index = IndexWriter(output_path)
+		queue = asyncio.Queue(maxsize=2*self.max_requests)
+		bar = progressbar.ProgressBar(max_value=len(reader)).start()
+		imported = 0
+		# rows taken from the journal of an earlier run
+		resumed = 0
+
+		failures = []
+
+		async def worker():
+			nonlocal imported, resumed, written
+			while True:
+				item = await queue.get()
+				if item is None:
+					return
+				if failures:
+					# Keep draining the queue so that the reader is not blocked
+					continue
+				(n, batch) = item
+				try:
+					todo = [row for row in batch if row.path not in journal.done]
+					new_hashes = await self.hashify_batch(todo, clips_path, opts=opts, in_memory=in_memory)
+				except Exception as e:
+					failures.append(e)
+					continue
+				journal.append((row.path,) + hashes for (row, hashes) in zip(todo, new_hashes))
+				new_hashes = iter(new_hashes)
+				results[n] = [journal.done[row.path] if row.path in journal.done else next(new_hashes) for row in batch]
+				while written in results:
+					clip_index.extend(results.pop(written))
+					written += 1
+				imported += len(todo)
+				resumed += len(batch) - len(todo)
+				bar.update(imported + resumed)
+
+		workers = [asyncio.create_task(worker()) for _ in range(self.max_requests)]
+		batch = []
+		n = 0
+		for row in normaliser.rows(reader) if normaliser else reader:
+			batch.append(row)
+			if len(batch) == batch_size:
+				await queue.put((n, batch))
+				n += 1
+				batch = []
+		if batch:
+			await queue.put((n, batch))
+			n += 1
+		for _ in workers:
+			await queue.put(None)
+		await asyncio.gather(*workers)
+		reader.close()
+		if failures:
+			# The journal is kept, so the import can be resumed
+			journal.close()
+			bar.finish()
+			raise failures[0]
+		bar.finish()
+
+		# Save the transcript → clip hash index, streamed lines are already written
+		clip_index.close()
+		journal.close(remove=True)
+		if normaliser:
+			# variant → canonical sentence, for the record
+			normaliser.save(output_path + '.variants')
+
+		metrics.count('rows.imported', imported)
+		metrics.count('rows.resumed', resumed)
+		metrics.count('sentence_cache.hits', self.sentence_hits)
+		metrics.count('sentence_cache.misses', self.sentence_misses)
+		print('', file=sys.stderr)
+		print('Sentences:', len(self._sentences), 'unique |', self.sentence_hits, 'hits |',
+				self.sentence_misses, 'misses', file=sys.stderr)
+
+	async def close(self):
+		"""Close the HTTP session and the tagging pool"""
+		await self._session.close()
+		self._tagger.shutdown()
+
+async def main(args):
+	imp = Importer(api=args.api, max_requests=max(1, args.max_requests), tag_threads=max(1, args.tag_threads))
+	await imp.connect()
+	try:
+		await imp.hashify(args.dataset_dir, args.index_path, dryrun=False,
+				batch_size=max(1, args.batch_size), resume=args.resume, in_memory=args.in_memory,
+				normalise=args.normalise)
+	finally:
+		await imp.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(usage='importer_async.py [--max-requests N] [--tag-threads N] [--batch-size N] [--resume] [--in-memory] [--normalise] [--metrics report.json] [--prometheus metrics.prom] dataset_dir index_path')
+	parser.add_argument('-a', '--api', dest='api', default=DEFAULT_API,
+			help='base URL of the IPFS HTTP API (default: ' + DEFAULT_API + ')')
+	parser.add_argument('-n', '--max-requests', dest='max_requests', type=int, default=16,
+			help='maximum number of requests in flight to the daemon (default: 16)')
+	parser.add_argument('-t', '--tag-threads', dest='tag_threads', type=int, default=4,
+			help='number of threads for ID3 tagging (default: 4)')
+	parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1,
+			help='number of rows to add to IPFS per request (default: 1)')
+	parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+			help='continue an interrupted import from index_path.journal')
+	parser.add_argument('-m', '--in-memory', dest='in_memory', action='store_true',
+			help='tag clips in memory instead of rewriting the files in dataset_dir')
+	parser.add_argument('--normalise', dest='normalise', action='store_true',
+			help='fold alternative spellings of sentences (e.g. apostrophes) into one, listing them in index_path.variants')
+	metrics.add_arguments(parser)
+	parser.add_argument('dataset_dir')
+	parser.add_argument('index_path')
+	args = parser.parse_args()
+	metrics.start('importer_async', args.metrics, args.prometheus, args.prometheus_interval)
+	asyncio.run(main(args))
+	metrics.finish()
@@ -1,47 +1,124 @@
 #!/usr/bin/env python3
 """Import a Common Voice dump into IPFS generating an index of CIDs using multiprocessing."""
-import csv
+import argparse
 import hashlib
 import ipfshttpclient
-from itertools import (takewhile,repeat)
-import json
 import progressbar
 import re
 import sys
 import os
 
 from mutagen.mp3 import MP3
-from mutagen.easyid3 import EasyID3
 
 # MULTIPROCESSING
-from typing import Iterable, TypedDict
 from datetime import datetime, timedelta
-from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import time
+import multiprocessing.util
 import psutil
 
-class CommonVoiceRec(TypedDict):
-  client_id: str
-  path: str
-  sentence: str
-  up_votes: int
-  down_votes:	int
-  age: str
-  gender: str
-  accents: str
-  variant: str
-  locale: str
-  segment: str
+import ipfsbatch
+import tagging
+from clipindex import IndexWriter
+from journal import Journal
+from metrics import metrics
+from normalise import Normaliser, fold
+from tsvreader import TSVReader
+
+# Sentence CIDs keyed on (content, locale), seeded by the parent process
+# before the pool starts so that no two workers add the same sentence
+_sentence_cids: dict = {}
+# Set up once in each worker process by init_worker
+_client = None
+_reader = None
+_clips_path: str = ''
+_opts: dict = {}
+_batch_size: int = 1
+_in_memory: bool = False
+_normalise: bool = False
+
+def init_worker(sentence_cids: dict, validated_path: str, clips_path: str, opts: dict, batch_size: int, in_memory: bool, normalise: bool):
+  """
+  Pool initializer, receives the pre-seeded sentence CID cache and the import settings,
+  maps validated.tsv and opens the connection the worker keeps for its whole life
+  """
+  global _sentence_cids, _client, _reader, _clips_path, _opts, _batch_size, _in_memory, _normalise
+  _sentence_cids = sentence_cids
+  # Chunks come as byte spans of the file, so the worker need not index it
+  _reader = TSVReader(validated_path, index=False)
+  _clips_path = clips_path
+  _opts = opts
+  _batch_size = batch_size
+  _in_memory = in_memory
+  _normalise = normalise
+  # Only send back what the worker recorded, a forked worker starts with a copy of the parent's
+  metrics.reset()
+  _client = metrics.instrument(ipfshttpclient.connect(session=True))
+  # Workers leave through multiprocessing, which skips atexit but runs its own finalizers
+  multiprocessing.util.Finalize(None, _client.close, exitpriority=10)
+
+def hashify_process(first: int, end: int, skip: frozenset):
+  """
+  Tag and add the clips of a chunk of records
+  first, end: byte span of the chunk in validated.tsv
+  skip: clip paths of records of the chunk that are already imported
+  Returns (items, misses, seconds, metrics) where items is a list of
+  (sentence CID, clip CID, (length, bitrate, size)) in file order
+  """
+  start: float = time.monotonic()
+  with metrics.timer('tsv.read'):
+    recs = [rec for rec in _reader.rows_between(first, end) if rec.path not in skip]
+  if _normalise:
+    # the parent recorded the variants when it seeded the sentences
+    recs = [rec._replace(sentence=fold(rec.sentence, rec.locale)) for rec in recs]
+
+  # accumulate results here
+  results = []
+  misses: int = 0
+  # Iterate through the records in batches, each batch takes one add request
+  # for its sentences and one for its clips
+  for offset in range(0, len(recs), _batch_size):
+    batch = recs[offset:offset + _batch_size]
+    keys = [(rec.sentence, rec.locale) for rec in batch]
+    # Sentences are normally all seeded by the parent, only add stragglers
+    new_keys = list(dict.fromkeys(key for key in keys if key not in _sentence_cids))
+    if new_keys:
+      misses += len(new_keys)
+      sentences = [{
+        'content': content,
+        'language': locale,
+        'copyright': 'CC0-1.0'
+      } for content, locale in new_keys]
+      _sentence_cids.update(zip(new_keys, ipfsbatch.add_json_many(_client, sentences, opts=_opts)))
+    sent_hashes = [_sentence_cids[key] for key in keys]
+    clips = []
+    infos = []
+    for rec, sent_hash in zip(batch, sent_hashes):
+      clip = tagging.tag_clip(os.path.join(_clips_path, rec.path), rec.locale, sent_hash, rec.client_id, in_memory=_in_memory)
+      clips.append(clip)
+      info = tagging.clip_info(clip)   # length, bitrate & size, so the indexer needs no download
+      infos.append((info['length'], info['bitrate'], info['size']))
+    clip_res = ipfsbatch.add_many(_client, clips, opts=_opts)
+    for sent_hash, res, info in zip(sent_hashes, clip_res, infos):
+      # Only the CIDs go back to the parent, not the whole add response
+      results.append((sent_hash, res['Hash'], info))
+
+  snapshot = metrics.snapshot()
+  metrics.reset()
+  return results, misses, time.monotonic() - start, snapshot
 
 
 class Importer:
   """Imports CommonVoice(like) formatted validated.tsv files, processes them with audio files, sets ID3 tags into audio files, outputs a file containing IPFS CID's for sentences and recordings."""
   __clips_path: str = ''
   __opts: object = {}
+  __batch_size: int = 1
+  __in_memory: bool = False
 
   def __init__(self):
     """Set up a connection to the local IPFS node - keeping this for initial connection check and warning"""
     try:
-      self._client = ipfshttpclient.connect(session=True)
+      self._client = metrics.instrument(ipfshttpclient.connect(session=True))
     except:
       print('Could not connect to IPFS node', file=sys.stderr)
       sys.exit(-1)
@@ -83,81 +160,82 @@ class Importer:
     num_chunks = int(rec_cnt/chunk_size) + (1 if (rec_cnt % chunk_size > 0) else 0)
     return num_procs, chunk_size, num_chunks
 
-  def chunk_reader(self, dict_reader: csv.DictReader, chunk_size: int = 1000) -> Iterable[CommonVoiceRec]:
+  def path_join(self, *args, sep=os.sep):
+    """
+    Join a sequence of arguments on a given delimiter
+    *args: any number of strings
+    sep: directory separator
+    """
+    return sep.join(args)
+
+  def tune_chunk_size(self, sec_per_rec: float, remaining: int, num_procs: int) -> int:
     """
-    Generator function to read from a csv.DictReader in chunks of lines (records)
+    Decide on the size of the next chunk from the measured processing time
 
     Arguments:
-      dict_reader: csv.DictReader object
-      chunk_size: Number of records to yield (default=1000)
+      sec_per_rec: float - moving average of worker seconds per record
+      remaining: int - number of records not yet handed out
+      num_procs: int - size of the pool
 
     Returns:
-      list[CommonVoiceRec]
+      int - number of records for the next chunk
     """
-    chunk: list[CommonVoiceRec] = list()
-    for i, dict_obj in enumerate(dict_reader):
-      rec: CommonVoiceRec = dict_obj
-      chunk.append(rec)
-      if len(chunk) == chunk_size:
-        yield chunk
-        chunk = []
-    # yield remaining (last portion of file)
-    yield chunk
-
-  def line_count(self, input_path):
+    # Aim for chunks that take a worker TARGET_CHUNK_SECS, long enough to keep
+    # the IPC and scheduling overhead low, short enough to journal progress
+    # often. Near the end, shrink chunks so that all processes finish together.
+    TARGET_CHUNK_SECS: float = 10.0
+    MIN_CHUNK: int = 50     # lower numbers will cause data transfer costs
+    MAX_CHUNK: int = 5000   # larger numbers will cause higher memory usage
+    chunk_size = int(TARGET_CHUNK_SECS / sec_per_rec) if sec_per_rec > 0 else MAX_CHUNK
+    chunk_size = min(chunk_size, -(-remaining // num_procs))
+    return max(MIN_CHUNK, min(MAX_CHUNK, chunk_size))
+
+  def seed_sentences(self, reader: TSVReader, batch_size: int = 1000, skip: dict = {}, normaliser: Normaliser = None) -> dict:
     """
-    Efficiently count the number of lines in a file
-    input_path: path to count the number of lines in
-    """
-    f = open(input_path, 'rb')
-    bufgen = takewhile(lambda x: x, (f.raw.read(1024*1024) for _ in repeat(None)))
-    res = sum( buf.count(b'\n') for buf in bufgen )
-    f.close()
-    return res
+    Add every distinct sentence in validated.tsv to IPFS before the workers start
 
-  def path_join(self, *args, sep=os.sep):
-    """
-    Join a sequence of arguments on a given delimiter
-    *args: any number of strings
-    sep: directory separator
-    """
-    return sep.join(args)
+    Arguments:
+      reader: validated.tsv
+      batch_size: number of sentences to add per request (default=1000)
+      skip: clip paths of records that are already imported
+      normaliser: folds alternative spellings of the sentences, if given
 
-  def hashify_process(self, lst: list):
-    # Each process has its own resource pools
-    client = ipfshttpclient.connect(session=True)
-
-    # accumulate results here
-    results = []
-    # Iterate through all records
-    for row in lst:
-      # print(row) # DEBUG
-      sentence = {
-        'content': row['sentence'],
-        'language': row['locale'],
+    Returns:
+      dict mapping (content, locale) to the CID of the sentence object
+    """
+    keys: dict = {}
+    for rec in reader:
+      # Every row goes through the normaliser, so that the variants list also
+      # has those of the rows imported before a resume
+      sentence = normaliser.sentence(rec.sentence, rec.locale) if normaliser else rec.sentence
+      if rec.path not in skip:
+        keys[(sentence, rec.locale)] = None
+
+    sentence_cids: dict = {}
+    keys = list(keys)
+    for start in range(0, len(keys), batch_size):
+      batch = keys[start:start + batch_size]
+      sentences = [{
+        'content': content,
+        'language': locale,
         'copyright': 'CC0-1.0'
-      }
-      sent_hash = client.add_json(sentence, opts=self.__opts)
-      clip_path = self.path_join(self.__clips_path, row['path'])
-      audio = EasyID3(clip_path)
-      audio['copyright'] = 'CC0-1.0'
-      audio['language'] = row['locale']
-      audio['album'] = sent_hash
-      audio['author'] = row['client_id']
-      audio.save()
-      clip_res = client.add(clip_path, opts=self.__opts)
-      results.append([sent_hash, clip_res])   # return list (length=input) of list (length=2)
-    
-    client.close()
-    return results
-
-  def hashify(self, input_path, output_path, dryrun=False):
+      } for content, locale in batch]
+      sentence_cids.update(zip(batch, ipfsbatch.add_json_many(self._client, sentences, opts=self.__opts)))
+    return sentence_cids
+
+  def hashify(self, input_path, output_path, dryrun=False, batch_size=1, resume=False, in_memory=False, normalise=False):
     """
     Import a Common Voice dump into IPFS
     input_path: path to a Common Voice dump directory
-    output_path: place to put the generated index in JSON
+    output_path: place to put the generated index, streamed as NDJSON if it ends in .ndjson
+    batch_size: number of records to send to IPFS in each add request
+    resume: skip the records in the journal of an interrupted run
+    in_memory: send tagged clips straight to IPFS, leaving the dataset untouched
+    normalise: fold alternative spellings of sentences into one, see normalise.py
     """
     start_time: datetime = datetime.now()
+    self.__batch_size = max(1, batch_size)
+    self.__in_memory = in_memory
 
     # Handle paths
     validated_path = self.path_join(input_path, 'validated.tsv')
@@ -173,63 +251,46 @@ class Importer:
       os.makedirs(dest_dir, exist_ok=True)
 
     # Size calculations
-    rec_cnt = self.line_count(validated_path) - 1
+    with metrics.timer('tsv.read'):
+      reader: TSVReader = TSVReader(validated_path)
+    rec_cnt = len(reader)
     num_procs, chunk_size, num_chunks = self.scheduler(rec_cnt)
 
     print(f'=== Importer processing {rec_cnt} recs.', input_path, '→', output_path, file=sys.stderr)
-    print(f'=== Processes: {num_procs} - Chunk size: {chunk_size} recs/proc - Total chunks: {num_chunks}')
+    print(f'=== Processes: {num_procs} - Chunk size: {chunk_size} recs/proc - Total chunks: {num_chunks} - Batch size: {self.__batch_size} recs/request')
 
-    # ProgressBar showing chunks (if there are many chunks, else it is not shown)
+    # ProgressBar showing records (if there are many chunks, else it is not shown)
     use_bar: bool = (num_chunks > num_procs) # if it finishes in one turn it is not logical to show the progress var
     if use_bar:
       update_interval: int = 2 if chunk_size < 100 else 5
       samples_seconds: int = 10 if num_chunks < 10 else 60 if num_chunks < 100 else 180
       bar = progressbar.ProgressBar(
-        prefix='Chunks: ',
-        max_value=num_chunks,
+        prefix='Recs: ',
+        max_value=rec_cnt,
         poll_interval=update_interval,
         min_poll_interval=update_interval,
         widget_kwargs={'samples': timedelta(seconds=samples_seconds)}
       )
       bar.start()
 
+    if dryrun:
+      self.__opts={'only_hash': True}
+
+    # Finished chunks are journalled so that an import can be resumed
+    journal = Journal(output_path + '.journal', resume=resume)
+    if journal.done:
+      print(f'=== Resuming: {len(journal.done)} recs already imported')
+
     #
-    # Actual processing through processes
+    # Add each distinct sentence once, the workers look them up
     #
-    chunk: list[CommonVoiceRec] = []
-
-    with open(validated_path, newline='') as validated_file:
-      if dryrun: 
-        self.__opts={'only_hash': True}
-
-      reader = csv.DictReader(validated_file, delimiter='\t', strict=True, quotechar=None, quoting=csv.QUOTE_NONE)
-      future_list: list[Future] = []
-      cnt_chunks: int = 0
-
-      with ProcessPoolExecutor( max_workers=num_procs) as e:
-        while (cnt_chunks < num_chunks):
-          # handle finished (TODO - needs rework - callbacks?)
-          cnt_running: int = 0
-          for future in future_list:
-            if future.running():
-              cnt_running += 1
-          if use_bar:
-            bar.update(cnt_chunks - cnt_running)
-          if cnt_running < num_procs:
-            # generate new chunks
-            chunk = next(self.chunk_reader(dict_reader=reader, chunk_size=chunk_size))
-            # print("CHUNK LEN=",len(chunk),chunk[0]['path'], " - ", chunk[-1]['path']) # DEBUG
-            future_list.append(e.submit(self.hashify_process, chunk))
-            cnt_chunks += 1
-          if cnt_chunks == num_chunks and cnt_running == 0:
-            # shutdown executor after all processes finished (no running futures & all chunks started)
-            e.shutdown()
-
-    if use_bar:
-      bar.finish()
+    with metrics.timer('sentences.seed'):
+      normaliser: Normaliser = Normaliser() if normalise else None
+      sentence_cids: dict = self.seed_sentences(reader, skip=journal.done, normaliser=normaliser)
+    print(f'=== Sentences: {len(sentence_cids)} unique')
 
     #
-    # combine results
+    # Actual processing through processes
     #
     # One sentence item is composed of CID of a sentence and a list of CID's of audio recordings in this format:
     # {CID_OF_SENTENCE: [
@@ -238,26 +299,112 @@ class Importer:
     #    ...
     #   ]
     # }
-    sentence_index: dict = {}
+    # Chunks are merged into the index in file order as soon as they and all chunks before them are done.
+    sentence_index: IndexWriter = IndexWriter(output_path)
     cnt_results: int = 0
-    # result_lengths: list[int] = [] # DEBUG
-    for future in future_list:
-      results = future.result()
-      cnt_results += len(results)
-      # result_lengths.append(len(results)) # DEBUG
-      for item in results:
-        # The result item is in format [CID_OF_SENTENCE, CID_OF_RECORDING]
-        if item[0] not in sentence_index:                   # if the sentence is not added yet
-          sentence_index[item[0]] = []                      # add it with 
-        sentence_index[item[0]].append(item[1]['Hash'])     # add the recordings CID to sentence
-
-    # Save the transcript → clip hash as a json file
-    with open(output_path, 'w') as output_file:
-      json.dump(sentence_index, output_file)
+    # records taken from the journal of an earlier run rather than sent to a worker
+    cnt_resumed: int = 0
+    cnt_misses: int = len(sentence_cids)
+    cnt_chunks: int = 0
+    cnt_read: int = 0
+    sec_per_rec: float = 0.0
+    # Keep the pool busy while the parent reads and merges
+    max_in_flight: int = 2 * num_procs
+
+    # running future → (chunk number, plan, row range of the chunk)
+    # a plan holds, per record of the chunk, its journalled result or None if it was sent to a worker,
+    # it is None itself when nothing was journalled
+    in_flight: dict = {}
+    # finished chunk number → list of (CID_OF_SENTENCE, CID_OF_RECORDING, AUDIO_INFO)
+    finished: dict = {}
+    next_merge: int = 0
+    exhausted: bool = False
+
+    worker_args = (sentence_cids, validated_path, self.__clips_path, self.__opts, self.__batch_size, self.__in_memory, normalise)
+    with ProcessPoolExecutor(max_workers=num_procs, initializer=init_worker, initargs=worker_args) as e:
+      while True:
+        # top up the pool with new chunks
+        while not exhausted and len(in_flight) < max_in_flight:
+          if cnt_read >= rec_cnt:
+            exhausted = True
+            break
+          rows = (cnt_read, min(cnt_read + chunk_size, rec_cnt))
+          cnt_read = rows[1]
+          plan = None
+          skip: frozenset = frozenset()
+          if journal.done:
+            with metrics.timer('tsv.read'):
+              paths = reader.column('path', *rows)
+            plan = [journal.done.get(path) for path in paths]
+            skip = frozenset(path for path in paths if path in journal.done)
+            cnt_resumed += len(skip)
+          if plan is None or None in plan:
+            # workers only get where the chunk is in the file
+            in_flight[e.submit(hashify_process, *reader.span(*rows), skip)] = (cnt_chunks, plan, rows)
+          else:
+            finished[cnt_chunks] = plan
+          cnt_chunks += 1
+          if sec_per_rec > 0:
+            chunk_size = self.tune_chunk_size(sec_per_rec, rec_cnt - cnt_read, num_procs)
+
+        # wait for at least one chunk to complete
+        if in_flight:
+          done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+          for future in done:
+            n, plan, rows = in_flight.pop(future)
+            results, misses, seconds, snapshot = future.result()
+            metrics.merge(snapshot)
+            metrics.observe('chunk', seconds)
+            cnt_misses += misses
+            # The result item is in format (CID_OF_SENTENCE, CID_OF_RECORDING, (LENGTH, BITRATE, SIZE))
+            items = [(sent_hash, clip_hash, {'length': length, 'bitrate': bitrate, 'size': size})
+                     for sent_hash, clip_hash, (length, bitrate, size) in results]
+            with metrics.timer('tsv.read'):
+              paths = [path for path in reader.column('path', *rows) if path not in journal.done]
+            with metrics.timer('journal.append'):
+              journal.append((path,) + item for path, item in zip(paths, items))
+            if plan is None:
+              finished[n] = items
+            else:
+              items = iter(items)
+              # records imported by an earlier run are taken from the journal
+              finished[n] = [next(items) if journalled is None else journalled for journalled in plan]
+            rate = seconds / max(1, len(paths))
+            sec_per_rec = rate if sec_per_rec == 0 else 0.7 * sec_per_rec + 0.3 * rate
+
+        # merge the finished chunks that are next in file order
+        while next_merge in finished:
+          items = finished.pop(next_merge)
+          with metrics.timer('index.write'):
+            sentence_index.extend(items)                  # add the recordings CIDs to their sentences
+          cnt_results += len(items)
+          next_merge += 1
+          if use_bar:
+            bar.update(min(cnt_results, rec_cnt))
+
+        if exhausted and not in_flight and not finished:
+          break
+
+    if use_bar:
+      bar.finish()
 
+    # Save the transcript → clip hash index (NDJSON lines are already written)
+    sentence_index.close()
+    journal.close(remove=True)
+    if normaliser:
+      # variant → canonical sentence, for the record
+      normaliser.save(output_path + '.variants')
+    reader.close()
+
+    cnt_imported: int = cnt_results - cnt_resumed
+    metrics.count('rows.imported', cnt_imported)
+    metrics.count('rows.resumed', cnt_resumed)
+    metrics.count('sentence_cache.hits', cnt_imported - cnt_misses)
+    metrics.count('sentence_cache.misses', cnt_misses)
     total_seconds = (datetime.now() - start_time).total_seconds()
     print(f'\n=== Returned items: {cnt_results} - Required: {rec_cnt}', "" if cnt_results == rec_cnt else " (Reason: Unclosed quotes in dataset)")
     print(f'=== PROCESSED {rec_cnt} records in {timedelta(seconds=total_seconds)}')
+    print(f'=== SENTENCE CACHE {cnt_imported - cnt_misses} hits / {cnt_misses} misses')
     print(f'=== SPEED ~{int(1000*total_seconds/rec_cnt)} sec/1000 recs / ~{int(rec_cnt/total_seconds)} recs/sec.')
     # print(result_lengths) # DEBUG
 
@@ -266,11 +413,21 @@ class Importer:
     self._client.close()
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(usage='importer_mp.py [--batch-size N] [--resume] [--in-memory] [--normalise] [--metrics report.json] [--prometheus metrics.prom] dataset_dir index_path')
+  parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1,
+                      help='number of records to add to IPFS per request (default: 1)')
+  parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+                      help='continue an interrupted import from index_path.journal')
+  parser.add_argument('-m', '--in-memory', dest='in_memory', action='store_true',
+                      help='tag clips in memory instead of rewriting the files in dataset_dir')
+  parser.add_argument('--normalise', dest='normalise', action='store_true',
+                      help='fold alternative spellings of sentences (e.g. apostrophes) into one, listing them in index_path.variants')
+  metrics.add_arguments(parser)
+  parser.add_argument('dataset_dir')
+  parser.add_argument('index_path')
+  args = parser.parse_args()
+  metrics.start('importer_mp', args.metrics, args.prometheus, args.prometheus_interval)
   imp = Importer()
-  if len(sys.argv) != 3:
-    print('importer.py dataset_dir index_path')
-    sys.exit(-1)
-  dataset_dir = sys.argv[1]
-  index_path = sys.argv[2]
-  imp.hashify(dataset_dir, index_path, dryrun=False)
+  imp.hashify(args.dataset_dir, args.index_path, dryrun=False, batch_size=args.batch_size, resume=args.resume, in_memory=args.in_memory, normalise=args.normalise)
   imp.close()
+  metrics.finish()
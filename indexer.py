@@ -1,73 +1,353 @@
 #!/usr/bin/env python3
 """Index a Common Voice from IPFS extracting an indexed-list of CIDs."""
 
+import argparse
 import ipfshttpclient
 import io
 import json
+import numpy
+import os
 import progressbar
 import re
 import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 from mutagen.mp3 import MP3
 
 from cvutils.tokeniser import Tokeniser
 from cvutils.tagger import Tagger
 
+import clipindex
+import ipfsbatch
+from bucketing import NUM_BUCKETS, STRATEGIES
+import mp3header
+from metrics import metrics
+from normalise import align, fold
+from cachedir import cache_dir
+from nlpcache import NLPCache, DEFAULT_MAX_ENTRIES
+from sampler import Sampler
+
 TRANSCRIPT_BLACKLIST = ["Hey", "Hei", "Firefox"]
 MAX_TEXT_LENGTH = 100  # in characters
 MAX_AUDIO_LENGTH = 10  # in seconds
 MAX_PER_BUCKET = 1000  # in clips
+ASSIGN_BLOCK = 256  # in clips, bucketed together once the strategy is fitted
+REACH_BLOCK = 4096  # in distinct clip lengths, bucketed together when finding the reach of the buckets
+
+# Tokeniser and tagger of a worker in the NLP process pool
+_tokeniser = None
+_tagger = None
+
+def init_nlp(locale):
+	"""Pool initializer, loads the tokeniser and tagger once per process"""
+	global _tokeniser, _tagger
+	_tokeniser = Tokeniser(locale)
+	_tagger = Tagger(locale)
+
+def analyse(content):
+	"""
+	Tokenise and tag a sentence in the NLP process pool
+	Returns (tokens, tags, seconds tokenising, seconds tagging)
+	"""
+	start = time.perf_counter()
+	tokens = _tokeniser.tokenise(content)
+	tokenised = time.perf_counter()
+	tags = _tagger.tag(tokens)
+	return (tokens, tags, tokenised - start, time.perf_counter() - tokenised)
 
 class Indexer:
 	
-	def __init__(self, locale):
-		"""Set up a connection to the local IPFS node"""
+	def __init__(self, locale, threads=8, procs=None, cache=None, seed=None, bucketing=None, sharded=False, page_size=0, meta_shard_size=0, normalise=False):
+		"""
+		Set up a connection to the local IPFS node
+		locale: language of the dataset
+		threads: number of concurrent requests to IPFS
+		procs: number of processes for tokenising and tagging (default: one per CPU)
+		cache: NLPCache of earlier tokeniser/tagger results, if any
+		seed: seed for a random sample of the clips, None to take them in index order
+		bucketing: strategy from bucketing.py to sort clips into buckets (default: quantiles)
+		sharded: add each bucket as its own object, listed in a root manifest
+		page_size: split the buckets of a sharded index into pages of this many clips, 0 for one page per bucket
+		meta_shard_size: pack the sentence metadata into objects of this many sentences, 0 for one object each
+		normalise: fold alternative spellings of sentences into one before tokenising and tagging them
+		"""
 		try:
-			self._client = ipfshttpclient.connect(session=True)
+			self._client = metrics.instrument(ipfshttpclient.connect(session=True))
 		except:
 			print('Could not connect to IPFS node', file=sys.stderr)
 
 		self.locale = locale
+		self.threads = threads
+		self.procs = procs or os.cpu_count()
+		self.cache = cache
+		self.seed = seed
+		self.bucketing = bucketing or STRATEGIES['quantile']()
+		self.sharded = sharded
+		self.page_size = page_size
+		self.meta_shard_size = meta_shard_size
+		self.normalise = normalise
+		# Each fetch thread has its own connection
+		self._local = threading.local()
+		self._clients = []
+		self._clients_lock = threading.Lock()
 
-	def rebucket(self, b):
-		""" """
-		# [47, 120, 264, 156, 173, 162, 129, 81, 69, 63]
-		# TODO: Rework this, it's pretty terrible
-		# keys are clip lengths, values are buckets in [1..10]
-		m = {0:1, 1:1, 2:1, 3:1, 4:1, 5:2, 6:2, 7:3, 8:3, 9:4, 10:5, 11:6, 12:7, 13:8, 14:9, 15:10}
-		if b in m:
-			return m[b]
-		return 10
-			
-	def index(self, index_path):
-		""" """
-		with open(index_path, 'r') as index_file:
-			clip_index = json.load(index_file)
+	def client(self):
+		"""The IPFS connection of the calling thread"""
+		if not hasattr(self._local, 'client'):
+			self._local.client = metrics.instrument(ipfshttpclient.connect(session=True))
+			with self._clients_lock:
+				self._clients.append(self._local.client)
+		return self._local.client
 
-		tokeniser = Tokeniser(self.locale)
-		tagger = Tagger(self.locale)
+	def reachable(self, length):
+		"""
+		Buckets a clip of known length can land in, whatever its sentence
+		length: duration of the clip in seconds
+		"""
+		chars = numpy.arange(MAX_TEXT_LENGTH + 1)
+		return set(self.bucketing.assign(chars, numpy.full(len(chars), length)).tolist())
 
-		skipped = 0
-		total = 0
-
-		buckets = {i: [] for i in range(1, 11)}
-		seen = {}
-		bar = progressbar.ProgressBar(max_value=MAX_PER_BUCKET*10).start()
-		MAX_CLIPS = MAX_PER_BUCKET*10
-		for sent_cid in clip_index:
-			sent_res = json.loads(self._client.cat(sent_cid))
-			if sent_res["content"] in TRANSCRIPT_BLACKLIST:
-				skipped += 1
-				continue
-
-			num_chars = len(re.sub(r"[^\w ]+", "", sent_res["content"]))
-
-			if num_chars > MAX_TEXT_LENGTH:
-				skipped += 1
-				continue
-
-			tokens = tokeniser.tokenise(sent_res["content"])
-			tags = tagger.tag(tokens)
+	def last_reach(self, positions, lengths):
+		"""
+		Find how far into the scan each bucket can still get clips, from the lengths recorded at import
+		positions: array of the position in the scan of each clip's sentence, as from clipindex.clip_lengths
+		lengths: array of the recorded length of each clip, NaN where not recorded
+		Returns a dict of bucket → position in the scan of the last sentence with a clip
+		that can land in it, buckets that no clip can land in are left out
+		"""
+		last = {}
+		unknown = numpy.isnan(lengths) | (lengths == 0)
+		if unknown.any():
+			# Not recorded, the clip could land anywhere
+			furthest = int(positions[unknown].max())
+			last = {bucket: furthest for bucket in range(1, NUM_BUCKETS + 1)}
+
+		# Clips of the same length reach the same buckets, bucket each length once for every sentence length
+		(distinct, which) = numpy.unique(lengths[~unknown], return_inverse=True)
+		furthest = numpy.full(len(distinct), -1, dtype=numpy.int64)
+		numpy.maximum.at(furthest, which, positions[~unknown])
+		chars = numpy.arange(MAX_TEXT_LENGTH + 1)
+		for start in range(0, len(distinct), REACH_BLOCK):
+			block = distinct[start:start + REACH_BLOCK]
+			grid = self.bucketing.assign(numpy.tile(chars, len(block)), numpy.repeat(block, len(chars))).reshape(len(block), len(chars))
+			for bucket in numpy.unique(grid).tolist():
+				position = int(furthest[start:start + REACH_BLOCK][(grid == bucket).any(axis=1)].max())
+				last[bucket] = max(last.get(bucket, -1), position)
+		return last
+
+	def calibrate(self, index_path):
+		"""
+		Fit the bucketing strategy on the first clips by sentence CID, a random
+		sample of the index rather than whatever comes first in it
+		index_path: path to the clip index
+		Returns a dict of sentence CID → result of fetch, for the scan to use
+		rather than fetching the sentences of the sample again
+		"""
+		fetched = {}
+		# (number of characters, length) of the fetched clips
+		sample = []
+		with ThreadPoolExecutor(max_workers=self.threads) as fetcher:
+			entries = clipindex.iter_index(index_path, order=clipindex.by_cid)
+			window = deque()
+			while len(sample) < self.bucketing.calibration:
+				# Keep the fetch pool busy a few sentences ahead
+				for (sent_cid, clip_cids, clip_info) in entries:
+					content = self.cache.content(sent_cid) if self.cache else None
+					window.append((sent_cid, fetcher.submit(self.fetch, sent_cid, clip_cids, clip_info, content)))
+					if len(window) >= 4 * self.threads:
+						break
+				if not window:
+					break
+				(sent_cid, future) = window.popleft()
+				fetched[sent_cid] = future.result()
+				(_, num_chars, lengths) = fetched[sent_cid]
+				if lengths is not None:
+					sample += [(num_chars, length) for length in lengths]
+			entries.close()
+			for (_, future) in window:
+				future.cancel()
+		# Leaving the pool waited for the fetches that had started, keep those too
+		for (sent_cid, future) in window:
+			if not future.cancelled() and future.exception() is None:
+				fetched[sent_cid] = future.result()
+		self.bucketing.fit([s[0] for s in sample], [s[1] for s in sample])
+		return fetched
+
+	def clip_length(self, clip_cid, info=None):
+		"""
+		Find the duration of a clip in seconds
+		clip_cid: CID of the clip
+		info: audio info recorded by the importer, if any
+		"""
+		if info and info.get('length'):
+			metrics.count('clip_length.recorded')
+			return info['length']
+
+		# Not known from the import, fetch just the start of the clip and read its headers
+		client = self.client()
+		head = client.cat(clip_cid, offset=0, length=mp3header.HEADER_FETCH)
+		size = len(head) if len(head) < mp3header.HEADER_FETCH else None
+		base = mp3header.id3_size(head)
+		if size is None and base + 1024 > len(head):
+			# A large ID3 tag, skip over it
+			head = client.cat(clip_cid, offset=base, length=mp3header.HEADER_FETCH)
+		else:
+			base = 0
+		with metrics.timer('mp3.header'):
+			length = mp3header.duration(head, size, base=base)
+		if length is None and size is None:
+			# Probably CBR, which needs the size of the file
+			size = client.files.stat('/ipfs/' + clip_cid)['Size']
+			with metrics.timer('mp3.header'):
+				length = mp3header.duration(head, size, base=base)
+			if length:
+				metrics.count('clip_length.stat')
+				return length
+		if length:
+			metrics.count('clip_length.header')
+			return length
+
+		# No usable header, fetch the whole clip
+		metrics.count('clip_length.download')
+		clip_fd = io.BytesIO(client.cat(clip_cid))
+		with metrics.timer('mp3.parse'):
+			audio = MP3(clip_fd)
+		return audio.info.length
+
+	def fetch(self, sent_cid, clip_cids, clip_info, content=None, full=frozenset()):
+		"""
+		Fetch a sentence and the lengths of its clips, runs in the fetch pool
+		sent_cid: CID of the sentence
+		clip_cids: CIDs of its clips
+		clip_info: audio info recorded by the importer, by clip CID
+		content: text of the sentence if it is already known
+		full: buckets that were already full, clips of known length that would
+		      land in them are not looked at
+		Returns (sentence, number of characters, clip lengths), with no
+		lengths if the sentence is filtered out and a length of None for
+		clips that were skipped
+		"""
+		if content is None:
+			sentence = json.loads(self.client().cat(sent_cid))
+		else:
+			sentence = {'content': content}
+		if sentence["content"] in TRANSCRIPT_BLACKLIST:
+			return (sentence, 0, None)
+
+		num_chars = len(re.sub(r"[^\w ]+", "", sentence["content"]))
+
+		if num_chars > MAX_TEXT_LENGTH:
+			return (sentence, num_chars, None)
+
+		skip = set()
+		known = [clip_cid for clip_cid in clip_cids if clip_info.get(clip_cid, {}).get('length')]
+		if full and known:
+			known_buckets = self.bucketing.assign(numpy.full(len(known), num_chars),
+					numpy.array([clip_info[clip_cid]['length'] for clip_cid in known]))
+			skip = {clip_cid for (clip_cid, bucket) in zip(known, known_buckets.tolist()) if bucket in full}
+		lengths = [None if clip_cid in skip else self.clip_length(clip_cid, clip_info.get(clip_cid)) for clip_cid in clip_cids]
+		return (sentence, num_chars, lengths)
+
+	def place(self, sampler, pending, selected):
+		"""
+		Bucket fetched clips all at once and offer them to the sampler in order
+		sampler: Sampler holding the buckets
+		pending: list of (sentence CID, content, number of characters, clip CID, length)
+		selected: dict of sentence CID → content to add the sentences of sampled clips to
+		"""
+		chars = numpy.array([num_chars for (_, _, num_chars, _, _) in pending])
+		lengths = numpy.array([length for (_, _, _, _, length) in pending])
+		for ((sent_cid, content, num_chars, clip_cid, length), bucket) in zip(pending, self.bucketing.assign(chars, lengths).tolist()):
+			entry = {
+				'length': length,
+				'chars_sec': num_chars / length,
+				'sentence_cid': sent_cid,
+				'meta_cid': None,  # filled in once the sentence is tagged
+				'clip_cid': clip_cid,
+			}
+			if sampler.offer(bucket, entry):
+				selected[sent_cid] = content
+		pending.clear()
+
+	def describe(self, selected):
+		"""
+		Tokenise and tag sentences and add their metadata objects, reusing
+		earlier results from the cache
+		selected: dict of sentence CID → content
+		Returns a dict of sentence CID → fields pointing index entries at the
+		metadata, {'meta_cid': CID} or {'meta_shard_cid': CID, 'meta_offset': N}
+		if the metadata is packed into shards
+		"""
+		meta_cids = {}
+		# sentence CID → (tokens, tags), of the sentences that need a metadata object
+		analysed = {}
+		# text to tokenise and tag → CIDs of the sentences that take their analysis from it
+		todo = {}
+		if self.normalise:
+			metrics.count('sentences.normalised', sum(fold(content, self.locale) != content for content in selected.values()))
+		for (sent_cid, content) in selected.items():
+			cached = self.cache.get(content) if self.cache else None
+			if cached is None:
+				# Variants of a sentence share the analysis of its folded spelling
+				todo.setdefault(fold(content, self.locale) if self.normalise else content, []).append(sent_cid)
+			elif cached['sentence_cid'] == sent_cid and cached['meta_cid'] and not self.meta_shard_size:
+				meta_cids[sent_cid] = cached['meta_cid']
+			else:
+				analysed[sent_cid] = (cached['tokens'], cached['tags'])
+
+		# text → (tokens, tags)
+		results = {}
+		if self.normalise and self.cache:
+			for (text, sent_cids) in todo.items():
+				if all(selected[sent_cid] != text for sent_cid in sent_cids):
+					# Only variants of it were selected, it may have been analysed before
+					cached = self.cache.get(text)
+					if cached is not None:
+						results[text] = (cached['tokens'], cached['tags'])
+		# folded texts analysed here that are not the content of any sentence, cached for later variants
+		shared = [text for (text, sent_cids) in todo.items()
+				if text not in results and all(selected[sent_cid] != text for sent_cid in sent_cids)]
+
+		if todo:
+			with metrics.timer('nlp.pool'), ProcessPoolExecutor(max_workers=self.procs, initializer=init_nlp, initargs=(self.locale,)) as pool:
+				# Each distinct text is only analysed once
+				texts = [text for text in todo if text not in results]
+				for (text, (tokens, tags, tokenise_seconds, tag_seconds)) in zip(texts, pool.map(analyse, texts, chunksize=16)):
+					metrics.observe('nlp.tokenise', tokenise_seconds)
+					metrics.observe('nlp.tag', tag_seconds)
+					results[text] = (tokens, tags)
+
+				# Give each variant the tokens as it spells them, so that they join
+				# back to its own content
+				unaligned = []
+				for (text, sent_cids) in todo.items():
+					(tokens, tags) = results[text]
+					for sent_cid in sent_cids:
+						content = selected[sent_cid]
+						spelt = tokens if content == text else align(tokens, content, text, self.locale)
+						if spelt is None:
+							unaligned.append(sent_cid)
+						else:
+							analysed[sent_cid] = (spelt, tags)
+				if unaligned:
+					# The tokeniser changed more than the folded characters, analyse the variants on their own
+					metrics.count('sentences.unaligned', len(unaligned))
+					contents = [selected[sent_cid] for sent_cid in unaligned]
+					for (sent_cid, (tokens, tags, tokenise_seconds, tag_seconds)) in zip(unaligned, pool.map(analyse, contents, chunksize=16)):
+						metrics.observe('nlp.tokenise', tokenise_seconds)
+						metrics.observe('nlp.tag', tag_seconds)
+						analysed[sent_cid] = (tokens, tags)
+			if self.cache:
+				for text in shared:
+					(tokens, tags) = results[text]
+					self.cache.put(text, tokens, tags, None, None)
+
+		metas = []
+		for (sent_cid, (tokens, tags)) in analysed.items():
 			meta = {
 				'sentence_cid': sent_cid,
 				'tokens': tokens,
@@ -75,34 +355,202 @@ class Indexer:
 			}
 			# Add perplexity here
 			# Add character frequencies
-			
-			meta_cid = self._client.add_json(meta)
-
-			for clip_cid in clip_index[sent_cid]:
-				clip_fd = io.BytesIO(self._client.cat(clip_cid))
-				audio = MP3(clip_fd)
-				chars_sec = num_chars / audio.info.length
-				bucket = self.rebucket(int((num_chars // audio.info.length)))
-				
-				if len(buckets[bucket]) >= MAX_PER_BUCKET:
+			metas.append(meta)
+
+		if self.meta_shard_size:
+			# Every selected sentence is in analysed, pack them in selection order
+			metas = dict(zip(analysed, metas))
+			sent_cids = list(selected)
+			shards = [sent_cids[i:i + self.meta_shard_size] for i in range(0, len(sent_cids), self.meta_shard_size)]
+			shard_cids = ipfsbatch.add_json_many(self._client, [[metas[sent_cid] for sent_cid in shard] for shard in shards])
+			fields = {}
+			for (shard, shard_cid) in zip(shards, shard_cids):
+				for (offset, sent_cid) in enumerate(shard):
+					fields[sent_cid] = {'meta_shard_cid': shard_cid, 'meta_offset': offset}
+			if self.cache:
+				# There is no metadata object of its own to remember
+				for sent_cids in todo.values():
+					for sent_cid in sent_cids:
+						(tokens, tags) = analysed[sent_cid]
+						self.cache.put(selected[sent_cid], tokens, tags, sent_cid, None)
+			return fields
+
+		with ThreadPoolExecutor(max_workers=self.threads) as adder:
+			added = dict(zip(analysed, adder.map(lambda meta: self.client().add_json(meta), metas)))
+		meta_cids.update(added)
+
+		if self.cache:
+			for (sent_cid, (tokens, tags)) in analysed.items():
+				self.cache.put(selected[sent_cid], tokens, tags, sent_cid, added[sent_cid])
+
+		return {sent_cid: {'meta_cid': meta_cid} for (sent_cid, meta_cid) in meta_cids.items()}
+
+	def add_sharded(self, buckets):
+		"""
+		Add the buckets as separate shards and a root manifest listing them
+		buckets: dict of bucket → list of index entries
+		Returns the CID of the manifest
+		"""
+		shards = []
+		for (bucket, entries) in buckets.items():
+			page_size = self.page_size or max(len(entries), 1)
+			for start in range(0, len(entries), page_size):
+				shards.append((bucket, entries[start:start + page_size]))
+		shard_cids = ipfsbatch.add_json_many(self._client, [entries for (_, entries) in shards])
+
+		manifest = {
+			'version': 1,
+			'total': sum(len(entries) for entries in buckets.values()),
+			'buckets': [],
+		}
+		for (bucket, entries) in buckets.items():
+			manifest['buckets'].append({
+				'bucket': bucket,
+				'count': len(entries),
+				'shards': [
+					{'cid': shard_cid, 'count': len(shard)}
+					for ((shard_bucket, shard), shard_cid) in zip(shards, shard_cids) if shard_bucket == bucket
+				],
+			})
+		return self._client.add_json(manifest)
+
+	def index(self, index_path):
+		"""
+		Pick a subset of the clips, balanced over the difficulty buckets
+
+		Sentences and clip lengths are fetched concurrently but handed to the
+		buckets in index order (or seeded random order), so the result does not
+		depend on timing. Buckets are assigned by the bucketing strategy, fitted
+		first if it needs to be: on the first clips of the scan if it is seeded,
+		and so already random, otherwise on the first clips by sentence CID. Clips that can only
+		land in full buckets are not fetched, and the scan stops once every
+		bucket is full or, going by the lengths recorded at import, out of
+		reach of the rest of the index. Only the
+		sentences that made it into a bucket are then tokenised and tagged, in
+		a process pool, and get a metadata object.
+		"""
+		skipped = 0
+
+		sampler = Sampler(range(1, NUM_BUCKETS + 1), MAX_PER_BUCKET, seed=self.seed)
+		buckets = sampler.buckets
+		# sentence CID → content, of the sentences with clips in a bucket
+		selected = {}
+		# clip length → buckets it can land in
+		reachable = {}
+		# fetched clips waiting to be bucketed, (sentence CID, content, number of characters, clip CID, length)
+		pending = []
+		# sentence CID → result of fetch, of the sentences fetched for the calibration sample
+		fetched = {}
+		if not self.bucketing.fitted and self.seed is None:
+			# The scan is in index order, fit on a sample from across the index
+			with metrics.timer('calibrate'):
+				fetched = self.calibrate(index_path)
+		# Sort the sentences once for both scans of the index
+		with metrics.timer('scan.order'):
+			order = clipindex.scan_order(index_path, sampler.order())
+		# (array of positions in the scan of their sentences, array of recorded lengths) of all clips,
+		# and bucket → position of the last sentence of the scan that can land in it, once the buckets are fitted
+		clips = None
+		last = None
+		if self.bucketing.fitted:
+			clips = clipindex.clip_lengths(index_path, order=order)
+			last = self.last_reach(*clips)
+		# position of the last sentence taken out of the window
+		scanned = -1
+		# position of the last sentence put in the window
+		submitted = -1
+		bar = progressbar.ProgressBar(max_value=MAX_PER_BUCKET*NUM_BUCKETS).start()
+		scan_start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=self.threads) as fetcher:
+			entries = clipindex.iter_index(index_path, order=order)
+			sentences = enumerate(entries)
+			window = deque()
+			while True:
+				if last is not None:
+					# Clips of the sentences that were taken out of the window are
+					# all pending or placed, nothing later can land in these
+					sampler.unfillable(bucket for bucket in buckets if last.get(bucket, -1) <= scanned)
+				if sampler.satisfied():
+					break
+				# Keep the fetch pool busy a few sentences ahead
+				for (position, (sent_cid, clip_cids, clip_info)) in sentences:
+					full = sampler.full_buckets()
+					if last is not None and all(last.get(bucket, -1) < position for bucket in buckets if bucket not in full):
+						# No clip from here on can land in a bucket with room left
+						entries.close()
+						break
+					lengths = [clip_info.get(clip_cid, {}).get('length') for clip_cid in clip_cids]
+					if full and all(lengths):
+						for length in lengths:
+							if length not in reachable:
+								reachable[length] = self.reachable(length)
+						if all(reachable[length] <= full for length in lengths):
+							# Every clip is known to land in a full bucket, don't fetch the sentence
+							sampler.skipped_sentences += 1
+							continue
+					if sent_cid in fetched:
+						# Fetched for the calibration sample already
+						future = Future()
+						future.set_result(fetched.pop(sent_cid))
+					else:
+						content = self.cache.content(sent_cid) if self.cache else None
+						future = fetcher.submit(self.fetch, sent_cid, clip_cids, clip_info, content, full)
+					window.append((position, sent_cid, clip_cids, future))
+					submitted = position
+					if len(window) >= 4 * self.threads:
+						break
+				if not window:
 					break
-					#continue
 
-#				print(bucket, audio.info.length, chars_sec, sent_res)
+				(scanned, sent_cid, clip_cids, future) = window.popleft()
+				with metrics.timer('scan.wait'):
+					(sentence, num_chars, lengths) = future.result()
+				if lengths is None:
+					skipped += 1
+					continue
+
+				for (clip_cid, length) in zip(clip_cids, lengths):
+					if length is None:
+						# Recorded and landing in a full bucket, it was never going to be fetched
+						continue
+					pending.append((sent_cid, sentence["content"], num_chars, clip_cid, length))
+
+				if not self.bucketing.fitted and len(pending) >= self.bucketing.calibration:
+					self.bucketing.fit([p[2] for p in pending], [p[4] for p in pending])
+					clips = clipindex.clip_lengths(index_path, order=order)
+					last = self.last_reach(*clips)
+				if self.bucketing.fitted and len(pending) >= ASSIGN_BLOCK:
+					self.place(sampler, pending, selected)
+					bar.update(sampler.total())
+
+			for (_, _, _, future) in window:
+				future.cancel()
 
-				entry = {
-					'length': audio.info.length,
-					'chars_sec': chars_sec,
-					'sentence_cid': sent_cid,
-					'meta_cid': meta_cid,
-					'clip_cid': clip_cid,
-				}
-				buckets[bucket].append(entry)
-				total += 1
-				bar.update(total)
+		if not self.bucketing.fitted:
+			# Fewer clips than the calibration sample, fit on all of them
+			self.bucketing.fit([p[2] for p in pending], [p[4] for p in pending])
+		if pending:
+			self.place(sampler, pending, selected)
+			bar.update(sampler.total())
 
-			if total >= MAX_CLIPS:
-				break
+		if clips is not None:
+			# Each clip without a recorded length that the scan stopped before would have needed a fetch
+			(positions, lengths) = clips
+			sampler.skipped_clips = int(numpy.count_nonzero((positions > submitted) & (numpy.isnan(lengths) | (lengths == 0))))
+
+		metrics.observe('scan', time.perf_counter() - scan_start)
+		metrics.count('sentences.filtered', skipped)
+		metrics.count('clips.not_fetched', sampler.skipped_clips)
+		metrics.count('sentences.not_fetched', sampler.skipped_sentences)
+		metrics.count('clips.selected', sampler.total())
+
+		with metrics.timer('describe'):
+			meta_fields = self.describe(selected)
+		for bucket in buckets:
+			for entry in buckets[bucket]:
+				if self.meta_shard_size:
+					del entry['meta_cid']
+				entry.update(meta_fields[entry['sentence_cid']])
 
 		print('',file=sys.stderr)
 		index_list = []
@@ -115,22 +563,72 @@ class Indexer:
 				file=sys.stderr,
 			)
 
+		print(' sampler: %d clips not fetched, %d sentences not fetched' % (
+				sampler.skipped_clips, sampler.skipped_sentences), file=sys.stderr)
+
+		if self.cache:
+			self.cache.evict()
+			print(' ' + self.cache.report(), file=sys.stderr)
+			metrics.count('nlp_cache.hits', self.cache.hits)
+			metrics.count('nlp_cache.misses', self.cache.misses)
+
+		if self.sharded:
+			return self.add_sharded(buckets)
+
 		opts = {'only_hash': False}
 		index_hash = self._client.add_json(index_list, opts=opts)
 
 		return index_hash
 			
 	def close(self):
-		"""Close the TCP connection to IPFS"""
+		"""Close the TCP connections to IPFS and save the cache"""
 		self._client.close()
+		for client in self._clients:
+			client.close()
+		if self.cache:
+			self.cache.close()
 
 if __name__ == "__main__":
-	if len(sys.argv) != 3:
-		print('indexer.py locale index_path', file=sys.stderr)
-		sys.exit(-1)
-	ind = Indexer(sys.argv[1])
-	index_path = sys.argv[2]
-	#output_path = sys.argv[2]
-	index = ind.index(index_path)
+	parser = argparse.ArgumentParser(usage='indexer.py [--threads N] [--procs N] [--cache path | --no-cache] [--cache-size N] [--seed N] [--bucketing quantile|fixed] [--calibration N] [--sharded [--page-size N]] [--meta-shard-size N] [--normalise] [--metrics report.json] [--prometheus metrics.prom] locale index_path')
+	parser.add_argument('-t', '--threads', dest='threads', type=int, default=8,
+			help='number of concurrent requests to IPFS (default: 8)')
+	parser.add_argument('-p', '--procs', dest='procs', type=int, default=None,
+			help='number of processes for tokenising and tagging (default: one per CPU)')
+	parser.add_argument('-c', '--cache', dest='cache', default=os.path.join(cache_dir(), 'nlp.sqlite'),
+			help='tokeniser/tagger cache (default: ~/.cache/omnilingo/nlp.sqlite)')
+	parser.add_argument('-C', '--no-cache', dest='no_cache', action='store_true',
+			help='do not read or write the tokeniser/tagger cache')
+	parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_MAX_ENTRIES,
+			help='maximum number of sentences kept in the cache (default: %d)' % DEFAULT_MAX_ENTRIES)
+	parser.add_argument('-s', '--seed', dest='seed', type=int, default=None,
+			help='take a random sample of the clips, the same for the same seed (default: in index order)')
+	parser.add_argument('-B', '--bucketing', dest='bucketing', choices=sorted(STRATEGIES), default='quantile',
+			help='how to sort clips into buckets by characters per second (default: quantile)')
+	parser.add_argument('--calibration', dest='calibration', type=int, default=5000,
+			help='number of clips to fit the quantile buckets on, taken by sentence CID or in the seeded order with --seed (default: 5000)')
+	parser.add_argument('--sharded', dest='sharded', action='store_true',
+			help='add one object per bucket and a root manifest listing them')
+	parser.add_argument('--page-size', dest='page_size', type=int, default=0,
+			help='split the buckets of a sharded index into pages of N clips (default: one page per bucket)')
+	parser.add_argument('--meta-shard-size', dest='meta_shard_size', type=int, default=0,
+			help='pack the metadata of N sentences into each object (default: one object per sentence)')
+	parser.add_argument('--normalise', dest='normalise', action='store_true',
+			help='fold alternative spellings of sentences (e.g. apostrophes) into one before tokenising and tagging')
+	metrics.add_arguments(parser)
+	parser.add_argument('locale')
+	parser.add_argument('index_path')
+	args = parser.parse_args()
+	if args.bucketing == 'quantile' and args.calibration <= 0:
+		parser.error('--calibration must be at least 1 for quantile bucketing')
+	metrics.start('indexer', args.metrics, args.prometheus, args.prometheus_interval)
+	cache = None
+	if not args.no_cache:
+		cache = NLPCache(args.cache, args.locale, max_entries=args.cache_size)
+	ind = Indexer(args.locale, threads=max(1, args.threads), procs=args.procs, cache=cache, seed=args.seed,
+			bucketing=STRATEGIES[args.bucketing](calibration=args.calibration),
+			sharded=args.sharded, page_size=max(0, args.page_size),
+			meta_shard_size=max(0, args.meta_shard_size), normalise=args.normalise)
+	index = ind.index(args.index_path)
 	print("{index}".format(index = index))
 	ind.close()
+	metrics.finish()
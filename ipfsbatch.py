@@ -0,0 +1,74 @@
+"""Add many files or JSON objects to IPFS in a single multipart request."""
+import io
+import json
+import os
+
+
+def encode_json(obj):
+	"""
+	Serialise an object exactly as ipfshttpclient's add_json does, so that
+	objects added in a batch get the same CIDs as ones added one at a time
+	obj: any JSON serialisable object
+	"""
+	return json.dumps(obj, sort_keys=True, indent=None, separators=(',', ':'),
+			ensure_ascii=False).encode('utf-8')
+
+
+def file_name(f):
+	"""
+	Return the name a file is given in the multipart add request
+	f: a path or a file object with a name attribute
+	"""
+	if isinstance(f, (str, bytes, os.PathLike)):
+		return os.path.basename(os.fsdecode(f))
+	return os.path.basename(getattr(f, 'name', ''))
+
+
+def add_many(client, files, opts={}):
+	"""
+	Add a list of files to IPFS with one /api/v0/add request
+	client: an ipfshttpclient client
+	files: paths or file objects, each with a unique (base)name
+	opts: options passed to the add call
+	Returns the add response entries in the same order as files
+	"""
+	if not files:
+		return []
+
+	names = [file_name(f) for f in files]
+	unique = {}
+	for (name, f) in zip(names, files):
+		if name in unique:
+			if unique[name] is f or unique[name] == f:
+				continue
+			raise ValueError('Duplicate file name in batch: ' + name)
+		unique[name] = f
+
+	res = client.add(*unique.values(), opts=opts)
+	if not isinstance(res, list):
+		res = [res]
+
+	# The daemon answers with one entry per top-level file, keyed by name
+	by_name = {os.path.basename(entry['Name']): entry for entry in res}
+	missing = [name for name in unique if name not in by_name]
+	if missing:
+		raise ValueError('IPFS add returned no entry for: ' + ', '.join(missing))
+
+	return [by_name[name] for name in names]
+
+
+def add_json_many(client, objs, opts={}):
+	"""
+	Add a list of JSON objects to IPFS with one /api/v0/add request
+	client: an ipfshttpclient client
+	objs: list of JSON serialisable objects
+	opts: options passed to the add call
+	Returns the list of CIDs in the same order as objs
+	"""
+	files = []
+	for (i, obj) in enumerate(objs):
+		f = io.BytesIO(encode_json(obj))
+		f.name = str(i) + '.json'
+		files.append(f)
+
+	return [entry['Hash'] for entry in add_many(client, files, opts=opts)]
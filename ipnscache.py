@@ -0,0 +1,58 @@
+"""Local cache of what IPNS names last pointed to, for publisher merges."""
+import json
+import os
+import time
+
+from cachedir import cache_dir
+
+DEFAULT_MAX_AGE = 3600  # in seconds
+
+
+def default_path():
+	"""Where the cache is kept by default"""
+	return os.path.join(cache_dir(), 'ipns.json')
+
+
+class IPNSCache:
+	"""
+	JSON file of IPNS name → {"path": /ipfs/CID, "time": when it was resolved
+	or published}
+	"""
+
+	def __init__(self, path=None):
+		"""
+		Load the cache
+		path: path of the JSON file (default: ~/.cache/omnilingo/ipns.json)
+		"""
+		self.path = path or default_path()
+		self._names = {}
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as cache_file:
+				self._names = json.load(cache_file)
+
+	def get(self, name, max_age=DEFAULT_MAX_AGE):
+		"""
+		Look up what a name last pointed to
+		name: IPNS name
+		max_age: ignore entries older than this many seconds, None to take any
+		Returns the /ipfs/ path or None
+		"""
+		entry = self._names.get(name)
+		if entry is None:
+			return None
+		if max_age is not None and time.time() - entry['time'] > max_age:
+			return None
+		return entry['path']
+
+	def put(self, name, path):
+		"""
+		Record what a name points to and save the cache
+		name: IPNS name
+		path: /ipfs/ path it points to
+		"""
+		self._names[name] = {'path': path, 'time': time.time()}
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as cache_file:
+			json.dump(self._names, cache_file)
+		os.replace(tmp_path, self.path)
@@ -0,0 +1,68 @@
+"""Append-only journal of imported rows, so an interrupted import can be resumed."""
+import json
+import os
+import threading
+
+
+class Journal:
+	"""
+	Each line of the journal records one finished row of validated.tsv as
+	clip path, sentence CID, clip CID and the clip's audio info as JSON
+	(empty if unknown) separated by tabs.
+	"""
+
+	def __init__(self, path, resume=False):
+		"""
+		Open a journal for writing
+		path: path of the journal file
+		resume: keep the records of a previous run instead of starting afresh
+		"""
+		self.path = path
+		self.done = {}
+		if resume and os.path.exists(path):
+			self.done = self.replay()
+		self._file = open(path, 'a' if resume else 'w')
+		self._lock = threading.Lock()
+
+	def replay(self):
+		"""
+		Read the records of a previous run, dropping a partly written last line
+		Returns a dict of clip path → (sentence CID, clip CID, audio info or None)
+		"""
+		done = {}
+		complete = 0
+		with open(self.path, 'rb') as journal_file:
+			for line in journal_file:
+				if not line.endswith(b'\n'):
+					break
+				fields = line.decode('utf-8').rstrip('\n').split('\t')
+				if len(fields) not in (3, 4):
+					break
+				info = json.loads(fields[3]) if len(fields) == 4 and fields[3] else None
+				done[fields[0]] = (fields[1], fields[2], info)
+				complete += len(line)
+		# Anything after the last complete record was cut off by a crash
+		os.truncate(self.path, complete)
+		return done
+
+	def append(self, records):
+		"""
+		Record a set of finished rows
+		records: iterable of (clip path, sentence CID, clip CID, audio info or None)
+		"""
+		lines = []
+		for (path, sent_cid, clip_cid, info) in records:
+			info = json.dumps(info, separators=(',', ':')) if info else ''
+			lines.append('\t'.join((path, sent_cid, clip_cid, info)) + '\n')
+		with self._lock:
+			self._file.write(''.join(lines))
+			self._file.flush()
+
+	def close(self, remove=False):
+		"""
+		Close the journal file
+		remove: delete the journal, e.g. once the index has been written
+		"""
+		self._file.close()
+		if remove:
+			os.remove(self.path)
@@ -0,0 +1,119 @@
+"""Manifest of the clips behind an index, so that the next import only has to handle what changed."""
+import hashlib
+import os
+
+from clipindex import iter_index
+
+
+def manifest_path(index_path):
+	"""
+	Where the manifest of an index is kept
+	index_path: path to the index
+	"""
+	return index_path + '.manifest'
+
+
+def clip_stat(clip_path):
+	"""
+	Size and modification time of a clip, to tell if it changed
+	clip_path: path to the mp3 file
+	Returns (size in bytes, mtime in ns)
+	"""
+	stat = os.stat(clip_path)
+	return (stat.st_size, stat.st_mtime_ns)
+
+
+def row_digest(row):
+	"""
+	Digest of what a row of validated.tsv puts into its clip's tags
+	row: a row of validated.tsv, as read by TSVReader
+	"""
+	fields = (row.sentence, row.locale, row.client_id)
+	return hashlib.sha256('\t'.join(fields).encode('utf-8')).hexdigest()[:32]
+
+
+class Manifest:
+	"""
+	Each line of the manifest records one row of the index as clip path,
+	size and mtime of the clip as it was found, size and mtime after it was
+	tagged (the same if it was tagged in memory), the row's digest, sentence
+	CID and clip CID, separated by tabs.
+	"""
+
+	def __init__(self, path):
+		"""
+		Start a new manifest, only put in place by close()
+		path: path of the manifest file
+		"""
+		self.path = path
+		self._file = open(path + '.tmp', 'w')
+
+	def append(self, records):
+		"""
+		Record a set of rows
+		records: iterable of (clip path, (size, mtime), (tagged size, tagged mtime), digest, sentence CID, clip CID)
+		"""
+		lines = []
+		for (path, (size, mtime), (tagged_size, tagged_mtime), digest, sent_cid, clip_cid) in records:
+			fields = (path, str(size), str(mtime), str(tagged_size), str(tagged_mtime), digest, sent_cid, clip_cid)
+			lines.append('\t'.join(fields) + '\n')
+		self._file.write(''.join(lines))
+
+	def close(self):
+		"""Finish the manifest and put it in place"""
+		self._file.close()
+		os.replace(self.path + '.tmp', self.path)
+
+
+def load_manifest(path):
+	"""
+	Read a manifest
+	path: path of the manifest file
+	Returns a dict of clip path → (clip path, (size, mtime), (tagged size, tagged mtime), digest, sentence CID, clip CID)
+	"""
+	records = {}
+	with open(path, 'r', encoding='utf-8') as manifest_file:
+		for line in manifest_file:
+			fields = line.rstrip('\n').split('\t')
+			if len(fields) != 8:
+				continue
+			(path, size, mtime, tagged_size, tagged_mtime, digest, sent_cid, clip_cid) = fields
+			records[path] = (path, (int(size), int(mtime)), (int(tagged_size), int(tagged_mtime)), digest, sent_cid, clip_cid)
+	return records
+
+
+class PreviousImport:
+	"""The index of an earlier import and its manifest, to reuse the rows that have not changed."""
+
+	def __init__(self, index_path):
+		"""
+		Load an earlier index and its manifest
+		index_path: path to the earlier index, in either format
+		"""
+		self.records = load_manifest(manifest_path(index_path))
+		# clip CID → (sentence CID, audio info), only for the clips of the manifest
+		wanted = {record[5] for record in self.records.values()}
+		self._clips = {}
+		for (sent_cid, clips, info) in iter_index(index_path):
+			for clip_cid in clips:
+				if clip_cid in wanted:
+					self._clips[clip_cid] = (sent_cid, info.get(clip_cid))
+
+	def lookup(self, row, stat):
+		"""
+		Find the result of an unchanged row
+		row: a row of validated.tsv, as read by TSVReader
+		stat: (size, mtime) of its clip now
+		Returns (manifest record, (sentence CID, clip CID, audio info)), None if the row is new or changed
+		"""
+		record = self.records.get(row.path)
+		if record is None:
+			return None
+		(_, found, tagged, digest, sent_cid, clip_cid) = record
+		# A fresh copy of the clip matches as it was found, the clip tagged in
+		# place by the earlier import matches as it was left
+		if stat not in (found, tagged) or digest != row_digest(row):
+			return None
+		if self._clips.get(clip_cid, (None,))[0] != sent_cid:
+			return None
+		return (record, (sent_cid, clip_cid, self._clips[clip_cid][1]))
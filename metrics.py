@@ -0,0 +1,296 @@
+"""Timings and counters of the stages of the import, index and publish tools.
+
+Each process has one registry, `metrics`. Stages are timed with
+`metrics.timer(name)` and events counted with `metrics.count(name)`. Worker
+processes send `metrics.snapshot()` back with their results and the parent
+`merge()`s them. At the end the tools can write a JSON report and, during long
+runs, a Prometheus textfile (for node_exporter's textfile collector) every few
+seconds.
+"""
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+# Attributes of an IPFS client that are not API calls
+_UNTIMED = ('close', 'session')
+
+
+class Metrics:
+	"""Registry of latency histograms and counters."""
+
+	def __init__(self, tool=''):
+		"""
+		tool: name of the tool, a label of every Prometheus metric
+		"""
+		self.tool = tool
+		self.started = time.time()
+		self._lock = threading.Lock()
+		self._timers = {}
+		self._counters = {}
+		self._textfile = None
+		self._json_path = None
+
+	def reset(self):
+		"""Forget everything recorded so far, in a forked worker"""
+		# The lock may have been copied while another thread of the parent held it
+		self._lock = threading.Lock()
+		self._timers = {}
+		self._counters = {}
+		self._textfile = None
+		self._json_path = None
+
+	def observe(self, name, seconds):
+		"""
+		Record how long a stage took
+		name: name of the stage, e.g. ipfs.add
+		seconds: duration
+		"""
+		with self._lock:
+			timer = self._timers.get(name)
+			if timer is None:
+				timer = self._timers[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+			timer['count'] += 1
+			timer['sum'] += seconds
+			timer['max'] = max(timer['max'], seconds)
+			for (i, bound) in enumerate(BUCKETS):
+				if seconds <= bound:
+					timer['buckets'][i] += 1
+					break
+
+	@contextmanager
+	def timer(self, name):
+		"""
+		Time the body of a with statement
+		name: name of the stage
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+
+	def count(self, name, n=1):
+		"""
+		Count events
+		name: name of the counter, e.g. sentence_cache.hits
+		n: number of events
+		"""
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + n
+
+	def snapshot(self):
+		"""Everything recorded so far, as plain data that can be pickled"""
+		with self._lock:
+			return {
+				'timers': {name: dict(timer, buckets=list(timer['buckets'])) for (name, timer) in self._timers.items()},
+				'counters': dict(self._counters),
+			}
+
+	def merge(self, snapshot):
+		"""
+		Add the recordings of another process
+		snapshot: what its snapshot() returned
+		"""
+		with self._lock:
+			for (name, other) in snapshot['timers'].items():
+				timer = self._timers.get(name)
+				if timer is None:
+					self._timers[name] = dict(other, buckets=list(other['buckets']))
+					continue
+				timer['count'] += other['count']
+				timer['sum'] += other['sum']
+				timer['max'] = max(timer['max'], other['max'])
+				timer['buckets'] = [a + b for (a, b) in zip(timer['buckets'], other['buckets'])]
+			for (name, n) in snapshot['counters'].items():
+				self._counters[name] = self._counters.get(name, 0) + n
+
+	def instrument(self, client, prefix='ipfs'):
+		"""
+		Wrap an IPFS client so that each API call is timed by its name,
+		e.g. ipfs.add or ipfs.name.publish
+		client: an ipfshttpclient client
+		prefix: name of the stage the calls are timed under
+		"""
+		return _TimedClient(self, client, prefix)
+
+	def report(self):
+		"""Summary of the recordings, with estimated percentiles"""
+		snapshot = self.snapshot()
+		timers = {}
+		for (name, timer) in sorted(snapshot['timers'].items()):
+			timers[name] = {
+				'count': timer['count'],
+				'total_seconds': timer['sum'],
+				'mean_seconds': timer['sum'] / timer['count'] if timer['count'] else 0.0,
+				'max_seconds': timer['max'],
+				'p50_seconds': _percentile(timer, 0.5),
+				'p90_seconds': _percentile(timer, 0.9),
+				'p99_seconds': _percentile(timer, 0.99),
+			}
+		return {
+			'tool': self.tool,
+			'elapsed_seconds': time.time() - self.started,
+			'timers': timers,
+			'counters': dict(sorted(snapshot['counters'].items())),
+		}
+
+	def write_json(self, path):
+		"""
+		Write the report as JSON
+		path: where to write it
+		"""
+		_write(path, json.dumps(self.report(), indent=2) + '\n')
+
+	def write_prometheus(self, path):
+		"""
+		Write the recordings in the Prometheus text format
+		path: where to write it, should end in .prom for node_exporter
+		"""
+		snapshot = self.snapshot()
+		tool = _label(self.tool)
+		lines = [
+			'# HELP omnilingo_stage_seconds Time spent in each stage of the pipeline.',
+			'# TYPE omnilingo_stage_seconds histogram',
+		]
+		for (name, timer) in sorted(snapshot['timers'].items()):
+			labels = 'tool="%s",stage="%s"' % (tool, _label(name))
+			cumulative = 0
+			for (bound, n) in zip(BUCKETS, timer['buckets']):
+				cumulative += n
+				le = '+Inf' if bound == float('inf') else repr(bound)
+				lines.append('omnilingo_stage_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+			lines.append('omnilingo_stage_seconds_sum{%s} %r' % (labels, timer['sum']))
+			lines.append('omnilingo_stage_seconds_count{%s} %d' % (labels, timer['count']))
+		lines += [
+			'# HELP omnilingo_events_total Events counted by the pipeline.',
+			'# TYPE omnilingo_events_total counter',
+		]
+		for (name, n) in sorted(snapshot['counters'].items()):
+			lines.append('omnilingo_events_total{tool="%s",event="%s"} %d' % (tool, _label(name), n))
+		lines += [
+			'# HELP omnilingo_elapsed_seconds Time since the tool started.',
+			'# TYPE omnilingo_elapsed_seconds gauge',
+			'omnilingo_elapsed_seconds{tool="%s"} %r' % (tool, time.time() - self.started),
+		]
+		_write(path, '\n'.join(lines) + '\n')
+
+	def start_textfile(self, path, interval=15):
+		"""
+		Rewrite a Prometheus textfile every interval seconds until stop_textfile()
+		path: where to write it
+		interval: seconds between writes
+		"""
+		stop = threading.Event()
+
+		def loop():
+			while not stop.wait(interval):
+				self.write_prometheus(path)
+
+		thread = threading.Thread(target=loop, daemon=True)
+		thread.start()
+		self._textfile = (path, stop, thread)
+
+	def stop_textfile(self):
+		"""Stop rewriting the Prometheus textfile and write it one last time"""
+		if self._textfile is None:
+			return
+		(path, stop, thread) = self._textfile
+		stop.set()
+		thread.join()
+		self.write_prometheus(path)
+		self._textfile = None
+
+	def add_arguments(self, parser):
+		"""
+		Add the --metrics and --prometheus options to a tool's argument parser
+		parser: an argparse.ArgumentParser
+		"""
+		parser.add_argument('--metrics', dest='metrics', default=None,
+				help='write timings and counters of each stage to this JSON file at the end')
+		parser.add_argument('--prometheus', dest='prometheus', default=None,
+				help='keep timings and counters in this Prometheus textfile while running')
+		parser.add_argument('--prometheus-interval', dest='prometheus_interval', type=int, default=15,
+				help='seconds between writes of the Prometheus textfile (default: 15)')
+
+	def start(self, tool, json_path=None, prometheus_path=None, interval=15):
+		"""
+		Set up the outputs asked for on the command line of a tool
+		tool: name of the tool
+		json_path: where to write the JSON report at the end, if anywhere
+		prometheus_path: where to keep a Prometheus textfile, if anywhere
+		interval: seconds between textfile writes
+		"""
+		self.tool = tool
+		self._json_path = json_path
+		if prometheus_path:
+			self.start_textfile(prometheus_path, interval=interval)
+
+	def finish(self):
+		"""Write the outputs set up by start()"""
+		self.stop_textfile()
+		if self._json_path:
+			self.write_json(self._json_path)
+
+
+class _TimedClient:
+	"""Proxy of an IPFS client, or one of its sections, timing every call."""
+
+	def __init__(self, metrics, target, prefix):
+		self._metrics = metrics
+		self._target = target
+		self._prefix = prefix
+
+	def __reduce__(self):
+		# Sent to a worker process, report to that process's registry
+		return (_instrument, (self._target, self._prefix))
+
+	def __getattr__(self, name):
+		attr = getattr(self._target, name)
+		if name.startswith('_') or name in _UNTIMED:
+			return attr
+		stage = self._prefix + '.' + name
+		if not callable(attr):
+			# A section of the API, e.g. client.name
+			return _TimedClient(self._metrics, attr, stage)
+
+		def timed(*args, **kwargs):
+			with self._metrics.timer(stage):
+				return attr(*args, **kwargs)
+		return timed
+
+
+def _percentile(timer, q):
+	"""Upper bound of the histogram bucket holding the q-th quantile"""
+	if timer['count'] == 0:
+		return 0.0
+	rank = q * timer['count']
+	cumulative = 0
+	for (bound, n) in zip(BUCKETS, timer['buckets']):
+		cumulative += n
+		if cumulative >= rank:
+			return min(bound, timer['max'])
+	return timer['max']
+
+
+def _label(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _write(path, text):
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as out_file:
+		out_file.write(text)
+	os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+
+
+def _instrument(client, prefix):
+	return metrics.instrument(client, prefix)
@@ -0,0 +1,86 @@
+"""Local record of the CIDs of model files and model metadata objects."""
+import json
+import os
+import threading
+
+from cachedir import cache_dir
+
+
+def default_path():
+	"""Where the record is kept by default"""
+	return os.path.join(cache_dir(), 'models.json')
+
+
+class ModelCache:
+	"""
+	JSON file remembering the CID of each model file, by path, size and
+	modification time, and the CID of each model metadata object, by content,
+	so that unchanged models are not hashed or added again
+	"""
+
+	def __init__(self, path=None):
+		"""
+		Load the record
+		path: path of the JSON file (default: ~/.cache/omnilingo/models.json)
+		"""
+		self.path = path or default_path()
+		self._files = {}
+		self._metas = {}
+		self._lock = threading.Lock()
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as cache_file:
+				saved = json.load(cache_file)
+			self._files = saved.get('files', {})
+			self._metas = saved.get('metas', {})
+
+	def _stat(self, model_fn):
+		stat = os.stat(model_fn)
+		return (os.path.abspath(model_fn), stat.st_size, stat.st_mtime)
+
+	def file_cid(self, model_fn):
+		"""
+		Look up the CID of a model file, if it has not changed since it was hashed
+		model_fn: path of the model
+		"""
+		(path, size, mtime) = self._stat(model_fn)
+		entry = self._files.get(path)
+		if entry and entry['size'] == size and entry['mtime'] == mtime:
+			return entry['cid']
+		return None
+
+	def put_file(self, model_fn, cid):
+		"""
+		Record the CID of a model file
+		model_fn: path of the model
+		cid: its CID
+		"""
+		(path, size, mtime) = self._stat(model_fn)
+		with self._lock:
+			self._files[path] = {'size': size, 'mtime': mtime, 'cid': cid}
+
+	def _key(self, meta):
+		return json.dumps(meta, sort_keys=True, separators=(',', ':'))
+
+	def meta_cid(self, meta):
+		"""
+		Look up the CID of a model metadata object added before
+		meta: the metadata, including the model CID
+		"""
+		return self._metas.get(self._key(meta))
+
+	def put_meta(self, meta, cid):
+		"""
+		Record the CID of a model metadata object
+		meta: the metadata, including the model CID
+		cid: CID of the object
+		"""
+		with self._lock:
+			self._metas[self._key(meta)] = cid
+
+	def save(self):
+		"""Write the record out"""
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		tmp_path = self.path + '.tmp'
+		with self._lock, open(tmp_path, 'w') as cache_file:
+			json.dump({'files': self._files, 'metas': self._metas}, cache_file)
+		os.replace(tmp_path, self.path)
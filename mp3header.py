@@ -0,0 +1,159 @@
+"""Work out the duration of an MP3 from its first few kilobytes.
+
+Reads the ID3v2 header to find the first MPEG audio frame and then takes the
+number of frames from its Xing/Info or VBRI header. Without either, the file is
+assumed to be CBR and the duration is estimated from the bitrate and file size.
+"""
+
+HEADER_FETCH = 8192  # in bytes, enough for the first frame and its Xing/VBRI header
+
+# kbit/s by (MPEG version 1?, layer), index 0 is "free" and 15 is invalid
+BITRATES = {
+	(True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+	(True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+	(True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+	(False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+	(False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+	(False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Hz by the version bits of the frame header
+SAMPLE_RATES = {
+	3: [44100, 48000, 32000],  # MPEG 1
+	2: [22050, 24000, 16000],  # MPEG 2
+	0: [11025, 12000, 8000],   # MPEG 2.5
+}
+
+
+def id3_size(data):
+	"""
+	Size of the ID3v2 tag at the start of a file, 0 if there is none
+	data: the first bytes of the file
+	"""
+	if len(data) < 10 or data[:3] != b'ID3':
+		return 0
+	size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+	footer = 10 if data[5] & 0x10 else 0
+	return 10 + size + footer
+
+
+def frame_header(data, offset):
+	"""
+	Parse the MPEG audio frame header at offset
+	data: bytes of the file
+	offset: where the frame starts
+	Returns a dict describing the frame, or None if there is no valid frame there
+	"""
+	if offset + 4 > len(data):
+		return None
+	(b1, b2, b3) = (data[offset + 1], data[offset + 2], data[offset + 3])
+	if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+		return None
+	version = (b1 >> 3) & 0x03
+	layer = 4 - ((b1 >> 1) & 0x03)
+	bitrate_index = b2 >> 4
+	rate_index = (b2 >> 2) & 0x03
+	if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+		return None
+	mpeg1 = version == 3
+	if layer == 1:
+		samples = 384
+	elif layer == 3 and not mpeg1:
+		samples = 576
+	else:
+		samples = 1152
+	mono = (b3 >> 6) == 3
+	if layer == 3:
+		side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+	else:
+		side_info = 0
+	return {
+		'bitrate': BITRATES[(mpeg1, layer)][bitrate_index] * 1000,
+		'sample_rate': SAMPLE_RATES[version][rate_index],
+		'samples': samples,
+		'side_info': side_info,
+	}
+
+
+def find_frame(data, offset, search=4096):
+	"""
+	Find the first valid frame header at or after offset
+	data: bytes of the file
+	offset: where to start looking, usually the end of the ID3 tag
+	search: how many bytes to look through
+	Returns (offset of the frame, frame header) or (None, None)
+	"""
+	end = min(len(data) - 4, offset + search)
+	while offset <= end:
+		offset = data.find(b'\xff', offset, end + 1)
+		if offset < 0:
+			break
+		header = frame_header(data, offset)
+		if header:
+			return (offset, header)
+		offset += 1
+	return (None, None)
+
+
+def _int(data, offset, size=4):
+	return int.from_bytes(data[offset:offset + size], 'big')
+
+
+def vbr_frames(data, offset, header):
+	"""
+	Read the number of frames and encoder delay/padding from a Xing/Info or VBRI header
+	data: bytes of the file
+	offset: offset of the first frame
+	header: its parsed frame header
+	Returns (frames, delay and padding in samples) or (None, 0)
+	"""
+	xing = offset + 4 + header['side_info']
+	if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 8:
+		flags = _int(data, xing + 4)
+		if not flags & 0x01 or len(data) < xing + 12:
+			return (None, 0)
+		frames = _int(data, xing + 8)
+		pos = xing + 12
+		for (flag, size) in ((0x02, 4), (0x04, 100), (0x08, 4)):
+			if flags & flag:
+				pos += size
+		# The LAME tag after the Xing header holds the encoder delay and padding
+		lame = data[pos:pos + 24]
+		if len(lame) < 24:
+			# Cut short, there may be a delay and padding that we can't see
+			return (None, 0)
+		skipped = 0
+		if lame[:4] == b'LAME':
+			skipped = ((lame[21] << 4) | (lame[22] >> 4)) + (((lame[22] & 0x0F) << 8) | lame[23])
+		return (frames, skipped)
+
+	vbri = offset + 4 + 32
+	if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+		return (_int(data, vbri + 14), 0)
+
+	return (None, 0)
+
+
+def duration(data, file_size, base=0):
+	"""
+	Work out the duration of an MP3
+	data: bytes of the file starting at base
+	file_size: size of the whole file in bytes, None if not known
+	base: offset of data in the file, e.g. the end of a large ID3 tag
+	Returns the duration in seconds, or None if no usable frame header was found
+	or the file is CBR and file_size was not given
+	"""
+	start = id3_size(data) if base == 0 else 0
+	(offset, header) = find_frame(data, start)
+	if header is None:
+		return None
+
+	(frames, skipped) = vbr_frames(data, offset, header)
+	if frames:
+		samples = frames * header['samples'] - skipped
+		return max(samples, 0) / header['sample_rate']
+
+	# No VBR header, assume CBR and estimate from the size of the audio
+	if file_size is None:
+		return None
+	return (file_size - base - offset) * 8 / header['bitrate']
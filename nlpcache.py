@@ -0,0 +1,120 @@
+"""On-disk cache of tokeniser and tagger results for the indexer."""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_MAX_ENTRIES = 1000000  # in sentences
+
+
+def cvutils_version():
+	"""Version of commonvoice-utils, results of other versions are not reused"""
+	try:
+		from importlib.metadata import version
+		return version('commonvoice-utils')
+	except Exception:
+		return 'unknown'
+
+
+class NLPCache:
+	"""
+	SQLite cache keyed by (locale, SHA-256 of the sentence, cvutils version)
+	holding the tokens, the tags and the CID of the sentence's metadata object.
+	Least recently used entries are evicted beyond max_entries.
+	"""
+
+	def __init__(self, path, locale, max_entries=DEFAULT_MAX_ENTRIES):
+		"""
+		Open or create a cache
+		path: path of the SQLite database
+		locale: language of the sentences
+		max_entries: maximum number of sentences to keep
+		"""
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		self.path = path
+		self.locale = locale
+		self.version = cvutils_version()
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+		self._db = sqlite3.connect(path)
+		self._db.execute('''CREATE TABLE IF NOT EXISTS nlp (
+			locale TEXT, content_hash TEXT, version TEXT,
+			content TEXT, tokens TEXT, tags TEXT,
+			sentence_cid TEXT, meta_cid TEXT, last_used REAL,
+			PRIMARY KEY (locale, content_hash, version))''')
+		self._db.execute('CREATE INDEX IF NOT EXISTS nlp_sentence ON nlp (sentence_cid)')
+		self._db.execute('CREATE INDEX IF NOT EXISTS nlp_last_used ON nlp (last_used)')
+
+	def _key(self, content):
+		return (self.locale, hashlib.sha256(content.encode('utf-8')).hexdigest(), self.version)
+
+	def content(self, sentence_cid):
+		"""
+		Look up the text of a sentence seen before, saving a fetch from IPFS
+		sentence_cid: CID of the sentence object
+		Returns the content or None
+		"""
+		row = self._db.execute('SELECT content FROM nlp WHERE sentence_cid = ? AND locale = ? LIMIT 1',
+				(sentence_cid, self.locale)).fetchone()
+		return row[0] if row else None
+
+	def get(self, content):
+		"""
+		Look up the analysis of a sentence
+		content: text of the sentence
+		Returns a dict with tokens, tags, sentence_cid and meta_cid, or None
+		"""
+		key = self._key(content)
+		row = self._db.execute('''SELECT tokens, tags, sentence_cid, meta_cid FROM nlp
+				WHERE locale = ? AND content_hash = ? AND version = ?''', key).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self._db.execute('''UPDATE nlp SET last_used = ?
+				WHERE locale = ? AND content_hash = ? AND version = ?''', (time.time(),) + key)
+		return {
+			'tokens': json.loads(row[0]),
+			'tags': json.loads(row[1]),
+			'sentence_cid': row[2],
+			'meta_cid': row[3],
+		}
+
+	def put(self, content, tokens, tags, sentence_cid, meta_cid):
+		"""
+		Store the analysis of a sentence
+		content: text of the sentence
+		tokens: output of the tokeniser
+		tags: output of the tagger
+		sentence_cid: CID of the sentence object
+		meta_cid: CID of the metadata object built from them
+		"""
+		self._db.execute('INSERT OR REPLACE INTO nlp VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+				self._key(content) + (content, json.dumps(tokens), json.dumps(tags),
+				sentence_cid, meta_cid, time.time()))
+
+	def size(self):
+		"""Number of sentences in the cache"""
+		return self._db.execute('SELECT COUNT(*) FROM nlp').fetchone()[0]
+
+	def evict(self):
+		"""Drop the least recently used entries over the limit and save the cache"""
+		excess = self.size() - self.max_entries
+		if excess > 0:
+			self._db.execute('''DELETE FROM nlp WHERE rowid IN
+					(SELECT rowid FROM nlp ORDER BY last_used LIMIT ?)''', (excess,))
+			self.evicted += excess
+		self._db.commit()
+
+	def close(self):
+		"""Trim and save the cache"""
+		self.evict()
+		self._db.close()
+
+	def report(self):
+		"""One line of statistics for the bucket report"""
+		return 'nlp cache: %d hits, %d misses, %d evicted, %d entries' % (
+				self.hits, self.misses, self.evicted, self.size())
@@ -0,0 +1,103 @@
+"""Fold alternative spellings of sentences into one, from the alternative characters in orthography.py.
+
+The alternatives of a locale map a canonical character to the characters
+people type instead, e.g. ʼ (U+02BC) for ' and ’ in Breton. Only variants
+that are not letters themselves are folded: ' and ’ become ʼ, but a Turkish
+I is a letter of its own and is never turned into İ.
+"""
+import json
+import os
+import unicodedata
+
+from functools import lru_cache
+
+import orthography
+
+
+@lru_cache(maxsize=None)
+def translation_table(locale):
+	"""
+	Table for str.translate() folding the variants of a locale into the canonical characters
+	locale: language code
+	Returns a dict of code point → canonical character, empty if there is nothing to fold
+	"""
+	table = {}
+	for (canonical, variants) in orthography.alternatives(locale).items():
+		for variant in variants:
+			if len(variant) != 1 or unicodedata.category(variant).startswith('L'):
+				continue
+			table[ord(variant)] = canonical
+	return table
+
+
+def fold(text, locale):
+	"""
+	Canonical spelling of a sentence
+	text: the sentence
+	locale: its language
+	"""
+	table = translation_table(locale)
+	return text.translate(table) if table else text
+
+
+def align(tokens, text, folded, locale):
+	"""
+	Spell the tokens of a folded sentence as one of its variants does, folding
+	swaps one character for one so each token has the same span in both
+	tokens: tokens of the folded sentence
+	text: the variant
+	folded: the folded sentence, fold(text, locale)
+	locale: their language
+	Returns the tokens as they are in text, None if a token is not in the sentence in order
+	"""
+	spelt = []
+	pos = 0
+	for token in tokens:
+		# The tokeniser may turn a variant back into another one, e.g. ʼ into '
+		start = folded.find(fold(token, locale), pos)
+		if start < 0:
+			return None
+		pos = start + len(token)
+		spelt.append(text[start:pos])
+	return spelt
+
+
+class Normaliser:
+	"""Folds the sentences of rows of validated.tsv, remembering each variant it folded."""
+
+	def __init__(self):
+		# locale → variant → canonical sentence
+		self.variants = {}
+
+	def sentence(self, text, locale):
+		"""
+		Canonical spelling of a sentence, recording it if it was a variant
+		text: the sentence
+		locale: its language
+		"""
+		canonical = fold(text, locale)
+		if canonical != text:
+			self.variants.setdefault(locale, {})[text] = canonical
+		return canonical
+
+	def rows(self, rows):
+		"""
+		Fold the sentences of rows as they are read
+		rows: iterable of Row tuples from TSVReader
+		Yields the rows with their sentence folded
+		"""
+		for row in rows:
+			canonical = self.sentence(row.sentence, row.locale)
+			yield row if canonical == row.sentence else row._replace(sentence=canonical)
+
+	def save(self, path):
+		"""
+		Write the variants found, as JSON locale → {variant: canonical}, if there were any
+		path: where to write them
+		"""
+		if not self.variants:
+			return
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'w', encoding='utf-8') as variants_file:
+			json.dump(self.variants, variants_file, ensure_ascii=False, indent=1)
+		os.replace(tmp_path, path)
@@ -4,83 +4,303 @@ import csv
 import hashlib
 import ipfshttpclient
 import json
+import os
 import progressbar
 import re
 import sys
 import glob
 import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import languages 
 import orthography
+from ipnscache import IPNSCache, DEFAULT_MAX_AGE
+from metrics import metrics
+from modelcache import ModelCache
+
+class ProgressReader:
+	"""Model file that shows a progress bar as it is streamed to IPFS"""
+
+	def __init__(self, model_fn):
+		"""
+		Open a model for reading
+		model_fn: path of the model
+		"""
+		self.name = model_fn
+		self._file = open(model_fn, 'rb')
+		self._done = 0
+		self._bar = progressbar.ProgressBar(max_value=os.path.getsize(model_fn)).start()
+
+	def read(self, size=-1):
+		data = self._file.read(size)
+		self._done += len(data)
+		self._bar.update(self._done)
+		return data
+
+	def close(self):
+		self._bar.finish()
+		self._file.close()
+
 
 class Publisher:
 	
-	def __init__(self, locale, display, models, cid, merge=None):
-		"""Set up a connection to the local IPFS node"""
+	def __init__(self, locale=None, display=None, models=None, cid=None, merge=None, threads=8, ipns_cache=None, max_age=DEFAULT_MAX_AGE, refresh=False, model_cache=None):
+		"""
+		Set up a connection to the local IPFS node
+		locale, display, models, cid: a locale to queue as with add(), so that
+		    Publisher(locale, display, models, cid, merge=...).publish() works as it always did
+		merge: CID, IPNS name or key name of an existing language list to add to
+		threads: number of locales to prepare at the same time
+		ipns_cache: IPNSCache of the language lists last seen behind IPNS names, if any
+		max_age: resolve names again if their cache entry is older than this many seconds
+		refresh: resolve names again whatever the age of their cache entry
+		model_cache: ModelCache of the CIDs of models added before, if any
+		"""
 		try:
-			self._client = ipfshttpclient.connect(session=True)
+			self._client = metrics.instrument(ipfshttpclient.connect(session=True))
 		except:
 			print('Could not connect to IPFS node', file=sys.stderr)
 
 		self.languages = {}
-		self.display = display
-		self.models = models
+		# (locale, display name, models, index CID) to publish
+		self.releases = []
+		self.threads = threads
+		# Each thread preparing locales has its own connection
+		self._local = threading.local()
+		self._clients = []
+		self._clients_lock = threading.Lock()
+		self.ipns_cache = ipns_cache
+		self.max_age = max_age
+		self.refresh = refresh
+		self.model_cache = model_cache
 
 		if merge:
-			try:
-				try:
-					k5 = next(k for k in self._client.key.list()['Keys'] if k['Name'] == merge)
-					print("Resolved %s to %s" % (k5['Name'], k5['Id']), file=sys.stderr)
-					merge = k5['Id']
-				except StopIteration:
-					pass
-				if merge.startswith("k5"):
-					merge = self._client.name.resolve(merge)['Path']
-				x = self._client.cat(merge)
+			path = self.resolve(merge)
+			if path is None:
+				print('No existing list', file=sys.stderr)
+			else:
+				x = self._client.cat(path)
 				# Populate language list from existing
 				print('Found existing list', file=sys.stderr)
 				self.languages = json.loads(x)
-			except:
-				print('No existing list')
-				pass
 
 #		self.languages = {}
 		print('[languages]', self.languages.keys(), file=sys.stderr)
 
-		self.locale = locale
-		self.cid = cid
-		
-	def publish(self):
+		if locale is not None:
+			self.add(locale, display, models or [], cid)
+
+	def resolve(self, merge):
+		"""
+		Find the path of the language list to merge with, going through the
+		IPNS cache for names
+		merge: CID, IPNS name or key name
+		Returns a path for cat, None for a local key that was never published,
+		raises if a name can't be resolved and isn't cached
+		"""
+		local = False
+		try:
+			k5 = next(k for k in self._client.key.list()['Keys'] if k['Name'] == merge)
+			print("Resolved %s to %s" % (k5['Name'], k5['Id']), file=sys.stderr)
+			merge = k5['Id']
+			local = True
+		except StopIteration:
+			pass
+		if not merge.startswith("k5"):
+			return merge
+
+		if self.ipns_cache and not self.refresh:
+			path = self.ipns_cache.get(merge, max_age=self.max_age)
+			if path:
+				print('Using cached %s for %s' % (path, merge), file=sys.stderr)
+				return path
+		try:
+			path = self._client.name.resolve(merge)['Path']
+		except ipfshttpclient.exceptions.Error as e:
+			# Don't publish a list without the other locales, fall back to the
+			# last list seen however old it is
+			path = self.ipns_cache.get(merge, max_age=None) if self.ipns_cache else None
+			if path is None and local and isinstance(e, ipfshttpclient.exceptions.ErrorResponse):
+				# The node answered for a key of its own, nothing was ever
+				# published with it, start a new list
+				return None
+			if path is None:
+				print('Could not resolve %s: %s' % (merge, e), file=sys.stderr)
+				raise
+			print('Could not resolve %s, using cached %s' % (merge, path), file=sys.stderr)
+			return path
+		if self.ipns_cache:
+			self.ipns_cache.put(merge, path)
+		return path
+
+	def client(self):
+		"""The IPFS connection of the calling thread"""
+		if not hasattr(self._local, 'client'):
+			self._local.client = metrics.instrument(ipfshttpclient.connect(session=True))
+			with self._clients_lock:
+				self._clients.append(self._local.client)
+		return self._local.client
+
+	def add(self, locale, display, models, cid):
+		"""
+		Queue a locale to be published
+		locale: language code
+		display: display name of the language
+		models: list of (model path, model metadata)
+		cid: CID of the locale's index
+		"""
+		self.releases.append((locale, display, models, cid))
+
+	def pinned(self, cid):
+		"""
+		Check if the local node has a CID pinned
+		cid: CID to look for
+		"""
+		try:
+			self.client().pin.ls(cid, type='recursive')
+			return True
+		except ipfshttpclient.exceptions.Error:
+			return False
+
+	def add_model(self, model_fn, model_meta):
+		"""
+		Add a model and its metadata object, skipping whatever the node already has
+		model_fn: path of the model
+		model_meta: metadata of the model
+		Returns the CID of the metadata object
+		"""
+		client = self.client()
+		model_hash = self.model_cache.file_cid(model_fn) if self.model_cache else None
+		if model_hash is None:
+			print('Hashing', model_fn, file=sys.stderr)
+			reader = ProgressReader(model_fn)
+			with metrics.timer('model.hash'):
+				model_hash = client.add(reader, only_hash=True)['Hash']
+			reader.close()
+			if self.model_cache:
+				self.model_cache.put_file(model_fn, model_hash)
+
+		if self.pinned(model_hash):
+			print('Already pinned', model_fn, model_hash, file=sys.stderr)
+			metrics.count('models.pinned')
+		else:
+			metrics.count('models.uploaded')
+			print('Adding', model_fn, file=sys.stderr)
+			reader = ProgressReader(model_fn)
+			with metrics.timer('model.upload'):
+				added = client.add(reader)['Hash']
+			reader.close()
+			if added != model_hash:
+				# The file changed while we were looking at it
+				model_hash = added
+				if self.model_cache:
+					self.model_cache.put_file(model_fn, model_hash)
+
+		meta = dict(model_meta, model=model_hash)
+		print(meta)
+		meta_hash = self.model_cache.meta_cid(meta) if self.model_cache else None
+		if meta_hash is None or not self.pinned(meta_hash):
+			meta_hash = client.add_json(meta)
+			if self.model_cache:
+				self.model_cache.put_meta(meta, meta_hash)
+		return meta_hash
+
+	def describe(self, locale, display, models):
+		"""
+		Add the metadata object of a locale, runs in a thread
+		locale: language code
+		display: display name of the language
+		models: list of (model path, model metadata)
+		Returns the CID of the metadata object
+		"""
+		client = self.client()
 		opts = {}
 		meta_info = {
-			'alternatives': orthography.alternatives(self.locale),
-			'display': self.display,
-		}
-		if self.models:
-			model_hash = self._client.add(self.models[0][0], opts=opts)
-			self.models[0][1]["model"] = model_hash["Hash"]
-			print(self.models[0][1])
-			model_meta_hash = self._client.add_json(self.models[0][1], opts=opts)
-			meta_info['models'] = [model_meta_hash]
-
-		meta_hash = self._client.add_json(meta_info, opts=opts)
-
-		self.languages[self.locale] = {
-			'meta': meta_hash, 
-			'cids': [self.cid]
+			'alternatives': orthography.alternatives(locale),
+			'display': display,
 		}
+		if models:
+			meta_info['models'] = [self.add_model(model_fn, model_meta) for (model_fn, model_meta) in models]
+
+		return client.add_json(meta_info, opts=opts)
+
+	def publish(self):
+		"""
+		Add the metadata of every queued locale, then the language list, and
+		publish the list to IPNS once
+		Returns the CID of the language list
+		"""
+		opts = {}
+		with metrics.timer('describe'), ThreadPoolExecutor(max_workers=self.threads) as pool:
+			meta_hashes = list(pool.map(lambda release: self.describe(*release[:3]), self.releases))
+		metrics.count('locales', len(self.releases))
+
+		for ((locale, display, models, cid), meta_hash) in zip(self.releases, meta_hashes):
+			self.languages[locale] = {
+				'meta': meta_hash, 
+				'cids': [cid]
+			}
+			print('[' + locale + ']',  display, '|', meta_hash, file=sys.stderr)
 
 		index_hash = self._client.add_json(self.languages, opts=opts)
-		
-		print('[' + self.locale + ']',  self.display, '|', meta_hash, file=sys.stderr)
 
-		self._client.name.publish(index_hash, allow_offline=True)
+		if self.model_cache:
+			self.model_cache.save()
+
+		published = self._client.name.publish(index_hash, allow_offline=True)
+		if self.ipns_cache:
+			self.ipns_cache.put(published['Name'], '/ipfs/' + index_hash)
 
 		return index_hash 
 
 	def close(self):
-		"""Close the TCP connection to IPFS"""
+		"""Close the TCP connections to IPFS"""
 		self._client.close()
+		for client in self._clients:
+			client.close()
+
+
+def display_name(locale):
+	"""
+	Display name of a locale from languages.py, the locale itself if it is not there
+	locale: language code
+	"""
+	if locale in languages.names:
+		return languages.names[locale]
+	print('WARNING:', locale, 'not found in languages.py, display name will be "' + locale + '".', file=sys.stderr)
+	return locale
+
+
+def load_model(model_fn):
+	"""
+	Read the metadata of a model, from the .json file next to it
+	model_fn: path of the .tflite model
+	Returns (model path, model metadata)
+	"""
+	model_meta_fn = model_fn.replace('.tflite', '.json')
+	model_meta = json.loads(open(model_meta_fn).read())
+	return (model_fn, model_meta)
+
+
+def load_manifest(manifest_fn):
+	"""
+	Read a batch manifest, a JSON object mapping each locale to the CID of its
+	index or to {"cid": CID, "models": [model paths], "display": name}
+	manifest_fn: path of the manifest
+	Returns a list of (locale, display name, models, index CID)
+	"""
+	with open(manifest_fn) as manifest_file:
+		manifest = json.load(manifest_file)
+	releases = []
+	for (locale, release) in manifest.items():
+		if isinstance(release, str):
+			release = {'cid': release}
+		display = release.get('display') or display_name(locale)
+		models = [load_model(model_fn) for model_fn in release.get('models', [])]
+		releases.append((locale, display, models, release['cid']))
+	return releases
 
 
 if __name__ == "__main__":
@@ -94,6 +314,7 @@ if __name__ == "__main__":
 		print('',file=sys.stderr)
 		print('publisher.py [--merge cid] locale cid', file=sys.stderr)
 		print('	  [--with-model model.tflite] locale cid', file=sys.stderr)
+		print('	  --batch manifest.json', file=sys.stderr)
 		sys.exit(-1)
 
 	merge = None
@@ -103,25 +324,39 @@ if __name__ == "__main__":
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-g', '--merge', dest='merge', action='store')
-	parser.add_argument('-m', '--with-model', dest='model', action='store')
-	parser.add_argument('locale')
-	parser.add_argument('cid')
+	parser.add_argument('-m', '--with-model', dest='models', action='append', default=[],
+			help='model to publish with the locale, can be given more than once')
+	parser.add_argument('-b', '--batch', dest='batch', action='store',
+			help='JSON manifest of locale -> index CID, to publish many locales at once')
+	parser.add_argument('-t', '--threads', dest='threads', type=int, default=8,
+			help='number of locales to prepare at the same time (default: 8)')
+	parser.add_argument('--max-age', dest='max_age', type=int, default=DEFAULT_MAX_AGE,
+			help='resolve the --merge name again if the cached list is older than this many seconds (default: %d)' % DEFAULT_MAX_AGE)
+	parser.add_argument('--refresh', dest='refresh', action='store_true',
+			help='resolve the --merge name again even if the cached list is recent')
+	metrics.add_arguments(parser)
+	parser.add_argument('locale', nargs='?')
+	parser.add_argument('cid', nargs='?')
 	args = parser.parse_args()
+	metrics.start('publisher', args.metrics, args.prometheus, args.prometheus_interval)
 
-	if args.model:
-		model_fn = args.model
-		model_meta_fn = model_fn.replace('.tflite', '.json')
-		model_meta = json.loads(open(model_meta_fn).read())
-		models.append((model_fn, model_meta))
-
-	display = args.locale
-	if args.locale in languages.names:
-		display = languages.names[args.locale]
+	if args.batch:
+		if args.locale or args.models:
+			usage()
+		releases = load_manifest(args.batch)
 	else:
-		print('WARNING:', args.locale, 'not found in languages.py, display name will be "' + args.locale + '".', file=sys.stderr)
+		if not args.locale or not args.cid:
+			usage()
+		models = [load_model(model_fn) for model_fn in args.models]
+		releases = [(args.locale, display_name(args.locale), models, args.cid)]
 
-	pub = Publisher(args.locale, display, models, args.cid, merge=args.merge)
+	pub = Publisher(merge=args.merge, threads=max(1, args.threads), ipns_cache=IPNSCache(),
+			max_age=args.max_age, refresh=args.refresh, model_cache=ModelCache())
+	for release in releases:
+		pub.add(*release)
 	
 	new_hash = pub.publish()
+	pub.close()
+	metrics.finish()
 
 	print('index:', new_hash)
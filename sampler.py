@@ -0,0 +1,84 @@
+"""Stratified sampling of clips into the indexer's difficulty buckets.
+
+Each bucket holds at most a fixed number of clips. Without a seed the sampler
+is first-come: clips go into their bucket in index order until it is full.
+With a seed, sentences are visited in the order of a seeded hash of their CID,
+which makes the clips of each bucket a uniform sample of that bucket (the
+bottom-k of a reservoir keyed by the hash) that is the same for every run
+with the same seed. In both cases a clip that arrives after its bucket is
+full can never get in, so fetches for it can be skipped and the scan can stop
+as soon as every bucket is either full or out of reach of the rest of the
+index.
+"""
+import hashlib
+
+
+def priority(seed, cid):
+	"""
+	Seeded sort key of a CID
+	seed: integer seed of the sample
+	cid: CID of a sentence
+	"""
+	digest = hashlib.sha256(('%d:%s' % (seed, cid)).encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'big')
+
+
+class Sampler:
+	"""Keeps track of the clips picked for each bucket."""
+
+	def __init__(self, buckets, per_bucket, seed=None):
+		"""
+		Start an empty sample
+		buckets: IDs of the buckets
+		per_bucket: maximum number of clips in a bucket
+		seed: seed for visiting sentences in random order, None for index order
+		"""
+		self.per_bucket = per_bucket
+		self.seed = seed
+		self.buckets = {bucket: [] for bucket in buckets}
+		self._full = set()
+		# buckets that no clip left in the scan can land in
+		self._unfillable = set()
+		# clips without a recorded length that were never fetched because the scan stopped before them
+		self.skipped_clips = 0
+		# sentences that were not fetched because all of their clips were known to land in full buckets
+		self.skipped_sentences = 0
+
+	def order(self):
+		"""Sort key for the sentence CIDs of the index, None to keep index order"""
+		if self.seed is None:
+			return None
+		return lambda cid: priority(self.seed, cid)
+
+	def full_buckets(self):
+		"""Snapshot of the buckets that are full, they stay full"""
+		return frozenset(self._full)
+
+	def offer(self, bucket, entry):
+		"""
+		Add a clip to its bucket if there is room
+		bucket: bucket ID
+		entry: index entry of the clip
+		Returns True if the clip was added
+		"""
+		if bucket in self._full:
+			return False
+		self.buckets[bucket].append(entry)
+		if len(self.buckets[bucket]) >= self.per_bucket:
+			self._full.add(bucket)
+		return True
+
+	def unfillable(self, buckets):
+		"""
+		Record buckets that no clip left in the scan can land in
+		buckets: bucket IDs
+		"""
+		self._unfillable.update(buckets)
+
+	def satisfied(self):
+		"""Check if every bucket is full or unfillable, nothing later in the scan can change the sample"""
+		return len(self._full | self._unfillable) == len(self.buckets)
+
+	def total(self):
+		"""Number of clips in the sample"""
+		return sum(len(entries) for entries in self.buckets.values())
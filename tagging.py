@@ -0,0 +1,73 @@
+"""Write the ID3 tags of a Common Voice clip before it is added to IPFS."""
+import io
+import os
+
+from mutagen.easyid3 import EasyID3
+from mutagen.mp3 import MP3
+
+from metrics import metrics
+
+
+def set_tags(audio, locale, sent_hash, client_id):
+	"""
+	Set the tags every imported clip carries
+	audio: an EasyID3 object
+	locale: language of the clip
+	sent_hash: CID of the sentence object
+	client_id: the speaker's client_id
+	"""
+	audio["copyright"] = "CC0-1.0"
+	audio["language"] = locale
+	audio["album"] = sent_hash
+	audio["author"] = client_id
+
+
+def tag_clip(clip_path, locale, sent_hash, client_id, in_memory=False):
+	"""
+	Tag a clip, either rewriting the file in place or building the tagged file in memory
+	clip_path: path to the mp3 file
+	locale: language of the clip
+	sent_hash: CID of the sentence object
+	client_id: the speaker's client_id
+	in_memory: leave the file on disk untouched
+	Returns what to add to IPFS: clip_path itself, or with in_memory a
+	BytesIO of the tagged clip named after it. Both give the same CID.
+	"""
+	if not in_memory:
+		with metrics.timer('id3.tag'):
+			audio = EasyID3(clip_path)
+			set_tags(audio, locale, sent_hash, client_id)
+			audio.save()
+		return clip_path
+
+	with metrics.timer('clip.read'):
+		with open(clip_path, 'rb') as clip_file:
+			clip_fd = io.BytesIO(clip_file.read())
+	with metrics.timer('id3.tag'):
+		audio = EasyID3(clip_fd)
+		set_tags(audio, locale, sent_hash, client_id)
+		audio.save(clip_fd)
+	clip_fd.seek(0)
+	# Name it only now, so that mutagen never mistakes it for a path on disk
+	clip_fd.name = os.path.basename(clip_path)
+	return clip_fd
+
+
+def clip_info(clip):
+	"""
+	Read the audio properties the indexer needs, so that it never has to download the clip
+	clip: what tag_clip returned, a path or a BytesIO
+	Returns a dict with the length in seconds, the bitrate in bits/sec and the size in bytes
+	"""
+	with metrics.timer('mp3.info'):
+		audio = MP3(clip)
+	if isinstance(clip, str):
+		size = os.path.getsize(clip)
+	else:
+		size = len(clip.getbuffer())
+		clip.seek(0)
+	return {
+		'length': audio.info.length,
+		'bitrate': audio.info.bitrate,
+		'size': size,
+	}
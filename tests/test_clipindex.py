@@ -0,0 +1,230 @@
+"""Checks that indexes survive conversion between formats and the CID ↔ digest mapping of the binary one."""
+import hashlib
+import json
+import os
+
+import numpy
+import pytest
+
+import cids
+import clipindex
+from clipindex import BinaryIndex, IndexWriter, export, iter_index
+
+
+def cid(name):
+	"""CIDv0 made from the SHA-256 of a name"""
+	return cids.from_digest(hashlib.sha256(name.encode('utf-8')).digest())
+
+
+# Digests that numpy's fixed-width bytes would trim or that base58 pads
+AWKWARD = [b'\0' * 32, b'\0' + b'\x01' * 31, b'\x01' * 31 + b'\0', b'\xab' * 16 + b'\0' * 16, b'\xff' * 32]
+
+
+def sample_index():
+	"""(index, info) with sentences out of digest order, clips without info and awkward digests"""
+	index = {}
+	info = {}
+	for n in range(20):
+		clips = [cid('clip %d %d' % (n, m)) for m in range(n % 4 + 1)]
+		index[cid('sentence %d' % n)] = clips
+		for (m, clip_cid) in enumerate(clips):
+			if m != 1:
+				info[clip_cid] = {'length': 1.5 + n / 7, 'bitrate': 48000 + m, 'size': 1000 * n + m}
+	index[cids.from_digest(AWKWARD[0])] = [cids.from_digest(digest) for digest in AWKWARD[1:]]
+	index[cids.from_digest(AWKWARD[3])] = [cids.from_digest(AWKWARD[2])]
+	info[cids.from_digest(AWKWARD[2])] = {'length': 4.0, 'bitrate': 0, 'size': 0}
+	return (index, info)
+
+
+def write(path, index, info):
+	writer = IndexWriter(path)
+	for (sent_cid, clips) in index.items():
+		writer.extend((sent_cid, clip_cid, info.get(clip_cid)) for clip_cid in clips)
+	writer.close()
+
+
+def entries(index, info):
+	"""What iter_index should give for an index"""
+	return [(sent_cid, clips, {clip_cid: info[clip_cid] for clip_cid in clips if clip_cid in info})
+			for (sent_cid, clips) in index.items()]
+
+
+@pytest.mark.parametrize('digest', AWKWARD + [hashlib.sha256(b'x').digest()])
+def test_cid_round_trip(digest):
+	cid_text = cids.from_digest(digest)
+	assert cid_text.startswith('Qm') and len(cid_text) == 46
+	assert cids.to_digest(cid_text) == digest
+	assert cids.b58decode(cids.b58encode(b'\0\0' + digest)) == b'\0\0' + digest
+
+
+def test_known_cid():
+	# The empty directory object
+	cid_text = 'QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn'
+	assert cids.from_digest(cids.to_digest(cid_text)) == cid_text
+
+
+@pytest.mark.parametrize('cid_text', [
+	'bafybeigdyrzt5sfp7udm7hu76uh7y26nf3efuylqabf3oclgtqy55fbzdi',
+	'Qm0OIl',
+	'QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3N',
+	'',
+])
+def test_not_cidv0(cid_text):
+	with pytest.raises(ValueError):
+		cids.to_digest(cid_text)
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.ndjson', '.cidx'])
+def test_write_and_read(tmp_path, suffix):
+	(index, info) = sample_index()
+	path = str(tmp_path / ('index' + suffix))
+	write(path, index, info)
+	assert list(iter_index(path)) == entries(index, info)
+
+
+def test_json_cidx_round_trip(tmp_path):
+	(index, info) = sample_index()
+	json_path = str(tmp_path / 'index.json')
+	write(json_path, index, info)
+	export(json_path, str(tmp_path / 'index.cidx'))
+	export(str(tmp_path / 'index.cidx'), str(tmp_path / 'back.json'))
+	with open(json_path) as a, open(str(tmp_path / 'back.json')) as b:
+		assert json.load(a) == json.load(b)
+	with open(json_path + '.info') as a, open(str(tmp_path / 'back.json.info')) as b:
+		assert json.load(a) == json.load(b)
+	with open(str(tmp_path / 'index.cidx'), 'rb') as index_file:
+		assert index_file.read(len(clipindex.BINARY_MAGIC)) == clipindex.BINARY_MAGIC
+
+
+def test_streamed_sentence_on_several_lines(tmp_path):
+	"""A sentence in more than one batch is merged back into one entry"""
+	path = str(tmp_path / 'index.ndjson')
+	(a, b, x, y, z) = [cid(name) for name in 'abxyz']
+	info = {'length': 2.0, 'bitrate': 1, 'size': 2}
+	writer = IndexWriter(path)
+	writer.extend([(a, x, info)])
+	writer.extend([(b, y)])
+	writer.extend([(a, z)])
+	writer.close()
+	assert list(iter_index(path)) == [(a, [x, z], {x: info}), (b, [y], {})]
+	assert list(iter_index(path, order=lambda sent_cid: sent_cid != b)) == [(b, [y], {}), (a, [x, z], {x: info})]
+
+
+def test_streamed_lines_written_another_way(tmp_path):
+	"""Lines not in the layout IndexWriter uses are still read, by parsing them"""
+	path = tmp_path / 'index.ndjson'
+	(a, b, c, x, y, z) = [cid(name) for name in 'abcxyz']
+	path.write_text('\n'.join([
+		json.dumps({'clips': [x], 'sentence': a}),
+		json.dumps({'sentence': b, 'clips': [y]}),
+		'{"sentence":"%s","clips":["%s"]}' % (c.replace('Qm', 'Q\\u006d'), z),
+		'',
+		'{"sentence":"%s","clips":["%s"]}' % (a, z),
+	]) + '\n')
+	assert list(iter_index(str(path))) == [(a, [x, z], {}), (b, [y], {}), (c, [z], {})]
+
+
+def test_binary_lookup(tmp_path):
+	(index, info) = sample_index()
+	path = str(tmp_path / 'index.cidx')
+	write(path, index, info)
+	binary = BinaryIndex(path)
+	try:
+		assert len(binary) == len(index)
+		assert binary.clip_count() == sum(len(clips) for clips in index.values())
+		for (sent_cid, clips) in index.items():
+			k = binary.find(sent_cid)
+			assert binary.sentence(k) == sent_cid
+			assert binary.clips(k)[0] == clips
+		assert binary.find(cid('not in the index')) is None
+		assert binary.find('not a CID') is None
+		assert [binary.sentence(k) for k in binary.numbers()] == list(index)
+	finally:
+		binary.close()
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.ndjson', '.cidx'])
+def test_order(tmp_path, suffix):
+	"""Sentences are visited by their key, ties in index order"""
+	(index, info) = sample_index()
+	path = str(tmp_path / ('index' + suffix))
+	write(path, index, info)
+	key = lambda sent_cid: sent_cid[-1] in 'abcdefghijk'
+	want = sorted(entries(index, info), key=lambda entry: key(entry[0]))
+	assert list(iter_index(path, order=key)) == want
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.ndjson', '.cidx'])
+def test_scan_order(tmp_path, suffix):
+	"""An order sorted once gives the same scan as the key, every time"""
+	(index, info) = sample_index()
+	path = str(tmp_path / ('index' + suffix))
+	write(path, index, info)
+	key = lambda sent_cid: hashlib.sha256(sent_cid.encode('utf-8')).digest()
+	order = clipindex.scan_order(path, key)
+	assert callable(order) != (suffix == '.cidx')
+	assert list(iter_index(path, order=order)) == list(iter_index(path, order=key))
+	assert list(iter_index(path, order=order)) == list(iter_index(path, order=key))
+	assert clipindex.scan_order(path, None) is None
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.ndjson', '.cidx'])
+def test_by_cid(tmp_path, suffix):
+	"""Every format visits sentences in CID order, the binary one without sorting"""
+	(index, info) = sample_index()
+	path = str(tmp_path / ('index' + suffix))
+	write(path, index, info)
+	want = sorted(entries(index, info))
+	assert list(iter_index(path, order=clipindex.by_cid)) == want
+	assert [cids.to_digest(sent_cid) for (sent_cid, _, _) in want] == sorted(cids.to_digest(sent_cid) for sent_cid in index)
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.ndjson', '.cidx'])
+@pytest.mark.parametrize('seeded', [False, True])
+def test_clip_lengths(tmp_path, suffix, seeded):
+	"""Each clip's length goes with the position of its sentence in the scan"""
+	(index, info) = sample_index()
+	path = str(tmp_path / ('index' + suffix))
+	write(path, index, info)
+	key = (lambda sent_cid: hashlib.sha256(sent_cid.encode('utf-8')).digest()) if seeded else None
+	want = sorted((position, info.get(clip_cid, {}).get('length', -1.0))
+			for (position, (_, clips, _)) in enumerate(iter_index(path, order=key)) for clip_cid in clips)
+	(positions, lengths) = clipindex.clip_lengths(path, order=clipindex.scan_order(path, key))
+	assert sorted(zip(positions.tolist(), numpy.nan_to_num(lengths, nan=-1.0).tolist())) == want
+
+
+@pytest.mark.parametrize('order', [None, str])
+def test_binary_early_close(tmp_path, monkeypatch, order):
+	"""A scan that stops early unmaps the index, the map can't be closed while arrays point into it"""
+	(index, info) = sample_index()
+	path = str(tmp_path / 'index.cidx')
+	write(path, index, info)
+	closed = []
+	close = BinaryIndex.close
+	def record(self):
+		close(self)
+		closed.append(self._map.closed)
+	monkeypatch.setattr(BinaryIndex, 'close', record)
+	sentences = iter_index(path, order=order)
+	next(sentences)
+	sentences.close()
+	assert closed == [True]
+
+
+def test_binary_rejects_other_files(tmp_path):
+	path = str(tmp_path / 'index.cidx')
+	with open(path, 'wb') as index_file:
+		index_file.write(b'{"Qm": []}' + b'\0' * 32)
+	with pytest.raises(ValueError):
+		BinaryIndex(path)
+	(index, info) = sample_index()
+	write(path, index, info)
+	os.truncate(path, os.path.getsize(path) - 8)
+	with pytest.raises(ValueError):
+		BinaryIndex(path)
+
+
+def test_binary_writer_rejects_other_cids(tmp_path):
+	writer = IndexWriter(str(tmp_path / 'index.cidx'))
+	with pytest.raises(ValueError):
+		writer.extend([('bafybeigdyrzt5sfp7udm7hu76uh7y26nf3efuylqabf3oclgtqy55fbzdi', cid('c'))])
@@ -0,0 +1,111 @@
+"""Checks that batched adds give each input the CID the node returned for it."""
+import io
+import json
+
+import pytest
+
+import ipfsbatch
+
+
+class Client:
+	"""Answers add calls like ipfshttpclient, with the entries given by answer(names)"""
+
+	def __init__(self, answer):
+		self.answer = answer
+		self.calls = []
+
+	def add(self, *files, opts={}):
+		names = [ipfsbatch.file_name(f) for f in files]
+		self.calls.append(names)
+		return self.answer(names)
+
+
+def entries(names):
+	return [{'Name': name, 'Hash': 'Qm' + name, 'Size': '1'} for name in names]
+
+
+def named(name, data=b''):
+	f = io.BytesIO(data)
+	f.name = name
+	return f
+
+
+def test_single_dict_response():
+	client = Client(lambda names: entries(names)[0])
+	assert ipfsbatch.add_many(client, ['/data/clips/a.mp3']) == [{'Name': 'a.mp3', 'Hash': 'Qma.mp3', 'Size': '1'}]
+
+
+def test_list_response_in_another_order():
+	client = Client(lambda names: list(reversed(entries(names))))
+	files = ['/data/clips/%d.mp3' % n for n in range(5)]
+	assert [entry['Hash'] for entry in ipfsbatch.add_many(client, files)] == ['Qm%d.mp3' % n for n in range(5)]
+
+
+def test_entries_named_with_a_directory():
+	client = Client(lambda names: [dict(entry, Name='wrapped/' + entry['Name']) for entry in entries(names)])
+	assert [entry['Hash'] for entry in ipfsbatch.add_many(client, [named('b.json'), named('a.json')])] == ['Qmb.json', 'Qma.json']
+
+
+def test_same_file_twice_is_sent_once():
+	client = Client(entries)
+	f = named('a.json')
+	assert [entry['Hash'] for entry in ipfsbatch.add_many(client, ['x/a.mp3', f, 'x/a.mp3', f])] == ['Qma.mp3', 'Qma.json'] * 2
+	assert client.calls == [['a.mp3', 'a.json']]
+
+
+@pytest.mark.parametrize('files', [
+	['x/a.mp3', 'y/a.mp3'],
+	[named('a.json'), named('a.json')],
+	['x/a.json', named('a.json')],
+], ids=['paths', 'file objects', 'mixed'])
+def test_duplicate_basenames_raise(files):
+	client = Client(entries)
+	with pytest.raises(ValueError):
+		ipfsbatch.add_many(client, files)
+	assert client.calls == []
+
+
+@pytest.mark.parametrize('answer', [
+	lambda names: entries(names)[1:],
+	lambda names: entries(names[:1])[0],
+	lambda names: entries(names[:-1] + ['other.mp3']),
+], ids=['missing entry', 'single entry for a batch', 'renamed entry'])
+def test_missing_entry_raises(answer):
+	with pytest.raises(ValueError):
+		ipfsbatch.add_many(Client(answer), ['a.mp3', 'b.mp3', 'c.mp3'])
+
+
+def test_nothing_to_add():
+	client = Client(entries)
+	assert ipfsbatch.add_many(client, []) == []
+	assert client.calls == []
+
+
+def test_add_json_many_keeps_order():
+	sent = {}
+	def answer(names):
+		return list(reversed(entries(names)))
+	client = Client(answer)
+	original = client.add
+	def add(*files, opts={}):
+		sent.update((f.name, json.loads(f.getvalue())) for f in files)
+		return original(*files, opts=opts)
+	client.add = add
+	objs = [{'content': 'Bir'}, {'content': 'İki'}, {'content': 'Bir'}]
+	assert ipfsbatch.add_json_many(client, objs) == ['Qm0.json', 'Qm1.json', 'Qm2.json']
+	assert sent == {'0.json': objs[0], '1.json': objs[1], '2.json': objs[2]}
+
+
+def test_against_fake_node():
+	ipfshttpclient = pytest.importorskip('ipfshttpclient')
+	import fakeipfs
+	fake = fakeipfs.FakeIPFS()
+	try:
+		client = ipfshttpclient.connect(fake.multiaddr)
+		objs = [{'n': n} for n in range(12)]
+		try:
+			assert ipfsbatch.add_json_many(client, objs) == [fakeipfs.cid(ipfsbatch.encode_json(obj)) for obj in objs]
+		finally:
+			client.close()
+	finally:
+		fake.close()
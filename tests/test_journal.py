@@ -0,0 +1,84 @@
+"""Checks that the row journal gives back what was recorded and survives a crash mid-write."""
+import os
+
+from journal import Journal
+
+INFO = {'length': 4.5, 'bitrate': 48000, 'size': 27000}
+
+
+def test_resume_gives_back_records(tmp_path):
+	path = str(tmp_path / 'index.json.journal')
+	journal = Journal(path)
+	journal.append([('a.mp3', 'QmSa', 'QmCa', INFO), ('b.mp3', 'QmSb', 'QmCb', None)])
+	journal.append([])
+	journal.append([('c.mp3', 'QmSc', 'QmCc', {})])
+	journal.close()
+	journal = Journal(path, resume=True)
+	assert journal.done == {
+		'a.mp3': ('QmSa', 'QmCa', INFO),
+		'b.mp3': ('QmSb', 'QmCb', None),
+		'c.mp3': ('QmSc', 'QmCc', None),
+	}
+	journal.close()
+
+
+def test_three_and_four_field_records(tmp_path):
+	"""Journals written before the audio info was recorded have three fields"""
+	path = tmp_path / 'index.json.journal'
+	path.write_text('a.mp3\tQmSa\tQmCa\n'
+			'b.mp3\tQmSb\tQmCb\t\n'
+			'c.mp3\tQmSc\tQmCc\t{"length":4.5,"bitrate":48000,"size":27000}\n')
+	journal = Journal(str(path), resume=True)
+	assert journal.done == {
+		'a.mp3': ('QmSa', 'QmCa', None),
+		'b.mp3': ('QmSb', 'QmCb', None),
+		'c.mp3': ('QmSc', 'QmCc', INFO),
+	}
+	journal.close()
+
+
+def test_torn_last_line_is_cut_off(tmp_path):
+	path = tmp_path / 'index.json.journal'
+	whole = 'a.mp3\tQmSa\tQmCa\t\nb.mp3\tQmSb\tQmCb\t{"length":4.5,"bit'
+	path.write_text(whole)
+	journal = Journal(str(path), resume=True)
+	assert list(journal.done) == ['a.mp3']
+	assert os.path.getsize(str(path)) == len('a.mp3\tQmSa\tQmCa\t\n')
+	# New records start on a line of their own
+	journal.append([('b.mp3', 'QmSb', 'QmCb', INFO)])
+	journal.close()
+	journal = Journal(str(path), resume=True)
+	assert journal.done == {'a.mp3': ('QmSa', 'QmCa', None), 'b.mp3': ('QmSb', 'QmCb', INFO)}
+	journal.close()
+
+
+def test_replay_stops_at_a_malformed_line(tmp_path):
+	path = tmp_path / 'index.json.journal'
+	path.write_text('a.mp3\tQmSa\tQmCa\t\nb.mp3\tQmSb\n\nc.mp3\tQmSc\tQmCc\t\n')
+	journal = Journal(str(path), resume=True)
+	assert list(journal.done) == ['a.mp3']
+	journal.close()
+	assert path.read_text() == 'a.mp3\tQmSa\tQmCa\t\n'
+
+
+def test_without_resume_starts_afresh(tmp_path):
+	path = tmp_path / 'index.json.journal'
+	path.write_text('a.mp3\tQmSa\tQmCa\t\n')
+	journal = Journal(str(path))
+	assert journal.done == {}
+	journal.close()
+	assert path.read_text() == ''
+	journal = Journal(str(tmp_path / 'missing.journal'), resume=True)
+	assert journal.done == {}
+	journal.close()
+
+
+def test_close_remove(tmp_path):
+	path = str(tmp_path / 'index.json.journal')
+	journal = Journal(path)
+	journal.append([('a.mp3', 'QmSa', 'QmCa', INFO)])
+	journal.close()
+	assert os.path.exists(path)
+	journal = Journal(path, resume=True)
+	journal.close(remove=True)
+	assert not os.path.exists(path)
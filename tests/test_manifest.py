@@ -0,0 +1,102 @@
+"""Checks that an incremental import only reuses rows whose clip and row are unchanged."""
+import hashlib
+import os
+
+import pytest
+
+import cids
+from clipindex import IndexWriter
+from manifest import Manifest, PreviousImport, clip_stat, load_manifest, manifest_path, row_digest
+from tsvreader import Row
+
+FOUND = (27000, 1600000000000000000)
+TAGGED = (27350, 1700000000000000000)
+INFO = {'length': 4.5, 'bitrate': 48000, 'size': 27350}
+
+
+def cid(name):
+	return cids.from_digest(hashlib.sha256(name.encode('utf-8')).digest())
+
+
+ROW = Row('a.mp3', 'Bir cümle.', 'tr', 'client')
+SENTENCE = cid('sentence')
+CLIP = cid('clip')
+
+
+@pytest.fixture(params=['.json', '.ndjson', '.cidx'])
+def earlier(tmp_path, request):
+	"""An earlier import of ROW and its manifest"""
+	index_path = str(tmp_path / ('index' + request.param))
+	writer = IndexWriter(index_path)
+	writer.extend([(SENTENCE, CLIP, INFO), (cid('other sentence'), cid('other clip'), None)])
+	writer.close()
+	manifest = Manifest(manifest_path(index_path))
+	manifest.append([
+		(ROW.path, FOUND, TAGGED, row_digest(ROW), SENTENCE, CLIP),
+		('b.mp3', FOUND, FOUND, row_digest(ROW), cid('other sentence'), cid('gone')),
+		('c.mp3', FOUND, FOUND, row_digest(ROW), SENTENCE, cid('other clip')),
+	])
+	manifest.close()
+	return index_path
+
+
+@pytest.mark.parametrize('stat', [FOUND, TAGGED], ids=['found', 'tagged'])
+def test_unchanged_row_is_reused(earlier, stat):
+	found = PreviousImport(earlier).lookup(ROW, stat)
+	assert found is not None
+	(record, hashes) = found
+	assert record == (ROW.path, FOUND, TAGGED, row_digest(ROW), SENTENCE, CLIP)
+	assert hashes == (SENTENCE, CLIP, INFO)
+
+
+@pytest.mark.parametrize('stat', [
+	(FOUND[0] + 1, FOUND[1]),
+	(FOUND[0], FOUND[1] + 1),
+	(TAGGED[0] - 1, TAGGED[1]),
+	(TAGGED[0], TAGGED[1] - 1),
+	(FOUND[0], TAGGED[1]),
+], ids=['found size', 'found mtime', 'tagged size', 'tagged mtime', 'mixed'])
+def test_changed_clip_is_imported_again(earlier, stat):
+	assert PreviousImport(earlier).lookup(ROW, stat) is None
+
+
+@pytest.mark.parametrize('row', [
+	ROW._replace(sentence='Bir cümle!'),
+	ROW._replace(locale='az'),
+	ROW._replace(client_id='someone else'),
+], ids=['sentence', 'locale', 'client'])
+def test_changed_row_is_imported_again(earlier, row):
+	assert PreviousImport(earlier).lookup(row, FOUND) is None
+
+
+def test_new_row_is_imported(earlier):
+	assert PreviousImport(earlier).lookup(ROW._replace(path='new.mp3'), FOUND) is None
+
+
+@pytest.mark.parametrize('path', ['b.mp3', 'c.mp3'], ids=['clip not in index', 'clip of another sentence'])
+def test_manifest_disagreeing_with_index(earlier, path):
+	assert PreviousImport(earlier).lookup(ROW._replace(path=path), FOUND) is None
+
+
+def test_row_digest():
+	"""Only what goes into the tags counts, not where the clip is"""
+	assert row_digest(ROW) == row_digest(ROW._replace(path='elsewhere.mp3'))
+	assert row_digest(ROW) != row_digest(ROW._replace(sentence='Bir cümle'))
+
+
+def test_manifest_is_only_put_in_place_on_close(tmp_path):
+	path = str(tmp_path / 'index.json.manifest')
+	manifest = Manifest(path)
+	manifest.append([(ROW.path, FOUND, TAGGED, row_digest(ROW), SENTENCE, CLIP)])
+	assert not os.path.exists(path)
+	manifest.close()
+	with open(path, 'a') as manifest_file:
+		manifest_file.write('torn\tline\n')
+	assert load_manifest(path) == {ROW.path: (ROW.path, FOUND, TAGGED, row_digest(ROW), SENTENCE, CLIP)}
+
+
+def test_clip_stat(tmp_path):
+	clip = tmp_path / 'a.mp3'
+	clip.write_bytes(b'\0' * 100)
+	os.utime(str(clip), ns=(FOUND[1], FOUND[1]))
+	assert clip_stat(str(clip)) == (100, FOUND[1])
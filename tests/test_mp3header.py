@@ -0,0 +1,155 @@
+"""Checks of the MP3 header parser on synthetic frames, it decides the clip lengths the indexer records."""
+import random
+
+import pytest
+
+import mp3header
+
+# MPEG 1 layer III, 128 kbit/s, 44100 Hz, stereo: 417 bytes a frame, 32 bytes of side info
+MPEG1 = b'\xff\xfb\x90\x00'
+MPEG1_FRAME = 144 * 128000 // 44100
+# MPEG 2 layer III, 64 kbit/s, 22050 Hz, mono: 576 samples a frame, 9 bytes of side info
+MPEG2_MONO = b'\xff\xf3\x80\xc0'
+
+
+def frame(header, body=b'', size=MPEG1_FRAME):
+	"""An audio frame of the given size starting with its header and body"""
+	return (header + body).ljust(size, b'\0')
+
+
+def lame(delay, padding):
+	"""A LAME tag with the encoder delay and padding in samples"""
+	tag = bytearray(b'LAME3.100'.ljust(24, b'\0'))
+	tag[21] = delay >> 4
+	tag[22] = ((delay & 0x0F) << 4) | (padding >> 8)
+	tag[23] = padding & 0xFF
+	return bytes(tag)
+
+
+def xing(frames, tag=b'Xing', flags=0x0F, delay=576, padding=1000, side_info=32):
+	"""Side info then a Xing/Info header with the optional fields its flags call for and a LAME tag"""
+	body = b'\0' * side_info + tag + flags.to_bytes(4, 'big') + frames.to_bytes(4, 'big')
+	if flags & 0x02:
+		body += (frames * MPEG1_FRAME).to_bytes(4, 'big')
+	if flags & 0x04:
+		body += bytes(range(100))
+	if flags & 0x08:
+		body += (50).to_bytes(4, 'big')
+	return body + lame(delay, padding)
+
+
+def vbri(frames):
+	"""32 bytes of side info then a VBRI header"""
+	return b'\0' * 32 + b'VBRI' + (1).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + (80).to_bytes(2, 'big') \
+			+ (frames * MPEG1_FRAME).to_bytes(4, 'big') + frames.to_bytes(4, 'big') + b'\0' * 8
+
+
+def id3(size, footer=False):
+	"""An ID3v2 tag of size bytes after its 10 byte header, with a syncsafe size"""
+	syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+	tag = b'ID3\x04\x00' + (b'\x10' if footer else b'\x00') + syncsafe + b'\0' * size
+	return tag + (b'3DI' + b'\0' * 7 if footer else b'')
+
+
+def audio(n):
+	"""n plain audio frames"""
+	return frame(MPEG1) * n
+
+
+@pytest.mark.parametrize('flags', [0x01, 0x03, 0x07, 0x0F])
+@pytest.mark.parametrize('tag', [b'Xing', b'Info'])
+def test_xing_with_lame_delay(tag, flags):
+	data = id3(100) + frame(MPEG1, xing(1000, tag=tag, flags=flags, delay=576, padding=1000)) + audio(3)
+	assert mp3header.duration(data, None) == pytest.approx((1000 * 1152 - 1576) / 44100)
+
+
+def test_xing_without_lame_tag():
+	body = xing(1000)[:-24] + b'\0' * 24
+	assert mp3header.duration(frame(MPEG1, body), None) == pytest.approx(1000 * 1152 / 44100)
+
+
+def test_xing_without_frame_count():
+	"""A Xing header that does not give the number of frames falls back to the file size"""
+	data = frame(MPEG1, xing(1000, flags=0x06)) + audio(9)
+	assert mp3header.duration(data, None) is None
+	assert mp3header.duration(data, len(data)) == pytest.approx(len(data) * 8 / 128000)
+
+
+def test_mpeg2_mono_xing():
+	body = xing(500, side_info=9, delay=0, padding=0)
+	data = frame(MPEG2_MONO, body, size=144 * 64000 // 22050 // 2)
+	assert mp3header.duration(data, None) == pytest.approx(500 * 576 / 22050)
+
+
+def test_vbri():
+	data = id3(20) + frame(MPEG1, vbri(2500)) + audio(2)
+	assert mp3header.duration(data, None) == pytest.approx(2500 * 1152 / 44100)
+
+
+def test_cbr_from_file_size():
+	data = id3(300) + audio(200)
+	head = data[:mp3header.HEADER_FETCH]
+	assert mp3header.duration(head, None) is None
+	assert mp3header.duration(head, len(data)) == pytest.approx(200 * MPEG1_FRAME * 8 / 128000)
+
+
+def test_frame_found_after_junk():
+	data = id3(10) + b'\xff\x00junk' + audio(50)
+	assert mp3header.duration(data, len(data)) == pytest.approx((50 * MPEG1_FRAME) * 8 / 128000)
+
+
+@pytest.mark.parametrize('footer', [False, True])
+@pytest.mark.parametrize('vbr', [False, True])
+def test_large_id3_tag(footer, vbr):
+	"""A tag longer than the first fetch, the indexer fetches again from its end"""
+	first = frame(MPEG1, xing(1000)) if vbr else frame(MPEG1)
+	data = id3(20000, footer=footer) + first + audio(300)
+	head = data[:mp3header.HEADER_FETCH]
+	base = mp3header.id3_size(head)
+	assert base == 20010 + (10 if footer else 0)
+	assert base + 1024 > len(head)
+	assert mp3header.duration(head, None) is None
+	head = data[base:base + mp3header.HEADER_FETCH]
+	if vbr:
+		assert mp3header.duration(head, None, base=base) == pytest.approx((1000 * 1152 - 1576) / 44100)
+	else:
+		assert mp3header.duration(head, None, base=base) is None
+		assert mp3header.duration(head, len(data), base=base) == pytest.approx(301 * MPEG1_FRAME * 8 / 128000)
+
+
+@pytest.mark.parametrize('data', [
+	b'',
+	b'ID3',
+	id3(50),
+	b'\xff' * 64,
+	b'\xff\xfb',
+	b'\xff\xff\xff\xff' * 100,  # reserved bitrate
+	b'\xff\xfb\x9c\x00' * 100,  # reserved sample rate
+	b'\xff\xe9\x90\x00' * 100,  # reserved version
+	b'\xff\xf9\x90\x00' * 100,  # reserved layer
+	b'RIFF\x00\x00\x00\x00WAVEfmt ' + b'\0' * 100,
+], ids=['empty', 'id3 magic', 'id3 only', 'sync bytes', 'half header', 'bad bitrate', 'bad rate', 'bad version', 'bad layer', 'wav'])
+def test_garbage(data):
+	assert mp3header.duration(data, None) is None
+	assert mp3header.duration(data, 100000) is None
+
+
+@pytest.mark.parametrize('first', [xing(1000), xing(1000, flags=0x01), vbri(1000)], ids=['xing', 'info', 'vbri'])
+def test_truncated(first):
+	"""Any prefix of a file gives a length or None, it never raises"""
+	data = id3(30) + frame(MPEG1, first) + audio(2)
+	whole = mp3header.duration(data, None)
+	for end in range(len(data)):
+		length = mp3header.duration(data[:end], None)
+		assert length is None or length == whole
+
+
+def test_random_bytes():
+	rng = random.Random(7)
+	for n in range(500):
+		data = bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 600)))
+		if n % 2:
+			# make a frame header likely
+			data = b'\xff\xfb' + data
+		length = mp3header.duration(data, rng.choice([None, len(data)]))
+		assert length is None or length >= 0
@@ -0,0 +1,48 @@
+"""Checks of the folding of alternative spellings and of mapping tokens back onto each variant."""
+from normalise import Normaliser, align, fold
+
+
+def joins(tokens, text):
+	"""Check that the tokens are in the text in order"""
+	pos = 0
+	for token in tokens:
+		start = text.find(token, pos)
+		if start < 0:
+			return False
+		pos = start + len(token)
+	return True
+
+
+def test_fold():
+	assert fold("Ur c'hi, ur c’hi.", 'br') == 'Ur cʼhi, ur cʼhi.'
+	assert fold('Istanbul', 'tr') == 'Istanbul'
+	assert len(fold("c'h’", 'br')) == len("c'h’")
+
+
+def test_align_variants():
+	folded = 'Ur cʼhi bras.'
+	tokens = ['Ur', 'cʼhi', 'bras', '.']
+	for text in ["Ur c'hi bras.", 'Ur c’hi bras.', folded]:
+		spelt = align(tokens, text, fold(text, 'br'), 'br')
+		assert [fold(token, 'br') for token in spelt] == tokens
+		assert joins(spelt, text)
+	assert align(tokens, "Ur c'hi bras.", folded, 'br') == ['Ur', "c'hi", 'bras', '.']
+
+
+def test_align_rewritten_tokens():
+	"""A token the tokeniser spelt with another variant is still found"""
+	assert align(['Ur', "c'hi"], 'Ur c’hi', 'Ur cʼhi', 'br') == ['Ur', 'c’hi']
+
+
+def test_align_fails():
+	"""Tokens that are not in the sentence in order can't be given the variant's spelling"""
+	assert align(['bras', 'Ur'], "Ur c'hi bras", 'Ur cʼhi bras', 'br') is None
+	assert align(['ki'], "Ur c'hi", 'Ur cʼhi', 'br') is None
+
+
+def test_normaliser_variants():
+	normaliser = Normaliser()
+	assert normaliser.sentence("c'hoari", 'br') == 'cʼhoari'
+	assert normaliser.sentence('cʼhoari', 'br') == 'cʼhoari'
+	assert normaliser.sentence('İyi', 'tr') == 'İyi'
+	assert normaliser.variants == {'br': {"c'hoari": 'cʼhoari'}}
@@ -0,0 +1,134 @@
+"""Checks of the memory-mapped validated.tsv reader against the files it has to cope with."""
+import csv
+
+import pytest
+
+import tsvreader
+from tsvreader import Row, TSVReader
+
+HEADER = 'client_id\tpath\tsentence\tup_votes\tdown_votes\tage\tgender\taccent\tlocale\tsegment'
+
+
+def line(n, sentence=None):
+	"""A row of validated.tsv in the Common Voice column order"""
+	sentence = 'Cümle numarası %d.' % n if sentence is None else sentence
+	return '\t'.join(('client%d' % n, 'common_voice_tr_%08d.mp3' % n, sentence, '2', '0', '', '', '', 'tr', ''))
+
+
+def expected(n, sentence=None):
+	sentence = 'Cümle numarası %d.' % n if sentence is None else sentence
+	return Row('common_voice_tr_%08d.mp3' % n, sentence, 'tr', 'client%d' % n)
+
+
+def write(tmp_path, text, newline='\n'):
+	path = tmp_path / 'validated.tsv'
+	path.write_bytes(text.replace('\n', newline).encode('utf-8'))
+	return str(path)
+
+
+def read_all(path, **kwargs):
+	reader = TSVReader(path, **kwargs)
+	try:
+		return list(reader.rows())
+	finally:
+		reader.close()
+
+
+def test_reads_rows(tmp_path):
+	path = write(tmp_path, '\n'.join([HEADER] + [line(n) for n in range(5)]) + '\n')
+	assert read_all(path) == [expected(n) for n in range(5)]
+
+
+def test_crlf(tmp_path):
+	path = write(tmp_path, '\n'.join([HEADER] + [line(n) for n in range(5)]) + '\n', newline='\r\n')
+	rows = read_all(path)
+	assert rows == [expected(n) for n in range(5)]
+	assert not any(field.endswith('\r') for row in rows for field in row)
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_blank_lines(tmp_path, newline):
+	text = '\n'.join([HEADER, line(0), '', line(1), '', '', line(2)]) + '\n\n'
+	path = write(tmp_path, text, newline=newline)
+	reader = TSVReader(path)
+	try:
+		assert len(reader) == 3
+		assert list(reader.rows()) == [expected(n) for n in range(3)]
+		assert [reader.row(i) for i in range(3)] == [expected(n) for n in range(3)]
+	finally:
+		reader.close()
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_no_trailing_newline(tmp_path, newline):
+	path = write(tmp_path, '\n'.join([HEADER] + [line(n) for n in range(3)]), newline=newline)
+	assert read_all(path) == [expected(n) for n in range(3)]
+
+
+def test_header_only(tmp_path):
+	assert read_all(write(tmp_path, HEADER + '\n')) == []
+	assert read_all(write(tmp_path, HEADER)) == []
+
+
+def test_missing_column(tmp_path):
+	with pytest.raises(ValueError):
+		TSVReader(write(tmp_path, 'client_id\tpath\tsentence\n'))
+	with pytest.raises(ValueError):
+		TSVReader(write(tmp_path, ''))
+
+
+def test_column_order_and_short_rows(tmp_path):
+	text = 'locale\tsentence\tpath\tclient_id\tsegment\n' + 'tr\tBir "iki" üç\tclip.mp3\tc1\n' + 'tr\tDört\tclip2.mp3\n'
+	assert read_all(write(tmp_path, text)) == [
+		Row('clip.mp3', 'Bir "iki" üç', 'tr', 'c1'),
+		Row('clip2.mp3', 'Dört', 'tr', ''),
+	]
+
+
+def test_matches_csv(tmp_path):
+	"""Same rows as csv.DictReader with no quoting, as the importers used before"""
+	sentences = ['"Alıntı" ile başlar', "Kesme işareti'", 'Sonunda boşluk ', 'Ünlü ünsüz']
+	path = write(tmp_path, '\n'.join([HEADER] + [line(n, sentences[n % len(sentences)]) for n in range(50)]) + '\n')
+	with open(path, 'r', encoding='utf-8', newline='') as tsv_file:
+		want = [Row(r['path'], r['sentence'], r['locale'], r['client_id'])
+				for r in csv.DictReader(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE)]
+	assert read_all(path) == want
+
+
+def test_column(tmp_path):
+	path = write(tmp_path, '\n'.join([HEADER] + [line(n) for n in range(10)]) + '\n')
+	reader = TSVReader(path)
+	try:
+		assert reader.column('path', 2, 5) == [expected(n).path for n in range(2, 5)]
+		assert reader.column('locale') == ['tr'] * 10
+	finally:
+		reader.close()
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+@pytest.mark.parametrize('trailing', [True, False])
+def test_rows_between_spans(tmp_path, monkeypatch, newline, trailing):
+	"""Rows read by byte span, as importer_mp's workers do, are the rows of the span"""
+	# Small blocks so that rows straddle the edges of the blocks
+	monkeypatch.setattr(tsvreader, 'BLOCK_SIZE', 100)
+	monkeypatch.setattr(tsvreader, 'ROWS_PER_BLOCK', 3)
+	lines = [HEADER]
+	for n in range(40):
+		lines.append(line(n))
+		if n % 7 == 0:
+			lines.append('')
+	text = '\n'.join(lines) + ('\n' if trailing else '')
+	path = write(tmp_path, text, newline=newline)
+	reader = TSVReader(path)
+	worker = TSVReader(path, index=False)
+	try:
+		assert len(reader) == 40
+		for (start, stop) in [(0, 40), (0, 1), (5, 17), (39, 40), (13, 13), (30, 100)]:
+			want = [expected(n) for n in range(start, min(stop, 40))]
+			assert list(reader.rows(start, stop)) == want
+			(first, end) = reader.span(start, stop)
+			assert list(reader.rows_between(first, end)) == want
+			assert list(worker.rows_between(first, end)) == want
+	finally:
+		reader.close()
+		worker.close()
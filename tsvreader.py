@@ -0,0 +1,187 @@
+"""Memory-mapped reader of the columns of validated.tsv that the importers use.
+
+Rather than building a dict of every column of every row, the file is mapped
+into memory and the byte offsets of its rows are kept in two numpy arrays.
+Rows are only split when they are read, a block at a time, and only the
+columns in COLUMNS are kept. Fields are split on tabs with no quoting, as in the Common Voice
+format.
+"""
+import mmap
+import os
+
+from collections import namedtuple
+from operator import itemgetter
+
+import numpy
+
+COLUMNS = ('path', 'sentence', 'locale', 'client_id')
+
+Row = namedtuple('Row', COLUMNS)
+
+# Bytes of the file searched for newlines at a time, so the search does not
+# need a temporary array the size of the file
+BLOCK_SIZE = 64 * 1024 * 1024
+# Rows decoded at a time when reading in order
+ROWS_PER_BLOCK = 8192
+
+
+class TSVReader:
+	"""Rows of a validated.tsv file, by number or by byte span."""
+
+	def __init__(self, path, index=True):
+		"""
+		Map a file and read its header
+		path: path to validated.tsv
+		index: find where every row starts and ends, without it rows can only be read by byte span
+		"""
+		self.path = path
+		self._file = open(path, 'rb')
+		self._map = None
+		size = os.fstat(self._file.fileno()).st_size
+		if size:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+			header_end = self._map.find(b'\n')
+			header = self._map[:header_end if header_end >= 0 else size]
+		else:
+			header_end = -1
+			header = b''
+		names = header.rstrip(b'\r').decode('utf-8').split('\t')
+		missing = [name for name in COLUMNS if name not in names]
+		if missing:
+			raise ValueError('%s has no %s column' % (path, ', '.join(missing)))
+		self._fields = [names.index(name) for name in COLUMNS]
+		self._last = max(self._fields)
+		self._pick = itemgetter(*self._fields)
+		# Byte offset of the first row
+		self.data_start = header_end + 1 if header_end >= 0 else size
+
+		# 8 bytes per row for files under 4 GiB
+		self._dtype = numpy.uint32 if size < 2 ** 32 else numpy.int64
+		self._starts = numpy.zeros(0, dtype=self._dtype)
+		self._ends = numpy.zeros(0, dtype=self._dtype)
+		if index:
+			self._index(size)
+
+	def _index(self, size):
+		newlines = [numpy.zeros(0, dtype=numpy.int64)]
+		for offset in range(self.data_start, size, BLOCK_SIZE):
+			count = min(BLOCK_SIZE, size - offset)
+			block = numpy.frombuffer(self._map, dtype=numpy.uint8, count=count, offset=offset)
+			newlines.append(numpy.flatnonzero(block == 0x0A).astype(numpy.int64) + offset)
+			self._release(offset, offset + count)
+		ends = numpy.concatenate(newlines)
+		if size > self.data_start and (len(ends) == 0 or ends[-1] != size - 1):
+			# Last row without a newline
+			ends = numpy.append(ends, size)
+		starts = numpy.empty_like(ends)
+		if len(ends):
+			starts[0] = self.data_start
+			starts[1:] = ends[:-1] + 1
+		# Skip blank lines, like csv does
+		lengths = ends - starts
+		crlf = lengths == 1
+		if crlf.any():
+			crlf[crlf] = numpy.frombuffer(self._map, dtype=numpy.uint8)[starts[crlf]] == 0x0D
+		keep = (lengths > 0) & ~crlf
+		self._starts = starts[keep].astype(self._dtype)
+		self._ends = ends[keep].astype(self._dtype)
+
+	def _release(self, first, end):
+		# Mapped pages that were read count towards the RSS of the process
+		# until they are dropped, they stay in the page cache
+		if not hasattr(mmap, 'MADV_DONTNEED'):
+			return
+		first -= first % mmap.PAGESIZE
+		end -= end % mmap.PAGESIZE
+		if end > first:
+			self._map.madvise(mmap.MADV_DONTNEED, first, end - first)
+
+	def __len__(self):
+		return len(self._starts)
+
+	def _parse_lines(self, data):
+		# Decoding all of the lines at once is much faster than line by line
+		pick = self._pick
+		width = self._last + 1
+		rows = []
+		for line in data.decode('utf-8').split('\n'):
+			if line.endswith('\r'):
+				line = line[:-1]
+			if not line:
+				continue
+			fields = line.split('\t', width)
+			if len(fields) < width:
+				fields += [''] * (width - len(fields))
+			rows.append(Row._make(pick(fields)))
+		return rows
+
+	def row(self, i):
+		"""
+		Read one row
+		i: row number, from 0 for the first row after the header
+		"""
+		return self._parse_lines(self._map[self._starts[i]:self._ends[i]])[0]
+
+	def rows(self, start=0, stop=None):
+		"""
+		Read a range of rows
+		start: number of the first row
+		stop: number of the row after the last one, None for the end of the file
+		Yields Row tuples
+		"""
+		stop = len(self) if stop is None else min(stop, len(self))
+		for block in range(start, stop, ROWS_PER_BLOCK):
+			(first, end) = self.span(block, min(block + ROWS_PER_BLOCK, stop))
+			yield from self._parse_lines(self._map[first:end])
+			self._release(first, end)
+
+	def __iter__(self):
+		return self.rows()
+
+	def column(self, name, start=0, stop=None):
+		"""
+		Read one column of a range of rows
+		name: one of COLUMNS
+		start: number of the first row
+		stop: number of the row after the last one, None for the end of the file
+		Returns a list of strings
+		"""
+		field = COLUMNS.index(name)
+		return [row[field] for row in self.rows(start, stop)]
+
+	def span(self, start, stop):
+		"""
+		Where a range of rows is in the file, to hand it to another process
+		start: number of the first row
+		stop: number of the row after the last one
+		Returns (first byte, byte after the last one)
+		"""
+		stop = min(stop, len(self))
+		if start >= stop:
+			return (0, 0)
+		return (int(self._starts[start]), int(self._ends[stop - 1]))
+
+	def rows_between(self, first, end):
+		"""
+		Read the rows in a byte span of the file, e.g. one from span()
+		first: offset of the start of the first row
+		end: offset of the end of the last row
+		Yields Row tuples
+		"""
+		pos = first
+		while pos < end:
+			stop = end
+			if end - pos > BLOCK_SIZE:
+				# Cut at the last newline of the block
+				cut = self._map.rfind(b'\n', pos, pos + BLOCK_SIZE)
+				if cut >= 0:
+					stop = cut
+			yield from self._parse_lines(self._map[pos:stop])
+			self._release(pos, stop)
+			pos = stop + 1
+
+	def close(self):
+		"""Unmap and close the file"""
+		if self._map is not None:
+			self._map.close()
+		self._file.close()